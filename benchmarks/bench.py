@@ -0,0 +1,237 @@
+#!/usr/bin/env python2
+"""
+Unit2OpenRC - benchmarks
+
+Generates synthetic unit corpora in temporary directory and measures time
+and memory spent by parsing, conversion, rendering and writing, as well as
+by entire auto-conversion pipeline. Archive stage also checks that
+compressed --tar-out archive is same for same units.
+
+Usage: python2 benchmarks/bench.py [--units 10,1000,10000] [--jobs N]
+"""
+from __future__ import unicode_literals
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from unit2openrc import unitfile
+from unit2openrc.unitfile import UnitFile
+from unit2openrc.unitindex import UnitIndex
+from unit2openrc.rcfile import RCFile
+from unit2openrc.convert import convert
+from unit2openrc.manifest import Manifest
+from unit2openrc.main import convert_all, write_one, archive_all
+from cStringIO import StringIO
+import corpus
+import argparse, tempfile, shutil, time, json, resource, gc
+
+STAGES = ( "parse", "convert", "render", "write", "auto", "auto-incremental",
+	"archive" )
+
+
+def load_units(root):
+	""" Returns list of (name, unit filename, drop-ins) for whole corpus """
+	index = UnitIndex(corpus.unit_dirs(root))
+	return [ (name, path, index.dropins(name))
+		for (name, path) in sorted(index.services().items()) ]
+
+
+def parse(units):
+	unitfile._layer_cache.clear()
+	rv = []
+	for name, path, dropins in units:
+		try:
+			rv.append(( name, path, UnitFile.load(path, dropins) ))
+		except ValueError:
+			pass
+	return rv
+
+
+def convert_units(parsed):
+	rv = []
+	for name, path, u in parsed:
+		rc = RCFile(name.split(".")[0])
+		try:
+			convert(u, rc)
+		except ValueError:
+			continue
+		rv.append(( path, rc ))
+	return rv
+
+
+def render(converted):
+	rv = []
+	for path, rc in converted:
+		o = StringIO()
+		rc.write(o, path)
+		rv.append(( rc.shortname, o.getvalue() ))
+	return rv
+
+
+def write(root, rendered):
+	d = corpus.init_d(root)
+	for name, data in rendered:
+		write_one(os.path.join(d, name), data)
+
+
+def clean_init_d(root):
+	d = corpus.init_d(root)
+	shutil.rmtree(d)
+	os.mkdir(d)
+
+
+def run_stage(stage, root, job_count):
+	"""
+	Runs stage, together with all stages it depends on. Returns number of
+	seconds spent in stage itself.
+	"""
+	units = load_units(root)
+	if stage == "parse":
+		t = time.time()
+		parse(units)
+		return time.time() - t
+	parsed = parse(units)
+	if stage == "convert":
+		t = time.time()
+		convert_units(parsed)
+		return time.time() - t
+	converted = convert_units(parsed)
+	if stage == "render":
+		t = time.time()
+		render(converted)
+		return time.time() - t
+	rendered = render(converted)
+	if stage == "write":
+		clean_init_d(root)
+		t = time.time()
+		write(root, rendered)
+		return time.time() - t
+	
+	del units, parsed, converted, rendered
+	clean_init_d(root)
+	manifest_file = os.path.join(root, "manifest.json")
+	if os.path.exists(manifest_file):
+		os.unlink(manifest_file)
+	if stage == "auto":
+		t = time.time()
+		convert_all(corpus.unit_dirs(root), corpus.init_d(root), job_count,
+			Manifest(manifest_file))
+		return time.time() - t
+	if stage == "auto-incremental":
+		# Converts everything, changes 1% of units and measures second run
+		convert_all(corpus.unit_dirs(root), corpus.init_d(root), job_count,
+			Manifest(manifest_file))
+		for name, path, dropins in load_units(root)[::100]:
+			f = open(path, "a")
+			f.write("# changed\n")
+			f.close()
+		t = time.time()
+		convert_all(corpus.unit_dirs(root), corpus.init_d(root), job_count,
+			Manifest(manifest_file))
+		return time.time() - t
+	if stage == "archive":
+		# Archives everything twice, second run only to compare results
+		os.environ["SOURCE_DATE_EPOCH"] = "0"
+		archive = os.path.join(root, "scripts.tar.gz")
+		index = UnitIndex(corpus.unit_dirs(root))
+		t = time.time()
+		with open(archive, "wb") as f:
+			archive_all(index, f)
+		seconds = time.time() - t
+		first = open(archive, "rb").read()
+		time.sleep(1)
+		with open(archive, "wb") as f:
+			archive_all(index, f)
+		if open(archive, "rb").read() != first:
+			raise RuntimeError("Same units produced different archives")
+		return seconds
+	raise ValueError("Unknown stage: %s" % (stage,))
+
+
+def measure(stage, root, job_count):
+	"""
+	Runs stage in forked process, so every stage starts with same memory
+	usage. Returns (seconds, peak RSS in KiB).
+	"""
+	r, w = os.pipe()
+	pid = os.fork()
+	if pid == 0:
+		os.close(r)
+		rv = 1
+		try:
+			# Output of converted scripts is not interesting here
+			devnull = os.open(os.devnull, os.O_WRONLY)
+			os.dup2(devnull, 1)
+			os.dup2(devnull, 2)
+			gc.collect()
+			seconds = run_stage(stage, root, job_count)
+			peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+			os.write(w, json.dumps([ seconds, peak ]))
+			rv = 0
+		finally:
+			os._exit(rv)
+	os.close(w)
+	data = b""
+	while True:
+		chunk = os.read(r, 4096)
+		if not chunk: break
+		data += chunk
+	os.close(r)
+	os.waitpid(pid, 0)
+	if not data:
+		raise RuntimeError("Stage '%s' failed" % (stage,))
+	return json.loads(data)
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="Benchmarks unit2openrc "
+		"on synthetic unit corpora")
+	parser.add_argument('--units', type=str, default="10,1000,10000",
+		help="comma-separated list of corpus sizes (default 10,1000,10000)")
+	parser.add_argument('--stages', type=str, default=",".join(STAGES),
+		help="comma-separated list of stages to run (default: all)")
+	parser.add_argument('--jobs', type=int, default=None,
+		help="number of worker processes used by auto stages")
+	parser.add_argument('--repeat', type=int, default=3,
+		help="number of runs; best time is reported (default 3)")
+	parser.add_argument('--seed', type=int, default=0,
+		help="seed used to generate corpora")
+	parser.add_argument('--json', action='store_true',
+		help="output results as JSON")
+	args = parser.parse_args(argv[1:])
+	
+	sizes = [ int(x) for x in args.units.split(",") ]
+	stages = args.stages.split(",")
+	for s in stages:
+		if s not in STAGES:
+			parser.error("unknown stage: %s" % (s,))
+	
+	results = []
+	if not args.json:
+		print "%8s  %-17s %10s %12s %14s" % ("units", "stage", "time [s]",
+			"units/s", "peak RSS [MiB]")
+	for count in sizes:
+		root = tempfile.mkdtemp(prefix="unit2openrc-bench-")
+		try:
+			corpus.generate(root, count, args.seed)
+			for stage in stages:
+				best, peak = None, 0
+				for i in xrange(args.repeat):
+					seconds, rss = measure(stage, root, args.jobs)
+					best = seconds if best is None else min(best, seconds)
+					peak = max(peak, rss)
+				r = dict(units=count, stage=stage, seconds=best,
+					throughput=count / best if best else None,
+					peak_rss_kib=peak)
+				results.append(r)
+				if not args.json:
+					print "%8s  %-17s %10.4f %12.0f %14.1f" % (count, stage,
+						best, r['throughput'] or 0, peak / 1024.0)
+					sys.stdout.flush()
+		finally:
+			shutil.rmtree(root)
+	if args.json:
+		print json.dumps(results, indent=1)
+
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
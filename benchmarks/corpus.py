@@ -0,0 +1,131 @@
+#!/usr/bin/env python2
+"""
+Unit2OpenRC - benchmark corpus
+
+Generates synthetic, but realistic looking set of systemd units in
+temporary root directory.
+"""
+from __future__ import unicode_literals
+import os, random
+
+# Directories relative to generated root, in same order as in UNIT_DIRS
+ETC_DIR = "etc/systemd/system"
+LIB_DIR = "usr/lib/systemd/system"
+INIT_D = "etc/init.d"
+
+TARGETS = ( "network.target", "network-online.target", "local-fs.target",
+	"remote-fs.target", "nss-lookup.target", "dbus.socket", "syslog.target" )
+WORDS = ( "cache", "proxy", "agent", "worker", "monitor", "sync", "store",
+	"queue", "index", "gateway", "collector", "relay", "scheduler" )
+
+UNIT_TEMPLATE = """[Unit]
+Description=%(description)s
+Documentation=man:%(name)s(8)
+%(deps)s
+[Service]
+Type=%(type)s
+%(service)s
+[Install]
+WantedBy=multi-user.target
+"""
+
+
+def unit_dirs(root):
+	""" Returns list of unit directories in generated root """
+	return [ os.path.join(root, ETC_DIR), os.path.join(root, LIB_DIR) ]
+
+
+def init_d(root):
+	""" Returns path to directory where rc scripts should be generated """
+	return os.path.join(root, INIT_D)
+
+
+def generate(root, count, seed=0):
+	"""
+	Generates 'count' service units under 'root'. Returns list of
+	generated unit names.
+	
+	Units are mix of simple, forking and dbus services, with random
+	dependency fan-out to other generated services and targets, some with
+	long ExecStartPre lists, some overridden by drop-ins and some masked.
+	Same seed generates same corpus.
+	"""
+	rnd = random.Random(seed)
+	for d in unit_dirs(root) + [ init_d(root) ]:
+		if not os.path.isdir(d):
+			os.makedirs(d)
+	etc_dir, lib_dir = unit_dirs(root)
+	
+	names = []
+	for i in xrange(count):
+		name = "%s-%s%s.service" % (rnd.choice(WORDS), rnd.choice(WORDS), i)
+		names.append(name)
+		r = rnd.random()
+		if r < 0.6:
+			unit_type = "simple"
+		elif r < 0.85:
+			unit_type = "forking"
+		else:
+			unit_type = "dbus"
+		
+		# Dependencies on earlier services and targets
+		deps = []
+		earlier = names[max(0, i - 200):i]
+		fanout = min(len(earlier), int(rnd.expovariate(0.3)))
+		after = rnd.sample(earlier, fanout) + rnd.sample(TARGETS, rnd.randint(0, 3))
+		if after:
+			deps.append("After=%s" % (" ".join(after),))
+		if fanout and rnd.random() < 0.5:
+			deps.append("Requires=%s" % (" ".join(after[0:rnd.randint(1, fanout)]),))
+		if fanout and rnd.random() < 0.5:
+			deps.append("Wants=%s" % (rnd.choice(earlier),))
+		if rnd.random() < 0.1:
+			deps.append("Before=%s" % (rnd.choice(TARGETS),))
+		
+		# Service section
+		service = []
+		binary = "/usr/bin/%s" % (name.split(".")[0],)
+		if rnd.random() < 0.3:
+			service.append('Environment="OPTS=--level %s" LANG=C' % (rnd.randint(0, 9),))
+		pre = int(rnd.expovariate(0.5)) if rnd.random() < 0.4 else 0
+		if rnd.random() < 0.05:
+			pre += 30
+		for j in xrange(pre):
+			service.append('ExecStartPre=%s/bin/mkdir -p "/var/lib/%s/dir %s"'
+				% ("-" if j % 3 == 0 else "", name.split(".")[0], j))
+		if unit_type == "forking":
+			service.append("PIDFile=/run/%s.pid" % (name.split(".")[0],))
+			service.append("ExecStart=%s --daemonize --config /etc/%s.conf" % (binary, i))
+		else:
+			service.append("ExecStart=%s --foreground \\\n\t--name \"%s\" -v" % (binary, name))
+		if unit_type == "dbus":
+			service.append("BusName=org.example.%s%s" % (rnd.choice(WORDS).title(), i))
+		if rnd.random() < 0.2:
+			service.append("ExecStartPost=/bin/touch /run/%s.ready" % (i,))
+		if rnd.random() < 0.2:
+			service.append("ExecStop=/bin/kill -TERM $MAINPID")
+		if rnd.random() < 0.1:
+			service.append("ExecStopPost=/bin/rm -f /run/%s.ready" % (i,))
+		
+		f = open(os.path.join(lib_dir, name), "w")
+		f.write((UNIT_TEMPLATE % dict(
+			name = name.split(".")[0],
+			description = "Synthetic %s service number %s" % (unit_type, i),
+			deps = "".join([ x + "\n" for x in deps ]),
+			type = unit_type,
+			service = "".join([ x + "\n" for x in service ]),
+		)).encode('utf-8'))
+		f.close()
+		
+		# Local overrides
+		r = rnd.random()
+		if r < 0.1:
+			d = os.path.join(etc_dir, name + ".d")
+			os.mkdir(d)
+			f = open(os.path.join(d, "override.conf"), "w")
+			f.write("[Service]\nEnvironment=OVERRIDDEN=1\n")
+			f.close()
+		elif r < 0.12:
+			os.symlink("/dev/null", os.path.join(etc_dir, name))
+	
+	return names
@@ -5,111 +5,244 @@ Simple executable that waits until service with name passed as argument
 is available and exits with exit code 0.
 
 If anything fails, exits with code 1.
+
+When started with --broker, keeps running, holding single bus connection
+and tracking which names are owned. Other instances then only ask broker
+over unix socket, instead of connecting to bus by themselves. If broker
+is not running, every instance connects to bus on its own.
 */
 
+#define _GNU_SOURCE		// accept4, SOCK_CLOEXEC
 #include <stdlib.h>
 #include <stdio.h>
 #include <string.h>
+#include <errno.h>
+#include <time.h>		// clock_gettime
+#include <unistd.h>
+#include <getopt.h>
+#include <poll.h>
 #include <signal.h>
-#include <unistd.h>		// alarm function
+#include <sys/socket.h>
+#include <sys/stat.h>
+#include <sys/un.h>
 #include <dbus/dbus.h>
 
+#define DEFAULT_SOCKET "/run/dbus-service-wait.sock"
+#define MAX_CLIENTS 256
+#define MAX_REQUEST 512
+#define NAME_BUCKETS 256
+
 
 typedef struct {
 	/** Holds name of service to wait for */
 	char *excepted_name;
-	/** Holds pending ListNames method call */
-	DBusPendingCall *pending;
+	/** Set to 1 when name is acquired */
+	int found;
 	/** Holds executable name (argv[0]) */
 	char *arg0;
+	/** DBUS_BUS_SYSTEM or DBUS_BUS_SESSION */
+	DBusBusType bus_type;
 } ProgramData;
 
+/** Single entry in set of owned names */
+typedef struct OwnedName {
+	char *name;
+	struct OwnedName *next;
+} OwnedName;
+
+/** Client connected to broker */
+typedef struct {
+	int fd;
+	/** Request, read up to first newline */
+	char request[MAX_REQUEST];
+	size_t request_len;
+	/** Name client waits for, NULL while request is not complete */
+	char *name;
+	struct timespec deadline;
+} Client;
+
+/** State of broker */
+typedef struct {
+	char *arg0;
+	/** Hash set of well-known names that have owner */
+	OwnedName *owned[NAME_BUCKETS];
+	Client clients[MAX_CLIENTS];
+	int client_count;
+} Broker;
+
 
 /**
- * Filters recieved messages and calls request_service_list to (re)check list
- * of available services every time when NameOwnerChanged event is detected.
+ * Filters recieved messages and sets data->found when NameOwnerChanged
+ * signal reports that excepted name got new owner.
  */
 static DBusHandlerResult check_nameowner_changed (DBusConnection *bus, DBusMessage *message, void *user_data);
 
 /**
- * Sends ListNames method call to request list of all available services.
+ * Asks bus if excepted name already has owner.
+ * Returns 1 if it has, 0 if not and -1 on failure.
+ */
+static int name_has_owner(DBusConnection *bus, ProgramData *data, int timeout_ms);
+
+/**
+ * Waits for name by connecting to bus directly.
+ * Returns exit code.
  */
-static void request_service_list(DBusConnection *bus, ProgramData *data);
+static int wait_direct(ProgramData *data, struct timespec *deadline);
 
 /**
- * Parses list of services recieved as response to method call
- * sent by request_service_list.
+ * Asks broker listening on socket_path to wait for name.
+ * Returns exit code, or -1 if broker is not available.
  */
-static void parse_service_list(ProgramData *data);
+static int wait_broker(ProgramData *data, const char *socket_path, struct timespec *deadline);
+
+/** Runs broker. Returns exit code */
+static int run_broker(ProgramData *data, const char *socket_path);
+
+/** Set by SIGTERM and SIGINT to stop broker */
+static volatile sig_atomic_t terminated = 0;
+
+static void terminate(int sig) {
+	terminated = 1;
+}
 
-/** Called by SIGALRM if service is not found in given time */
-static void timeout_reached(int sig);
+/** Returns milliseconds remaining until deadline, or 0 if deadline passed */
+static int remaining_ms(struct timespec *deadline);
 
 /** Prints error message. Returns 1 */
 static int help(FILE *fd, ProgramData *data);
 
 
 int main (int argc, char **argv) {
-	ProgramData data = { NULL, NULL, argv[0] };
-	uint timeout = 5;
+	ProgramData data = { NULL, 0, argv[0], DBUS_BUS_SYSTEM };
+	const char *socket_path = DEFAULT_SOCKET;
+	int timeout = 5;
+	int broker = 0;
+	int c;
+	
+	static struct option long_options[] = {
+		{ "broker",  no_argument,       NULL, 'b' },
+		{ "session", no_argument,       NULL, 'S' },
+		{ "socket",  required_argument, NULL, 's' },
+		{ "timeout", required_argument, NULL, 't' },
+		{ "help",    no_argument,       NULL, 'h' },
+		{ NULL, 0, NULL, 0 }
+	};
 	
 	// Parse arguments
-	if ((argc < 2) || (argc > 4))
-		// Invalid argument count
-		return help(stderr, &data);
-	data.excepted_name = argv[1];
-	if (strcmp(argv[1], "-t") == 0) {
-		// Timeout specified
-		if (argc != 4)
-			// Invalid argument count
-			return help(stderr, &data);
-		timeout = atoi(argv[2]);
-		if (timeout < 1)
-			// Invalid timeout
+	while ((c = getopt_long(argc, argv, "bSs:t:h", long_options, NULL)) != -1) {
+		switch (c) {
+			case 'b':
+				broker = 1;
+				break;
+			case 'S':
+				data.bus_type = DBUS_BUS_SESSION;
+				break;
+			case 's':
+				socket_path = optarg;
+				break;
+			case 't':
+				timeout = atoi(optarg);
+				if (timeout < 1)
+					// Invalid timeout
+					return help(stderr, &data);
+				break;
+			case 'h':
+				// Display help
+				return help(stdout, &data) && 0;
+			default:
+				return help(stderr, &data);
+		}
+	}
+	
+	if (broker) {
+		if (optind != argc)
+			// Broker takes no bus name
 			return help(stderr, &data);
-		data.excepted_name = argv[3];
+		return run_broker(&data, socket_path);
 	}
-	if (strcmp(argv[1], "--help") == 0)
-		// Display help
-		return help(stdout, &data) && 0;
-	if (strcmp(argv[1], "-h") == 0)
-		// Display help
-		return help(stdout, &data) && 0;
+	
+	if (optind != argc - 1)
+		// Invalid argument count
+		return help(stderr, &data);
+	data.excepted_name = argv[optind];
 	
 	DBusError error = DBUS_ERROR_INIT;
-	DBusConnection *bus;
-
+	if (!dbus_validate_bus_name(data.excepted_name, &error)) {
+		fprintf (stderr, "%s: Invalid bus name: %s\n", argv[0], error.message);
+		dbus_error_free (&error);
+		return 1;
+	}
+	
 	// Setup timeout
-	signal (SIGALRM, timeout_reached);
-	alarm (timeout);
+	struct timespec deadline;
+	clock_gettime(CLOCK_MONOTONIC, &deadline);
+	deadline.tv_sec += timeout;
+	
+	// Ask broker, if there is any
+	int rv = wait_broker(&data, socket_path, &deadline);
+	if (rv >= 0)
+		return rv;
+	
+	return wait_direct(&data, &deadline);
+}
+
 
+static int remaining_ms(struct timespec *deadline) {
+	struct timespec now;
+	clock_gettime(CLOCK_MONOTONIC, &now);
+	long ms = (deadline->tv_sec - now.tv_sec) * 1000
+		+ (deadline->tv_nsec - now.tv_nsec) / 1000000;
+	return ms > 0 ? (int)ms : 0;
+}
+
+
+static int wait_direct(ProgramData *data, struct timespec *deadline) {
+	DBusError error = DBUS_ERROR_INIT;
+	DBusConnection *bus;
+	
 	// Connect to DBus
-	bus = dbus_bus_get (DBUS_BUS_SYSTEM, &error); 
+	bus = dbus_bus_get (data->bus_type, &error); 
 	if (!bus) {
-		fprintf (stderr, "%s: Failed to acquire system bus: %s\n", argv[0], error.message);
+		fprintf (stderr, "%s: Failed to acquire bus: %s\n", data->arg0, error.message);
 		dbus_error_free (&error);
 		return 1;
 	}
 	
-	// Setup filtering
-	char* filter = "interface='org.freedesktop.DBus',member='NameOwnerChanged'";
+	// Setup filtering. Match rule with arg0 ensures that only signals
+	// about excepted name are delivered.
+	char filter[512];
+	snprintf(filter, sizeof(filter), "type='signal',sender='org.freedesktop.DBus',"
+		"interface='org.freedesktop.DBus',member='NameOwnerChanged',arg0='%s'",
+		data->excepted_name);
 	dbus_bus_add_match (bus, filter, &error);
 	if (dbus_error_is_set (&error)) {
-		fprintf (stderr, "%s: Failed to setup filter: %s\n", argv[0], error.message);
+		fprintf (stderr, "%s: Failed to setup filter: %s\n", data->arg0, error.message);
 		dbus_error_free (&error);
 		return 1;
 	}
 	
 	// Enable calling to check_nameowner_changed
-	dbus_connection_add_filter (bus, check_nameowner_changed, &data, NULL);
-	request_service_list(bus, &data);
+	dbus_connection_add_filter (bus, check_nameowner_changed, data, NULL);
+	
+	// Check if name is already acquired. This is done only after match is
+	// added, so name acquired in meantime is not missed.
+	switch (name_has_owner(bus, data, remaining_ms(deadline))) {
+		case 1:
+			return 0;
+		case -1:
+			return 1;
+	}
 	
 	// Loop until finished
-	while (dbus_connection_read_write_dispatch (bus, -1)) {
-		if ((data.pending != NULL) && dbus_pending_call_get_completed(data.pending)) {
-			parse_service_list(&data);
-			dbus_pending_call_unref(data.pending);
-			data.pending = NULL;
+	while (!data->found) {
+		int remaining = remaining_ms(deadline);
+		if (remaining == 0) {
+			fprintf (stderr, "Timeout reached\n");
+			return 1;
+		}
+		if (!dbus_connection_read_write_dispatch (bus, remaining)) {
+			fprintf (stderr, "%s: Disconnected from bus\n", data->arg0);
+			return 1;
 		}
 	}
 	
@@ -118,84 +251,455 @@ int main (int argc, char **argv) {
 }
 
 
-static void timeout_reached(int s) {
-	fprintf (stderr, "Timeout reached\n");
-	exit(1);
+static int wait_broker(ProgramData *data, const char *socket_path, struct timespec *deadline) {
+	struct sockaddr_un addr;
+	char request[MAX_REQUEST];
+	char reply[8];
+	size_t len = 0;
+	int fd;
+	
+	if (strlen(socket_path) >= sizeof(addr.sun_path))
+		return -1;
+	memset(&addr, 0, sizeof(addr));
+	addr.sun_family = AF_UNIX;
+	strcpy(addr.sun_path, socket_path);
+	
+	fd = socket(AF_UNIX, SOCK_STREAM | SOCK_CLOEXEC, 0);
+	if (fd < 0)
+		return -1;
+	if (connect(fd, (struct sockaddr*)&addr, sizeof(addr)) < 0) {
+		// No broker
+		close(fd);
+		return -1;
+	}
+	
+	signal(SIGPIPE, SIG_IGN);
+	snprintf(request, sizeof(request), "WAIT %d %s\n", remaining_ms(deadline),
+		data->excepted_name);
+	if (write(fd, request, strlen(request)) != (ssize_t)strlen(request)) {
+		close(fd);
+		return -1;
+	}
+	
+	// Broker replies when name is acquired or when timeout is reached.
+	// One more second is given to it, in case it's busy.
+	struct pollfd pfd = { fd, POLLIN, 0 };
+	while (len < sizeof(reply) - 1) {
+		int r = poll(&pfd, 1, remaining_ms(deadline) + 1000);
+		if (r < 0 && errno == EINTR)
+			continue;
+		if (r <= 0)
+			break;
+		ssize_t n = read(fd, reply + len, sizeof(reply) - 1 - len);
+		if (n < 0 && errno == EINTR)
+			continue;
+		if (n <= 0)
+			break;
+		len += n;
+		if (memchr(reply, '\n', len) != NULL)
+			break;
+	}
+	close(fd);
+	
+	if ((len >= 2) && (reply[0] == '1') && (reply[1] == '\n'))
+		return 0;
+	if ((len >= 2) && (reply[0] == '0') && (reply[1] == '\n')) {
+		fprintf (stderr, "Timeout reached\n");
+		return 1;
+	}
+	// Broker went away without answering, try on own
+	return -1;
 }
 
 
-static void request_service_list(DBusConnection *bus, ProgramData* data) {
-	DBusMessage* message;
-
+static int name_has_owner(DBusConnection *bus, ProgramData *data, int timeout_ms) {
+	DBusError error = DBUS_ERROR_INIT;
+	DBusMessage *message, *reply;
+	dbus_bool_t has_owner = FALSE;
+	
 	message = dbus_message_new_method_call("org.freedesktop.DBus",
-		"/org/freedesktop/DBus", "org.freedesktop.DBus", "ListNames");
+		"/org/freedesktop/DBus", "org.freedesktop.DBus", "NameHasOwner");
 	if (message == NULL) {
 		fprintf (stderr, "%s: Failed to allocate dbus message\n", data->arg0);
-		exit(1);
+		return -1;
+	}
+	dbus_message_append_args(message, DBUS_TYPE_STRING, &data->excepted_name,
+		DBUS_TYPE_INVALID);
+	
+	reply = dbus_connection_send_with_reply_and_block(bus, message,
+		timeout_ms > 0 ? timeout_ms : 1, &error);
+	dbus_message_unref(message);
+	if (reply == NULL) {
+		fprintf (stderr, "%s: NameHasOwner call failed: %s\n", data->arg0, error.message);
+		dbus_error_free (&error);
+		return -1;
+	}
+	
+	if (!dbus_message_get_args(reply, &error, DBUS_TYPE_BOOLEAN, &has_owner,
+			DBUS_TYPE_INVALID)) {
+		fprintf (stderr, "%s: Invalid reply to NameHasOwner: %s\n", data->arg0, error.message);
+		dbus_error_free (&error);
+		dbus_message_unref(reply);
+		return -1;
 	}
+	
+	dbus_message_unref(reply);
+	return has_owner ? 1 : 0;
+}
+
 
-	if (!dbus_connection_send_with_reply (bus, message, &(data->pending), -1)) {
-		fprintf (stderr, "%s: Failed to send dbus message\n", data->arg0);
-		exit(1);
+static DBusHandlerResult check_nameowner_changed (DBusConnection *bus, DBusMessage *message, void* user_data) {
+	ProgramData *data = (ProgramData*)user_data;
+	const char *name, *old_owner, *new_owner;
+	
+	// Watch only for NameOwnerChanged messages
+	if (!dbus_message_is_signal(message, "org.freedesktop.DBus", "NameOwnerChanged"))
+		return DBUS_HANDLER_RESULT_NOT_YET_HANDLED;
+	
+	if (dbus_message_get_args(message, NULL,
+			DBUS_TYPE_STRING, &name,
+			DBUS_TYPE_STRING, &old_owner,
+			DBUS_TYPE_STRING, &new_owner,
+			DBUS_TYPE_INVALID)) {
+		if ((strcmp(data->excepted_name, name) == 0) && (new_owner[0] != 0))
+			data->found = 1;
 	}
-	dbus_connection_flush(bus);
+	return DBUS_HANDLER_RESULT_HANDLED;
+}
+
+
+/* Broker */
+
+static unsigned int name_hash(const char *name) {
+	unsigned int h = 5381;
+	while (*name)
+		h = h * 33 + (unsigned char)*name++;
+	return h % NAME_BUCKETS;
+}
+
 
-	if (NULL == data->pending) { 
-		fprintf (stderr, "%s: Failed to allocate response for ListNames call\n", data->arg0);
-		exit(1);
+static int broker_is_owned(Broker *b, const char *name) {
+	OwnedName *n;
+	for (n = b->owned[name_hash(name)]; n != NULL; n = n->next)
+		if (strcmp(n->name, name) == 0)
+			return 1;
+	return 0;
+}
+
+
+static void broker_set_owned(Broker *b, const char *name, int owned) {
+	OwnedName **p = &b->owned[name_hash(name)];
+	if (name[0] == ':')
+		// Unique names are not interesting
+		return;
+	for (; *p != NULL; p = &(*p)->next) {
+		if (strcmp((*p)->name, name) == 0) {
+			if (!owned) {
+				OwnedName *n = *p;
+				*p = n->next;
+				free(n->name);
+				free(n);
+			}
+			return;
+		}
+	}
+	if (owned) {
+		OwnedName *n = malloc(sizeof(OwnedName));
+		if ((n == NULL) || ((n->name = strdup(name)) == NULL)) {
+			fprintf (stderr, "Out of memory\n");
+			exit(1);
+		}
+		n->next = NULL;
+		*p = n;
+	}
+}
+
+
+/** Sends reply to client and disconnects it */
+static void broker_reply(Broker *b, int i, int found) {
+	const char *reply = found ? "1\n" : "0\n";
+	if (write(b->clients[i].fd, reply, 2) < 0) {
+		// Client is gone, nothing to do about it
 	}
+	close(b->clients[i].fd);
+	free(b->clients[i].name);
+	b->clients[i] = b->clients[--b->client_count];
+}
+
+
+/**
+ * Parses complete request from client. Returns 0 on success, -1 if
+ * request is not valid.
+ * Requests are 'HAS <name>' and 'WAIT <timeout in ms> <name>', ended by
+ * newline.
+ */
+static int broker_parse_request(Broker *b, int i) {
+	Client *c = &b->clients[i];
+	char *name;
+	int timeout_ms = 0;
 	
-	dbus_message_unref(message);
+	// Request ends at first newline; it may not contain NUL byte
+	char *end = memchr(c->request, '\n', c->request_len);
+	if ((end == NULL) || (memchr(c->request, 0, end - c->request) != NULL))
+		return -1;
+	*end = 0;
+	if (strncmp(c->request, "HAS ", 4) == 0) {
+		name = c->request + 4;
+	} else if (strncmp(c->request, "WAIT ", 5) == 0) {
+		timeout_ms = strtol(c->request + 5, &name, 10);
+		if ((*name != ' ') || (timeout_ms < 0))
+			return -1;
+		name ++;
+	} else {
+		return -1;
+	}
+	if (!dbus_validate_bus_name(name, NULL))
+		return -1;
+	if ((c->name = strdup(name)) == NULL)
+		return -1;
+	clock_gettime(CLOCK_MONOTONIC, &c->deadline);
+	c->deadline.tv_sec += timeout_ms / 1000;
+	c->deadline.tv_nsec += (timeout_ms % 1000) * 1000000L;
+	if (c->deadline.tv_nsec >= 1000000000L) {
+		c->deadline.tv_sec ++;
+		c->deadline.tv_nsec -= 1000000000L;
+	}
+	return 0;
 }
 
 
-static void parse_service_list(ProgramData *data) {
-	DBusMessageIter iter;
-	DBusMessageIter value;
-	DBusMessage *message = dbus_pending_call_steal_reply(data->pending);
+static DBusHandlerResult broker_nameowner_changed (DBusConnection *bus, DBusMessage *message, void* user_data) {
+	Broker *b = (Broker*)user_data;
+	const char *name, *old_owner, *new_owner;
+	int i;
+	
+	if (!dbus_message_is_signal(message, "org.freedesktop.DBus", "NameOwnerChanged"))
+		return DBUS_HANDLER_RESULT_NOT_YET_HANDLED;
+	if (!dbus_message_get_args(message, NULL,
+			DBUS_TYPE_STRING, &name,
+			DBUS_TYPE_STRING, &old_owner,
+			DBUS_TYPE_STRING, &new_owner,
+			DBUS_TYPE_INVALID))
+		return DBUS_HANDLER_RESULT_HANDLED;
 	
-	dbus_message_iter_init(message, &iter);
+	broker_set_owned(b, name, new_owner[0] != 0);
+	if (new_owner[0] != 0) {
+		// Wake up everyone waiting for this name
+		for (i = b->client_count - 1; i >= 0; i--)
+			if ((b->clients[i].name != NULL) && (strcmp(b->clients[i].name, name) == 0))
+				broker_reply(b, i, 1);
+	}
+	return DBUS_HANDLER_RESULT_HANDLED;
+}
 
+
+/** Loads all currently owned names using ListNames call */
+static int broker_list_names(Broker *b, DBusConnection *bus) {
+	DBusError error = DBUS_ERROR_INIT;
+	DBusMessageIter iter, value;
+	DBusMessage *message, *reply;
+	
+	message = dbus_message_new_method_call("org.freedesktop.DBus",
+		"/org/freedesktop/DBus", "org.freedesktop.DBus", "ListNames");
+	if (message == NULL) {
+		fprintf (stderr, "%s: Failed to allocate dbus message\n", b->arg0);
+		return -1;
+	}
+	reply = dbus_connection_send_with_reply_and_block(bus, message, -1, &error);
+	dbus_message_unref(message);
+	if (reply == NULL) {
+		fprintf (stderr, "%s: ListNames call failed: %s\n", b->arg0, error.message);
+		dbus_error_free (&error);
+		return -1;
+	}
+	
+	dbus_message_iter_init(reply, &iter);
 	if (dbus_message_iter_get_arg_type(&iter) == DBUS_TYPE_ARRAY) {
 		dbus_message_iter_recurse(&iter, &value);
 		while (dbus_message_iter_get_arg_type(&value) == DBUS_TYPE_STRING) {
 			const char *name;
 			dbus_message_iter_get_basic(&value, &name);
-			if (strcmp(data->excepted_name, name) == 0) {
-				exit(0);
-			}
+			broker_set_owned(b, name, 1);
 			dbus_message_iter_next(&value);
 		}
 	}
-	
-	dbus_message_unref(message);
-
+	dbus_message_unref(reply);
+	return 0;
 }
 
 
-static DBusHandlerResult check_nameowner_changed (DBusConnection *bus, DBusMessage *message, void* user_data) {
-	ProgramData *data = (ProgramData*)user_data;
-	DBusMessageIter iter;
-	int i = 0;
-	char* str = NULL; 
+static int run_broker(ProgramData *data, const char *socket_path) {
+	DBusError error = DBUS_ERROR_INIT;
+	DBusConnection *bus;
+	struct sockaddr_un addr;
+	struct pollfd fds[MAX_CLIENTS + 2];
+	Broker *b;
+	int bus_fd, listen_fd, i;
 	
-	// Watch only for NameOwnerChanged messages
-	if (dbus_message_has_member(message, "NameOwnerChanged")) {
-		if (data->pending == NULL) {
-			request_service_list(bus, data);
+	if ((b = calloc(1, sizeof(Broker))) == NULL) {
+		fprintf (stderr, "Out of memory\n");
+		return 1;
+	}
+	b->arg0 = data->arg0;
+	signal(SIGPIPE, SIG_IGN);
+	signal(SIGTERM, terminate);
+	signal(SIGINT, terminate);
+	
+	// Connect to DBus and subscribe to all name owner changes
+	bus = dbus_bus_get (data->bus_type, &error); 
+	if (!bus) {
+		fprintf (stderr, "%s: Failed to acquire bus: %s\n", data->arg0, error.message);
+		dbus_error_free (&error);
+		return 1;
+	}
+	dbus_bus_add_match (bus, "type='signal',sender='org.freedesktop.DBus',"
+		"interface='org.freedesktop.DBus',member='NameOwnerChanged'", &error);
+	if (dbus_error_is_set (&error)) {
+		fprintf (stderr, "%s: Failed to setup filter: %s\n", data->arg0, error.message);
+		dbus_error_free (&error);
+		return 1;
+	}
+	dbus_connection_add_filter (bus, broker_nameowner_changed, b, NULL);
+	if (broker_list_names(b, bus) < 0)
+		return 1;
+	if (!dbus_connection_get_unix_fd(bus, &bus_fd)) {
+		fprintf (stderr, "%s: Failed to get bus connection socket\n", data->arg0);
+		return 1;
+	}
+	
+	// Create listening socket
+	if (strlen(socket_path) >= sizeof(addr.sun_path)) {
+		fprintf (stderr, "%s: Socket path too long\n", data->arg0);
+		return 1;
+	}
+	memset(&addr, 0, sizeof(addr));
+	addr.sun_family = AF_UNIX;
+	strcpy(addr.sun_path, socket_path);
+	listen_fd = socket(AF_UNIX, SOCK_STREAM | SOCK_CLOEXEC | SOCK_NONBLOCK, 0);
+	unlink(socket_path);
+	mode_t old_umask = umask(077);
+	if ((listen_fd < 0)
+			|| (bind(listen_fd, (struct sockaddr*)&addr, sizeof(addr)) < 0)
+			|| (listen(listen_fd, 64) < 0)) {
+		fprintf (stderr, "%s: Failed to listen on %s: %s\n", data->arg0,
+			socket_path, strerror(errno));
+		return 1;
+	}
+	umask(old_umask);
+	
+	while (!terminated) {
+		// Dispatch everything that's already read, including signals
+		// recieved while waiting for ListNames reply
+		while (dbus_connection_dispatch(bus) == DBUS_DISPATCH_DATA_REMAINS);
+		if (!dbus_connection_get_is_connected(bus)) {
+			fprintf (stderr, "%s: Disconnected from bus\n", data->arg0);
+			break;
+		}
+		
+		// Reply to clients whose time is up and find nearest deadline
+		int timeout = -1;
+		for (i = b->client_count - 1; i >= 0; i--) {
+			if (b->clients[i].name == NULL) continue;
+			int remaining = remaining_ms(&b->clients[i].deadline);
+			if (remaining == 0)
+				broker_reply(b, i, 0);
+			else if ((timeout < 0) || (remaining < timeout))
+				timeout = remaining;
+		}
+		
+		fds[0].fd = bus_fd;
+		fds[0].events = POLLIN;
+		if (dbus_connection_has_messages_to_send(bus))
+			fds[0].events |= POLLOUT;
+		fds[1].fd = listen_fd;
+		fds[1].events = b->client_count < MAX_CLIENTS ? POLLIN : 0;
+		for (i = 0; i < b->client_count; i++) {
+			fds[i + 2].fd = b->clients[i].fd;
+			fds[i + 2].events = POLLIN;
+		}
+		int count = b->client_count;
+		if (poll(fds, count + 2, timeout) < 0) {
+			if (errno == EINTR) continue;
+			fprintf (stderr, "%s: poll failed: %s\n", data->arg0, strerror(errno));
+			break;
+		}
+		
+		if (fds[0].revents)
+			dbus_connection_read_write(bus, 0);
+		
+		// Read from clients. Iterates backwards, as broker_reply moves last
+		// client into place of removed one
+		for (i = count - 1; i >= 0; i--) {
+			Client *c = &b->clients[i];
+			if (!fds[i + 2].revents) continue;
+			if (c->name != NULL) {
+				// Client has nothing more to say; this is hangup
+				char tmp[64];
+				if (read(c->fd, tmp, sizeof(tmp)) <= 0) {
+					close(c->fd);
+					free(c->name);
+					b->clients[i] = b->clients[--b->client_count];
+				}
+				continue;
+			}
+			ssize_t n = read(c->fd, c->request + c->request_len,
+				MAX_REQUEST - 1 - c->request_len);
+			if ((n < 0) && ((errno == EINTR) || (errno == EAGAIN)))
+				continue;
+			if (n <= 0) {
+				close(c->fd);
+				b->clients[i] = b->clients[--b->client_count];
+				continue;
+			}
+			c->request_len += n;
+			if (memchr(c->request, '\n', c->request_len) == NULL) {
+				if (c->request_len >= MAX_REQUEST - 1) {
+					// Request too long
+					close(c->fd);
+					b->clients[i] = b->clients[--b->client_count];
+				}
+				continue;
+			}
+			if (broker_parse_request(b, i) < 0) {
+				close(c->fd);
+				b->clients[i] = b->clients[--b->client_count];
+				continue;
+			}
+			if (broker_is_owned(b, c->name))
+				broker_reply(b, i, 1);
+			else if (strncmp(c->request, "HAS ", 4) == 0)
+				broker_reply(b, i, 0);
+		}
+		
+		// Accept new clients
+		if (fds[1].revents & POLLIN) {
+			while (b->client_count < MAX_CLIENTS) {
+				int fd = accept4(listen_fd, NULL, NULL, SOCK_CLOEXEC | SOCK_NONBLOCK);
+				if (fd < 0) break;
+				memset(&b->clients[b->client_count], 0, sizeof(Client));
+				b->clients[b->client_count].fd = fd;
+				b->client_count ++;
+			}
 		}
 	}
-	return DBUS_HANDLER_RESULT_HANDLED;
+	
+	unlink(socket_path);
+	return terminated ? 0 : 1;
 }
 
 
 static int help(FILE *fd, ProgramData *data) {
-	fprintf (fd, "Usage: %s [-t timeout] BusName\n", data->arg0);
+	fprintf (fd, "Usage: %s [-t timeout] [-s socket] [-S] BusName\n", data->arg0);
+	fprintf (fd, "   or: %s --broker [-s socket] [-S]\n", data->arg0);
 	fprintf (fd, "   or: %s [-h|--help]\n", data->arg0);
 	fprintf (fd, "\n");
 	fprintf (fd, "Waits until specified the D-Bus bus name is acquired.\n");
 	fprintf (fd, "Options:\n");
-	fprintf (fd, "  -t            Specifies timeout in seconds. Default 5\n");
+	fprintf (fd, "  -t, --timeout Specifies timeout in seconds. Default 5\n");
+	fprintf (fd, "  -s, --socket  Socket used to talk with broker. Default %s\n", DEFAULT_SOCKET);
+	fprintf (fd, "  -S, --session Use session bus instead of system bus\n");
+	fprintf (fd, "  -b, --broker  Keep running and answer other instances over socket,\n");
+	fprintf (fd, "                so they don't have to connect to bus by themselves\n");
 	fprintf (fd, "  -h, --help    Display this help output\n");
 	fprintf (fd, "\n");
 	fprintf (fd, "Exits codes:\n");
@@ -203,4 +707,4 @@ static int help(FILE *fd, ProgramData *data) {
 	fprintf (fd, "  1 - timeout was reached or other failure.\n");
 	
 	return 1;	
-}
\ No newline at end of file
+}
@@ -0,0 +1,328 @@
+/*
+Unit2OpenRC - notify-service-wait
+
+Starts command with NOTIFY_SOCKET environment variable pointing to
+datagram socket owned by this executable and waits until daemon started
+by command sends READY=1 to it, as Type=notify services do.
+
+Exits with code 0 when READY=1 is recieved. If command fails, daemon dies,
+timeout is reached or anything else fails, exits with code 1. Daemon that
+was started, but never became ready, is killed and its pidfile removed,
+so service can be started again.
+*/
+
+#include <stdlib.h>
+#include <stdio.h>
+#include <string.h>
+#include <errno.h>
+#include <time.h>		// clock_gettime
+#include <unistd.h>
+#include <poll.h>
+#include <signal.h>		// kill
+#include <sys/socket.h>
+#include <sys/un.h>
+#include <sys/wait.h>
+
+/** How often is daemon checked for being alive, in ms */
+#define CHECK_INTERVAL 100
+/** How long is daemon given to exit after SIGTERM, in ms */
+#define STOP_TIMEOUT 5000
+
+
+typedef struct {
+	/** Path to notification socket */
+	char *socket_path;
+	/** Path to pidfile of daemon, may be NULL */
+	char *pidfile;
+	/** Holds executable name (argv[0]) */
+	char *arg0;
+} ProgramData;
+
+
+/** Creates and binds notification socket. Returns its fd or -1 */
+static int create_socket(ProgramData *data);
+
+/** Starts command with NOTIFY_SOCKET set. Returns pid or -1 */
+static pid_t start_command(ProgramData *data, char **argv);
+
+/**
+ * Reads all pending notifications from socket.
+ * Returns 1 if READY=1 was recieved, 0 otherwise.
+ */
+static int read_notifications(int fd);
+
+/** Returns pid stored in pidfile, or 0 if it cannot be read */
+static pid_t read_pid(ProgramData *data);
+
+/**
+ * Returns 0 if daemon with pid stored in pidfile is no longer running,
+ * 1 if it is running or if it cannot be determined.
+ */
+static int daemon_alive(ProgramData *data);
+
+/**
+ * Stops daemon that didn't become ready. Sends SIGTERM to pid from
+ * pidfile, SIGKILL if it doesn't exit in STOP_TIMEOUT, and removes
+ * pidfile.
+ */
+static void stop_daemon(ProgramData *data);
+
+/** Returns milliseconds remaining until deadline, or 0 if deadline passed */
+static int remaining_ms(struct timespec *deadline);
+
+/** Prints error message. Returns 1 */
+static int help(FILE *fd, ProgramData *data);
+
+
+int main (int argc, char **argv) {
+	ProgramData data = { NULL, NULL, argv[0] };
+	int timeout = 90;
+	int i = 1;
+	
+	// Parse arguments
+	while ((i < argc) && (argv[i][0] == '-')) {
+		if ((strcmp(argv[i], "-h") == 0) || (strcmp(argv[i], "--help") == 0))
+			// Display help
+			return help(stdout, &data) && 0;
+		if ((strcmp(argv[i], "-t") == 0) && (i + 1 < argc)) {
+			// Timeout specified; 0 means no timeout
+			char *end;
+			timeout = strtol(argv[i + 1], &end, 10);
+			if ((*end != 0) || (timeout < 0))
+				return help(stderr, &data);
+			i += 2;
+		} else if ((strcmp(argv[i], "-p") == 0) && (i + 1 < argc)) {
+			data.pidfile = argv[i + 1];
+			i += 2;
+		} else {
+			return help(stderr, &data);
+		}
+	}
+	// Remaining arguments are socket path, '--' and command
+	if ((argc - i < 3) || (strcmp(argv[i + 1], "--") != 0))
+		return help(stderr, &data);
+	data.socket_path = argv[i];
+	
+	// Setup timeout
+	struct timespec deadline;
+	clock_gettime(CLOCK_MONOTONIC, &deadline);
+	deadline.tv_sec += timeout;
+	
+	int fd = create_socket(&data);
+	if (fd < 0)
+		return 1;
+	
+	pid_t pid = start_command(&data, argv + i + 2);
+	if (pid < 0) {
+		unlink(data.socket_path);
+		return 1;
+	}
+	
+	// Loop until READY=1 is recieved. 'started' is set once command
+	// exits successfully, only then pidfile surely belongs to new daemon
+	int rv = 1;
+	int started = 0;
+	struct pollfd pfd = { fd, POLLIN, 0 };
+	while (1) {
+		int wait_ms = CHECK_INTERVAL;
+		if (timeout > 0) {
+			int remaining = remaining_ms(&deadline);
+			if (remaining == 0) {
+				fprintf (stderr, "Timeout reached\n");
+				break;
+			}
+			if (remaining < wait_ms)
+				wait_ms = remaining;
+		}
+		
+		int r = poll(&pfd, 1, wait_ms);
+		if ((r < 0) && (errno != EINTR)) {
+			fprintf (stderr, "%s: poll failed: %s\n", argv[0], strerror(errno));
+			break;
+		}
+		if ((r > 0) && read_notifications(fd)) {
+			rv = 0;
+			break;
+		}
+		
+		// Check if command failed. Command is expected to exit with 0 as
+		// soon as daemon is started on background.
+		if (pid > 0) {
+			int status;
+			if (waitpid(pid, &status, WNOHANG) == pid) {
+				pid = 0;
+				if (!WIFEXITED(status) || (WEXITSTATUS(status) != 0)) {
+					fprintf (stderr, "%s: Command failed\n", argv[0]);
+					break;
+				}
+				started = 1;
+			}
+		} else if (!daemon_alive(&data)) {
+			fprintf (stderr, "%s: Daemon exited before it was ready\n", argv[0]);
+			break;
+		}
+	}
+	
+	close(fd);
+	unlink(data.socket_path);
+	if (rv != 0) {
+		if (pid > 0) {
+			// Command is still running
+			kill(pid, SIGTERM);
+			waitpid(pid, NULL, 0);
+		}
+		if (started)
+			stop_daemon(&data);
+	}
+	return rv;
+}
+
+
+static int remaining_ms(struct timespec *deadline) {
+	struct timespec now;
+	clock_gettime(CLOCK_MONOTONIC, &now);
+	long ms = (deadline->tv_sec - now.tv_sec) * 1000
+		+ (deadline->tv_nsec - now.tv_nsec) / 1000000;
+	return ms > 0 ? (int)ms : 0;
+}
+
+
+static int create_socket(ProgramData *data) {
+	struct sockaddr_un addr;
+	
+	if (strlen(data->socket_path) >= sizeof(addr.sun_path)) {
+		fprintf (stderr, "%s: Socket path too long\n", data->arg0);
+		return -1;
+	}
+	memset(&addr, 0, sizeof(addr));
+	addr.sun_family = AF_UNIX;
+	strcpy(addr.sun_path, data->socket_path);
+	
+	int fd = socket(AF_UNIX, SOCK_DGRAM | SOCK_CLOEXEC | SOCK_NONBLOCK, 0);
+	if (fd < 0) {
+		fprintf (stderr, "%s: Failed to create socket: %s\n", data->arg0, strerror(errno));
+		return -1;
+	}
+	unlink(data->socket_path);
+	if (bind(fd, (struct sockaddr*)&addr, sizeof(addr)) < 0) {
+		fprintf (stderr, "%s: Failed to bind %s: %s\n", data->arg0,
+			data->socket_path, strerror(errno));
+		close(fd);
+		return -1;
+	}
+	return fd;
+}
+
+
+static pid_t start_command(ProgramData *data, char **argv) {
+	pid_t pid = fork();
+	if (pid < 0) {
+		fprintf (stderr, "%s: fork failed: %s\n", data->arg0, strerror(errno));
+		return -1;
+	}
+	if (pid == 0) {
+		setenv("NOTIFY_SOCKET", data->socket_path, 1);
+		execvp(argv[0], argv);
+		fprintf (stderr, "%s: Failed to execute %s: %s\n", data->arg0,
+			argv[0], strerror(errno));
+		_exit(127);
+	}
+	return pid;
+}
+
+
+static int read_notifications(int fd) {
+	char buffer[4096];
+	ssize_t n;
+	
+	while ((n = recv(fd, buffer, sizeof(buffer) - 1, 0)) >= 0) {
+		// Message is list of newline-separated assignments
+		buffer[n] = 0;
+		char *line = buffer;
+		while (line != NULL) {
+			char *next = strchr(line, '\n');
+			if (next != NULL)
+				*(next++) = 0;
+			if (strcmp(line, "READY=1") == 0)
+				return 1;
+			line = next;
+		}
+	}
+	return 0;
+}
+
+
+static pid_t read_pid(ProgramData *data) {
+	if (data->pidfile == NULL)
+		return 0;
+	FILE *f = fopen(data->pidfile, "r");
+	if (f == NULL)
+		return 0;
+	long pid = 0;
+	int r = fscanf(f, "%ld", &pid);
+	fclose(f);
+	if ((r != 1) || (pid < 1))
+		return 0;
+	return (pid_t)pid;
+}
+
+
+static int daemon_alive(ProgramData *data) {
+	long pid = read_pid(data);
+	if (pid == 0)
+		return 1;
+	if ((kill((pid_t)pid, 0) < 0) && (errno == ESRCH))
+		return 0;
+	
+	// Process that is not yet reaped still exists, but is not alive
+	char path[64], stat[512];
+	snprintf(path, sizeof(path), "/proc/%ld/stat", pid);
+	FILE *f = fopen(path, "r");
+	if (f == NULL)
+		return 1;
+	size_t n = fread(stat, 1, sizeof(stat) - 1, f);
+	fclose(f);
+	stat[n] = 0;
+	// State follows process name, which is in parenthesis and may contain anything
+	char *end = strrchr(stat, ')');
+	return ((end != NULL) && (end[1] == ' ') && (end[2] == 'Z')) ? 0 : 1;
+}
+
+
+static void stop_daemon(ProgramData *data) {
+	pid_t pid = read_pid(data);
+	if (pid == 0)
+		return;
+	if (daemon_alive(data)) {
+		fprintf (stderr, "%s: Stopping daemon %ld\n", data->arg0, (long)pid);
+		kill(pid, SIGTERM);
+		struct timespec deadline;
+		clock_gettime(CLOCK_MONOTONIC, &deadline);
+		deadline.tv_sec += STOP_TIMEOUT / 1000;
+		while (daemon_alive(data) && (remaining_ms(&deadline) > 0))
+			poll(NULL, 0, CHECK_INTERVAL);
+		if (daemon_alive(data))
+			kill(pid, SIGKILL);
+	}
+	unlink(data->pidfile);
+}
+
+
+static int help(FILE *fd, ProgramData *data) {
+	fprintf (fd, "Usage: %s [-t timeout] [-p pidfile] socket -- command [args...]\n", data->arg0);
+	fprintf (fd, "   or: %s [-h|--help]\n", data->arg0);
+	fprintf (fd, "\n");
+	fprintf (fd, "Executes command with NOTIFY_SOCKET set to socket and waits until\n");
+	fprintf (fd, "started daemon sends READY=1 notification.\n");
+	fprintf (fd, "Options:\n");
+	fprintf (fd, "  -t            Specifies timeout in seconds; 0 means no timeout. Default 90\n");
+	fprintf (fd, "  -p            Pidfile of daemon, used to detect that daemon died\n");
+	fprintf (fd, "  -h, --help    Display this help output\n");
+	fprintf (fd, "\n");
+	fprintf (fd, "Exits codes:\n");
+	fprintf (fd, "  0 - daemon is ready\n");
+	fprintf (fd, "  1 - timeout was reached or other failure. Daemon that didn't\n");
+	fprintf (fd, "      become ready is killed and its pidfile removed.\n");
+	
+	return 1;
+}
@@ -0,0 +1,370 @@
+/*
+Unit2OpenRC - socket-activate
+
+Binds listening sockets described by systemd .socket unit, waits until
+first connection (or datagram) arrives to any of them and then replaces
+itself with daemon, passing sockets to it as systemd does, using
+LISTEN_FDS, LISTEN_PID and LISTEN_FDNAMES environment variables.
+
+As daemon replaces this process, pid stays same and pidfile written by
+start-stop-daemon remains valid.
+*/
+
+#define _GNU_SOURCE
+#include <stdlib.h>
+#include <stdio.h>
+#include <string.h>
+#include <stddef.h>		// offsetof
+#include <errno.h>
+#include <unistd.h>
+#include <fcntl.h>
+#include <poll.h>
+#include <signal.h>
+#include <netdb.h>
+#include <sys/stat.h>
+#include <sys/socket.h>
+#include <sys/un.h>
+#include <netinet/in.h>
+
+/** Maximum number of sockets */
+#define MAX_SOCKETS 64
+/** First file descriptor passed to daemon, as defined by sd_listen_fds */
+#define LISTEN_FDS_START 3
+
+
+typedef struct {
+	/** Listening sockets */
+	int fds[MAX_SOCKETS];
+	/** Path of every unix socket, so it can be removed, or NULL */
+	char *paths[MAX_SOCKETS];
+	int count;
+	/** Name passed in LISTEN_FDNAMES */
+	char *name;
+	/** Permissions of unix sockets */
+	mode_t mode;
+	/** Holds executable name (argv[0]) */
+	char *arg0;
+} ProgramData;
+
+/** Set to signal number by signal handler */
+static volatile sig_atomic_t terminated = 0;
+
+
+/**
+ * Creates, binds and (for connection-oriented types) starts listening on
+ * socket. 'address' is in format used by ListenStream= and similar options.
+ * Returns 0 on success, 1 on failure.
+ */
+static int add_socket(ProgramData *data, int type, char *address);
+
+/**
+ * Waits until there is something to read from any socket.
+ * Returns 0 when daemon should be started, 1 if terminated by signal
+ */
+static int wait_for_activity(ProgramData *data);
+
+/** Moves sockets to fds starting at LISTEN_FDS_START, sets environment and executes daemon */
+static int exec_daemon(ProgramData *data, char **argv);
+
+/** Removes all unix sockets created in filesystem */
+static void cleanup(ProgramData *data);
+
+static void on_signal(int sig) { terminated = sig; }
+
+/** Prints error message. Returns 1 */
+static int help(FILE *fd, ProgramData *data);
+
+
+int main (int argc, char **argv) {
+	ProgramData data;
+	memset(&data, 0, sizeof(data));
+	data.arg0 = argv[0];
+	data.mode = 0666;
+	int c;
+	
+	// Parse arguments; '+' stops on first non-option, everything after
+	// '--' is daemon command
+	while ((c = getopt(argc, argv, "+hn:m:s:d:q:")) != -1) {
+		char *end;
+		switch (c) {
+			case 'h':
+				return help(stdout, &data) && 0;
+			case 'n':
+				data.name = optarg;
+				break;
+			case 'm':
+				data.mode = strtol(optarg, &end, 8);
+				if (*end != 0)
+					return help(stderr, &data);
+				break;
+			case 's':
+				if (add_socket(&data, SOCK_STREAM, optarg)) {
+					cleanup(&data);
+					return 1;
+				}
+				break;
+			case 'd':
+				if (add_socket(&data, SOCK_DGRAM, optarg)) {
+					cleanup(&data);
+					return 1;
+				}
+				break;
+			case 'q':
+				if (add_socket(&data, SOCK_SEQPACKET, optarg)) {
+					cleanup(&data);
+					return 1;
+				}
+				break;
+			default:
+				cleanup(&data);
+				return help(stderr, &data);
+		}
+	}
+	if ((data.count == 0) || (optind >= argc)) {
+		cleanup(&data);
+		return help(stderr, &data);
+	}
+	
+	if (wait_for_activity(&data)) {
+		cleanup(&data);
+		return 128 + terminated;
+	}
+	return exec_daemon(&data, argv + optind);
+}
+
+
+/**
+ * Parses 'host:port' or '[host]:port' and fills addr.
+ * Returns 0 on success, 1 on failure.
+ */
+static int parse_inet(ProgramData *data, char *address, int type,
+			struct sockaddr_storage *addr, socklen_t *len) {
+	char host[256];
+	char *port = strrchr(address, ':');
+	if ((port == NULL) || (port - address >= (long)sizeof(host))) {
+		fprintf (stderr, "%s: Invalid address: %s\n", data->arg0, address);
+		return 1;
+	}
+	memcpy(host, address, port - address);
+	host[port - address] = 0;
+	port ++;
+	char *h = host;
+	if ((h[0] == '[') && (h[strlen(h) - 1] == ']')) {
+		h[strlen(h) - 1] = 0;
+		h ++;
+	}
+	
+	struct addrinfo hints, *res;
+	memset(&hints, 0, sizeof(hints));
+	hints.ai_family = AF_UNSPEC;
+	hints.ai_socktype = type;
+	hints.ai_flags = AI_NUMERICHOST | AI_NUMERICSERV | AI_PASSIVE;
+	int r = getaddrinfo(h, port, &hints, &res);
+	if (r != 0) {
+		fprintf (stderr, "%s: Invalid address %s: %s\n", data->arg0, address, gai_strerror(r));
+		return 1;
+	}
+	memcpy(addr, res->ai_addr, res->ai_addrlen);
+	*len = res->ai_addrlen;
+	freeaddrinfo(res);
+	return 0;
+}
+
+
+static int add_socket(ProgramData *data, int type, char *address) {
+	struct sockaddr_storage addr;
+	socklen_t len;
+	char *path = NULL;
+	
+	if (data->count >= MAX_SOCKETS) {
+		fprintf (stderr, "%s: Too many sockets\n", data->arg0);
+		return 1;
+	}
+	memset(&addr, 0, sizeof(addr));
+	if ((address[0] == '/') || (address[0] == '@')) {
+		// Unix socket; '@' stands for abstract namespace
+		struct sockaddr_un *un = (struct sockaddr_un*)&addr;
+		size_t l = strlen(address);
+		if (l >= sizeof(un->sun_path)) {
+			fprintf (stderr, "%s: Socket path too long\n", data->arg0);
+			return 1;
+		}
+		un->sun_family = AF_UNIX;
+		memcpy(un->sun_path, address, l);
+		len = offsetof(struct sockaddr_un, sun_path) + l;
+		if (address[0] == '@')
+			un->sun_path[0] = 0;
+		else
+			path = address;
+	} else if (strspn(address, "0123456789") == strlen(address)) {
+		// Only port number, listen on all addresses
+		struct sockaddr_in6 *in6 = (struct sockaddr_in6*)&addr;
+		in6->sin6_family = AF_INET6;
+		in6->sin6_addr = in6addr_any;
+		in6->sin6_port = htons(atoi(address));
+		len = sizeof(struct sockaddr_in6);
+	} else if (parse_inet(data, address, type, &addr, &len)) {
+		return 1;
+	}
+	
+	int fd = socket(addr.ss_family, type | SOCK_CLOEXEC, 0);
+	if ((fd < 0) && (addr.ss_family == AF_INET6) && (errno == EAFNOSUPPORT)) {
+		// Port only, but there is no IPv6 support
+		struct sockaddr_in *in = (struct sockaddr_in*)&addr;
+		in_port_t port = ((struct sockaddr_in6*)&addr)->sin6_port;
+		memset(&addr, 0, sizeof(addr));
+		in->sin_family = AF_INET;
+		in->sin_addr.s_addr = htonl(INADDR_ANY);
+		in->sin_port = port;
+		len = sizeof(struct sockaddr_in);
+		fd = socket(AF_INET, type | SOCK_CLOEXEC, 0);
+	}
+	if (fd < 0) {
+		fprintf (stderr, "%s: Failed to create socket: %s\n", data->arg0, strerror(errno));
+		return 1;
+	}
+	
+	int one = 1, zero = 0;
+	if (addr.ss_family == AF_INET6)
+		// Accept IPv4 connections as well, as systemd does by default
+		setsockopt(fd, IPPROTO_IPV6, IPV6_V6ONLY, &zero, sizeof(zero));
+	if (addr.ss_family != AF_UNIX)
+		setsockopt(fd, SOL_SOCKET, SO_REUSEADDR, &one, sizeof(one));
+	if (path != NULL) {
+		struct stat st;
+		if ((lstat(path, &st) == 0) && S_ISSOCK(st.st_mode))
+			// Left over by previous instance
+			unlink(path);
+	}
+	if (bind(fd, (struct sockaddr*)&addr, len) < 0) {
+		fprintf (stderr, "%s: Failed to bind %s: %s\n", data->arg0, address, strerror(errno));
+		close(fd);
+		return 1;
+	}
+	if ((path != NULL) && (chmod(path, data->mode) < 0))
+		fprintf (stderr, "%s: Failed to set permissions of %s: %s\n", data->arg0,
+			path, strerror(errno));
+	if ((type != SOCK_DGRAM) && (listen(fd, SOMAXCONN) < 0)) {
+		fprintf (stderr, "%s: Failed to listen on %s: %s\n", data->arg0, address, strerror(errno));
+		close(fd);
+		if (path != NULL)
+			unlink(path);
+		return 1;
+	}
+	
+	data->fds[data->count] = fd;
+	data->paths[data->count] = path;
+	data->count ++;
+	return 0;
+}
+
+
+static int wait_for_activity(ProgramData *data) {
+	struct pollfd pfds[MAX_SOCKETS];
+	struct sigaction sa;
+	int i;
+	
+	// No SA_RESTART, so poll is interrupted
+	memset(&sa, 0, sizeof(sa));
+	sa.sa_handler = on_signal;
+	sigaction(SIGTERM, &sa, NULL);
+	sigaction(SIGINT, &sa, NULL);
+	
+	for (i = 0; i < data->count; i++) {
+		pfds[i].fd = data->fds[i];
+		pfds[i].events = POLLIN;
+		pfds[i].revents = 0;
+	}
+	while (!terminated) {
+		int r = poll(pfds, data->count, -1);
+		if (r > 0)
+			break;
+		if ((r < 0) && (errno != EINTR)) {
+			fprintf (stderr, "%s: poll failed: %s\n", data->arg0, strerror(errno));
+			// Start daemon anyway, it may still be able to use sockets
+			break;
+		}
+	}
+	
+	sa.sa_handler = SIG_DFL;
+	sigaction(SIGTERM, &sa, NULL);
+	sigaction(SIGINT, &sa, NULL);
+	return terminated ? 1 : 0;
+}
+
+
+static int exec_daemon(ProgramData *data, char **argv) {
+	int tmp[MAX_SOCKETS];
+	int i;
+	
+	// Move sockets out of the way first, so dup2 below cannot overwrite
+	// socket that was not moved yet
+	for (i = 0; i < data->count; i++) {
+		tmp[i] = fcntl(data->fds[i], F_DUPFD_CLOEXEC, LISTEN_FDS_START + data->count);
+		if (tmp[i] < 0) {
+			fprintf (stderr, "%s: fcntl failed: %s\n", data->arg0, strerror(errno));
+			return 1;
+		}
+		close(data->fds[i]);
+	}
+	for (i = 0; i < data->count; i++) {
+		// dup2 clears FD_CLOEXEC, so only these are inherited by daemon
+		if (dup2(tmp[i], LISTEN_FDS_START + i) < 0) {
+			fprintf (stderr, "%s: dup2 failed: %s\n", data->arg0, strerror(errno));
+			return 1;
+		}
+		close(tmp[i]);
+	}
+	
+	char buffer[32];
+	snprintf(buffer, sizeof(buffer), "%d", data->count);
+	setenv("LISTEN_FDS", buffer, 1);
+	snprintf(buffer, sizeof(buffer), "%ld", (long)getpid());
+	setenv("LISTEN_PID", buffer, 1);
+	if (data->name != NULL) {
+		// Same name for every socket, separated by ':'
+		size_t l = strlen(data->name) + 1;
+		char *names = malloc(l * data->count);
+		if (names != NULL) {
+			for (i = 0; i < data->count; i++) {
+				memcpy(names + i * l, data->name, l - 1);
+				names[i * l + l - 1] = (i == data->count - 1) ? 0 : ':';
+			}
+			setenv("LISTEN_FDNAMES", names, 1);
+		}
+	}
+	
+	execvp(argv[0], argv);
+	fprintf (stderr, "%s: Failed to execute %s: %s\n", data->arg0, argv[0], strerror(errno));
+	return 127;
+}
+
+
+static void cleanup(ProgramData *data) {
+	int i;
+	for (i = 0; i < data->count; i++) {
+		close(data->fds[i]);
+		if (data->paths[i] != NULL)
+			unlink(data->paths[i]);
+	}
+	data->count = 0;
+}
+
+
+static int help(FILE *fd, ProgramData *data) {
+	fprintf (fd, "Usage: %s [-n name] [-m mode] [-s|-d|-q address]... -- command [args...]\n", data->arg0);
+	fprintf (fd, "   or: %s [-h]\n", data->arg0);
+	fprintf (fd, "\n");
+	fprintf (fd, "Listens on given addresses and executes command as soon as first\n");
+	fprintf (fd, "connection or datagram arrives, passing sockets to it as systemd does.\n");
+	fprintf (fd, "Address is path, @abstract-name, port or address:port.\n");
+	fprintf (fd, "Options:\n");
+	fprintf (fd, "  -s            Stream socket (ListenStream=)\n");
+	fprintf (fd, "  -d            Datagram socket (ListenDatagram=)\n");
+	fprintf (fd, "  -q            Sequential packet socket (ListenSequentialPacket=)\n");
+	fprintf (fd, "  -n            Name passed in LISTEN_FDNAMES\n");
+	fprintf (fd, "  -m            Permissions of unix sockets, in octal. Default 0666\n");
+	fprintf (fd, "  -h            Display this help output\n");
+	
+	return 1;
+}
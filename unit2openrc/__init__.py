@@ -2,38 +2,25 @@
 """
 Unit2OpenRC - common tools and classes
 """
-import shlex
+from template import quote_arg
+from cmdline import split_words
+from collections import namedtuple
+import re, os, stat, tempfile
 
 class ServiceConfig(object):
-	""" Common part of RCFile and UnitFile """
-	
-	def __init__(self):
-		self.__dict__['values'] = {}
-	
-	
-	def __getattr__(self, k):
-		""" Overrides getattr to provide simpler access to self.values dict """
-		if k in self.values:
-			return self.values[k]
-		return object.__getattribute__(self, k)
-	
-	
-	def __hasattr__(self, k):
-		""" Overrides hasattr to provide simpler access to self.values dict """
-		return k in self.values or object.__hasattribute__(self, k)
-	
+	"""
+	Common part of RCFile and UnitFile.
+	Subclasses list all their fields in __slots__.
+	"""
+	__slots__ = ( )
 	
 	def __contains__(self, k):
-		""" Overrides 'in' operator to provide simpler access to self.values dict """
-		return k in self.values
-	
-	
-	def __setattr__(self, k, v):
-		""" Redirects all new values into self.values dict """
-		if not k in self.__dict__:
-			self.values[k] = v
-		else:
-			return object.__setattr__(self, k, v)
+		"""
+		Returns True if field 'k' is set, that is not None and not empty
+		list.
+		"""
+		v = getattr(self, k, None)
+		return v is not None and v != []
 	
 	
 	def __str__(self):
@@ -48,16 +35,9 @@ class Command(object):
 	
 	def __init__(self, *args):
 		self.args = list(args)
-		self.prefix = ""
-	
-	
-	def indent(self, amount=1):
-		"""
-		Adds indent (spaces) before command.
-		Returns self.
-		"""
-		self.prefix += "\t" * amount
-		return self
+		# If True, failure of command doesn't stop start_pre, start_post
+		# and similar functions
+		self.ignore_failure = False
 	
 	
 	def extend(self, *a):
@@ -71,50 +51,169 @@ class Command(object):
 	
 	def to_string(self):
 		"""
-		Returns command arguments as quoted, escaped, unicode string.
-		"""
-		# escape quotes and special characters
-		l = [ (x.encode('utf-8').encode('string_escape').replace("\\'", "'")
-				.replace('"', '\\"').decode('utf-8'))
-				if '"' in x else x for x in self.args ]
-		# quote arguments
-		l = [ '"%s"' % (x,) if " " in x and x.strip() != "" else x for x in l ]
-		return self.prefix + " ".join(l)	
-	
-	@staticmethod
-	def multiple(*commands):
-		"""
-		Creates list of multiple Command instances.
-		Each parameter should be either Command instance or string that will
-		be passed to Command.split() method.
+		Returns command arguments as quoted unicode string, safe to use
+		in shell script.
 		"""
-		rv = []
-		for c in commands:
-			if type(c) == list:
-				rv.extend(c)
-			elif isinstance(c, Command):
-				rv.append(c)
-			else:
-				rv.append(Command.split(c))
-		return rv
-	
-	
-	@staticmethod
-	def indented(*commands):
-		"""
-		Works as 'multiple', but calls 'indent' on each command to add indent
-		to entire group.
-		"""
-		return [ c.indent() for c in Command.multiple(*commands) ]
+		l = [ quote_arg(x) for x in self.args ]
+		if len(l) and "=" in l[0] and l[0] == self.args[0]:
+			# Would be read as variable assignment
+			l[0] = "'%s'" % (l[0],)
+		return " ".join(l)
 	
 	
 	@staticmethod
 	def split(s):
 		""" Parses arguments from string and returns new Command object """
-		return Command(*shlex.split(s))
+		return Command(*split_words(s))
 
 
-def ensure_list(v):
-	""" Returns v if v is list; returns [v] otherwise """
-	if type(v) == list: return v
-	return [v]
+class Diagnostic(namedtuple("Diagnostic", "level message")):
+	"""
+	Problem found while converting unit. 'level' is either WARNING, for
+	anything that was converted only partially, or ERROR, for unit that
+	could not be converted at all.
+	"""
+	__slots__ = ()
+	
+	def __unicode__(self):
+		return "%s: %s" % (self.level.capitalize(), self.message)
+	
+	def __str__(self):
+		return unicode(self).encode('utf-8')
+
+
+def split_instance(unit_name):
+	"""
+	Returns (template, instance) for instance of template unit, such as
+	('foo@.service', 'bar') for 'foo@bar.service', or (None, None) if
+	'unit_name' is not instance.
+	"""
+	if "@" not in unit_name or "." not in unit_name:
+		return None, None
+	base, suffix = unit_name.rsplit(".", 1)
+	prefix, instance = base.split("@", 1)
+	if not instance:
+		return None, None
+	return "%s@.%s" % (prefix, suffix), instance
+
+
+def is_template(unit_name):
+	""" Returns True for template unit name, such as 'foo@.service' """
+	return unit_name.split(".")[0].endswith("@")
+
+
+def rc_name(unit_name):
+	"""
+	Returns name of rc script generated from unit. Template 'foo@.service'
+	is converted into multiplexed script 'foo' and its instance
+	'foo@bar.service' is started as 'foo.bar'.
+	"""
+	template, instance = split_instance(unit_name)
+	if template is not None:
+		return "%s.%s" % (template.split("@", 1)[0], instance)
+	return unit_name.split(".")[0].split("@", 1)[0]
+
+
+def in_root(root, path):
+	"""
+	Returns absolute 'path' as seen from inside of 'root' directory, or
+	path as it is if 'root' is None.
+	"""
+	if root is None:
+		return path
+	return os.path.join(root, path.lstrip("/"))
+
+
+def write_if_changed(filename, data, mode):
+	"""
+	Writes data (byte string) into file with given permissions, unless file
+	already has exactly same content and permissions. Returns True if file
+	was written.
+	
+	Data is written into temporary file in same directory, which is synced
+	and renamed over original file, so it's never left half-written.
+	"""
+	try:
+		st = os.stat(filename)
+		if st.st_size == len(data) and stat.S_IMODE(st.st_mode) == mode:
+			with open(filename, "rb") as f:
+				if f.read() == data:
+					return False
+	except (IOError, OSError):
+		# Doesn't exist or cannot be read; try to write it anyway
+		pass
+	
+	d, name = os.path.split(filename)
+	fd, tmp = tempfile.mkstemp(prefix="." + name + ".", dir=d or ".")
+	try:
+		f = os.fdopen(fd, "wb")
+		try:
+			f.write(data)
+			f.flush()
+			os.fsync(fd)
+			os.fchmod(fd, mode)
+		finally:
+			f.close()
+		os.rename(tmp, filename)
+	except:
+		os.unlink(tmp)
+		raise
+	return True
+
+
+TIMESPAN_UNITS = {
+	'us' : 0.000001, 'usec' : 0.000001,
+	'ms' : 0.001, 'msec' : 0.001,
+	'' : 1, 's' : 1, 'sec' : 1, 'second' : 1, 'seconds' : 1,
+	'm' : 60, 'min' : 60, 'minute' : 60, 'minutes' : 60,
+	'h' : 3600, 'hr' : 3600, 'hour' : 3600, 'hours' : 3600,
+	'd' : 86400, 'day' : 86400, 'days' : 86400,
+	'w' : 604800, 'week' : 604800, 'weeks' : 604800,
+}
+TIMESPAN_RE = re.compile(r'\s*([0-9]+(?:\.[0-9]*)?)\s*([a-z]*)')
+
+def parse_timespan(v):
+	"""
+	Parses systemd time span, such as '90', '5s' or '1min 30s', and
+	returns number of seconds. Returns None for 'infinity'.
+	Throws ValueError if value cannot be parsed.
+	"""
+	v = v.strip()
+	if v == "infinity":
+		return None
+	total, pos = 0.0, 0
+	while pos < len(v):
+		m = TIMESPAN_RE.match(v, pos)
+		if not m or m.group(2) not in TIMESPAN_UNITS:
+			raise ValueError("Invalid time span: %s" % (v,))
+		total += float(m.group(1)) * TIMESPAN_UNITS[m.group(2)]
+		pos = m.end()
+		while pos < len(v) and v[pos].isspace(): pos += 1
+	if not v:
+		raise ValueError("Invalid time span: %s" % (v,))
+	return total
+
+
+SIZE_UNITS = {
+	'' : 1, 'B' : 1,
+	'K' : 1024, 'M' : 1024 ** 2, 'G' : 1024 ** 3,
+	'T' : 1024 ** 4, 'P' : 1024 ** 5, 'E' : 1024 ** 6,
+}
+SIZE_RE = re.compile(r'^([0-9]+(?:\.[0-9]*)?)\s*([A-Z]?)$')
+
+def parse_size(v):
+	"""
+	Parses systemd size, such as '4096', '512K' or '1.5G', and returns
+	number of bytes. Suffixes are powers of 1024. Returns None for
+	'infinity'.
+	Throws ValueError if value cannot be parsed.
+	"""
+	v = v.strip()
+	if v == "infinity":
+		return None
+	m = SIZE_RE.match(v)
+	if not m or m.group(2) not in SIZE_UNITS:
+		raise ValueError("Invalid size: %s" % (v,))
+	if "." in m.group(1):
+		return int(float(m.group(1)) * SIZE_UNITS[m.group(2)])
+	return int(m.group(1)) * SIZE_UNITS[m.group(2)]
@@ -0,0 +1,313 @@
+#!/usr/bin/env python2
+"""
+Unit2OpenRC - Analyze
+
+Builds dependency graph of all converted services and looks for cycles,
+dangling references and longest start-up chains.
+"""
+from __future__ import unicode_literals
+from consts import *
+import heapq
+
+# Kinds of dependencies, as used in depend() function of rc script
+DEPENDENCY_KINDS = ( 'need', 'want', 'after', 'before' )
+
+
+class DependencyGraph(object):
+	"""
+	Graph of dependencies between rc services.
+	
+	'depends' maps service name to dict of {kind: list of names}.
+	Ordering edge a->b means that a has to be started before b. Such edge
+	is created by 'b: need a', 'b: after a' and 'a: before b'.
+	"""
+	
+	def __init__(self):
+		self.depends = {}
+	
+	
+	def add(self, name, need=(), want=(), after=(), before=()):
+		""" Adds service with its dependencies """
+		self.depends[name] = dict(need=list(need), want=list(want),
+			after=list(after), before=list(before))
+	
+	
+	def add_rcfile(self, rc):
+		""" Adds service from RCFile instance """
+		self.add(rc.shortname, rc.need, rc.want, rc.after, rc.before)
+	
+	
+	def edges(self):
+		"""
+		Returns sorted list of (a, b, kind) ordering edges, where 'a' has to
+		be started before 'b' and 'kind' is dependency that caused it.
+		"""
+		rv = set()
+		for name, d in self.depends.iteritems():
+			for kind in ('need', 'after'):
+				for x in d[kind]:
+					rv.add(( x, name, kind ))
+			for x in d['before']:
+				rv.add(( name, x, 'before' ))
+		return sorted(rv)
+	
+	
+	def successors(self):
+		""" Returns dict of {name: sorted list of names started after it} """
+		rv = {}
+		for a, b, kind in self.edges():
+			rv.setdefault(a, set()).add(b)
+			rv.setdefault(b, set())
+		for name in self.depends:
+			rv.setdefault(name, set())
+		return { k : sorted(v) for (k, v) in rv.iteritems() }
+	
+	
+	def dangling(self, known=()):
+		"""
+		Returns sorted list of (name, kind, target) for every dependency on
+		service that is not in graph and not in 'known' list.
+		"""
+		rv = []
+		for name in sorted(self.depends):
+			for kind in DEPENDENCY_KINDS:
+				for x in self.depends[name][kind]:
+					if x not in self.depends and x not in known:
+						rv.append(( name, kind, x ))
+		return rv
+	
+	
+	def cycles(self):
+		"""
+		Returns list of dependency cycles, each as sorted list of services.
+		Uses (iterative) Tarjan's algorithm to find strongly connected
+		components.
+		"""
+		succ = self.successors()
+		index, lowlink, on_stack = {}, {}, set()
+		stack, rv = [], []
+		counter = 0
+		for root in sorted(succ):
+			if root in index: continue
+			work = [ (root, 0) ]
+			while work:
+				node, i = work.pop()
+				if i == 0:
+					index[node] = lowlink[node] = counter
+					counter += 1
+					stack.append(node)
+					on_stack.add(node)
+				recurse = False
+				for j in xrange(i, len(succ[node])):
+					s = succ[node][j]
+					if s not in index:
+						work.append(( node, j + 1 ))
+						work.append(( s, 0 ))
+						recurse = True
+						break
+					elif s in on_stack:
+						lowlink[node] = min(lowlink[node], index[s])
+				if recurse: continue
+				if lowlink[node] == index[node]:
+					component = []
+					while True:
+						x = stack.pop()
+						on_stack.discard(x)
+						component.append(x)
+						if x == node: break
+					if len(component) > 1 or node in succ[node]:
+						rv.append(sorted(component))
+				if work:
+					parent = work[-1][0]
+					lowlink[parent] = min(lowlink[parent], lowlink[node])
+		return sorted(rv)
+	
+	
+	def cycle_path(self, component):
+		"""
+		Returns shortest cycle through first service of 'component' (one of
+		lists returned by cycles()) as list of services that starts and
+		ends with that service, following actual ordering edges.
+		"""
+		succ = self.successors()
+		members = set(component)
+		start = component[0]
+		# Breadth-first search from start back to itself
+		parent = {}
+		queue = [ start ]
+		for node in queue:
+			for s in succ[node]:
+				if s == start:
+					path = [ start ]
+					while node != start:
+						path.append(node)
+						node = parent[node]
+					path.append(start)
+					return list(reversed(path))
+				if s in members and s not in parent:
+					parent[s] = node
+					queue.append(s)
+		return [ start ]
+	
+	
+	def critical_chains(self, estimates={}, default=1.0, count=5):
+		"""
+		Computes, for every service, longest chain of services that has to
+		be started before it. Length of chain is sum of start-up time
+		estimates of services in it, 'default' is used for services
+		converted by unit2openrc without estimate and 0 for everything else.
+		Edges that are part of cycle are ignored.
+		
+		Returns list of up to 'count' longest chains, longest first, each
+		as (length, [ (name, started_at, duration), ... ]) tuple, where
+		chain is ordered from last to first service.
+		"""
+		succ = self.successors()
+		in_cycle = {}
+		for i, c in enumerate(self.cycles()):
+			for x in c: in_cycle[x] = i
+		def weight(x):
+			if x in estimates: return estimates[x]
+			return default if x in self.depends else 0.0
+		
+		# Kahn's algorithm, processing nodes in sorted order
+		preds = { x : [] for x in succ }
+		dag_succ = { x : [] for x in succ }
+		for a in sorted(succ):
+			for b in succ[a]:
+				if a in in_cycle and in_cycle[a] == in_cycle.get(b):
+					continue
+				preds[b].append(a)
+				dag_succ[a].append(b)
+		pending = { x : len(preds[x]) for x in succ }
+		ready = sorted([ x for x in pending if pending[x] == 0 ])
+		finish, best_pred = {}, {}
+		while ready:
+			x = heapq.heappop(ready)
+			for p in preds[x]:
+				if x not in best_pred or finish[p] > finish[best_pred[x]]:
+					best_pred[x] = p
+			start = finish[best_pred[x]] if x in best_pred else 0.0
+			finish[x] = start + weight(x)
+			for s in dag_succ[x]:
+				pending[s] -= 1
+				if pending[s] == 0:
+					heapq.heappush(ready, s)
+		
+		rv = []
+		ends = sorted(finish, key=lambda x: (-finish[x], x))
+		for end in ends[0:count]:
+			chain, x = [], end
+			while x is not None:
+				start = finish[best_pred[x]] if x in best_pred else 0.0
+				chain.append(( x, start, finish[x] - start ))
+				x = best_pred.get(x)
+			rv.append(( finish[end], chain ))
+		return rv
+	
+	
+	def reduce(self):
+		"""
+		Removes 'after' and 'before' dependencies that are implied by other
+		dependencies (transitive reduction of ordering edges). 'need' and
+		'want' dependencies are never removed.
+		
+		Edge a->b is removed if 'a' is already started before 'b' through
+		path of other edges that goes only through services that are pulled
+		in by 'b' (by need or want, transitively). Ordering through service
+		that may not be started at all is not considered. Edges that are
+		part of cycle are kept.
+		
+		Returns number of removed dependencies.
+		"""
+		succ = self.successors()
+		pred = { x : set() for x in succ }
+		for a in succ:
+			for b in succ[a]:
+				pred[b].add(a)
+		in_cycle = set()
+		for c in self.cycles():
+			in_cycle.update(c)
+		
+		redundant = set()		# (a, b) edges that can be removed
+		for b in sorted(self.depends):
+			if b in in_cycle: continue
+			d = self.depends[b]
+			# Services that are started when 'b' is
+			pulled, todo = set(), d['need'] + d['want']
+			while todo:
+				x = todo.pop()
+				if x in pulled or x == b: continue
+				pulled.add(x)
+				if x in self.depends:
+					todo += self.depends[x]['need'] + self.depends[x]['want']
+			# Pulled services that are started before 'b'
+			reaching, todo = set(), [ x for x in pred[b] if x in pulled ]
+			while todo:
+				x = todo.pop()
+				if x in reaching: continue
+				reaching.add(x)
+				todo += [ y for y in pred[x] if y in pulled ]
+			for a in pred[b]:
+				if any([ x in reaching and x != a and x != b for x in succ[a] ]):
+					redundant.add(( a, b ))
+		
+		removed = 0
+		for b in sorted(self.depends):
+			d = self.depends[b]
+			# 'after' on same service as 'need' says nothing new
+			keep = [ a for a in d['after']
+				if a not in d['need'] and (a, b) not in redundant ]
+			removed += len(d['after']) - len(keep)
+			d['after'] = keep
+		for a in sorted(self.depends):
+			d = self.depends[a]
+			# 'before' is dropped also if other side already has 'after'
+			keep = [ b for b in d['before'] if (a, b) not in redundant
+				and not (b in self.depends and (a in self.depends[b]['after']
+					or a in self.depends[b]['need'])) ]
+			removed += len(d['before']) - len(keep)
+			d['before'] = keep
+		return removed
+	
+	
+	def report(self, estimates={}, count=5, known=()):
+		""" Returns human-readable report about cycles, dangling references and critical chains """
+		lines = []
+		lines.append("Services: %s, ordering edges: %s" % (len(self.depends), len(self.edges())))
+		cycles = self.cycles()
+		lines.append("")
+		lines.append("Cycles: %s" % (len(cycles),))
+		for c in cycles:
+			path = self.cycle_path(c)
+			if len(path) - 1 < len(c):
+				lines.append("  %s (cycle among: %s)" % (" -> ".join(path), ", ".join(c)))
+			else:
+				lines.append("  " + " -> ".join(path))
+		dangling = self.dangling(known)
+		lines.append("")
+		lines.append("Dangling references: %s" % (len(dangling),))
+		for name, kind, target in dangling:
+			lines.append("  %s: %s %s" % (name, kind, target))
+		lines.append("")
+		lines.append("Critical chains:")
+		for length, chain in self.critical_chains(estimates, count=count):
+			lines.append("")
+			for i, (name, start, duration) in enumerate(chain):
+				prefix = "  " if i == 0 else "  " + " " * (i - 1) + "`-"
+				lines.append("%s%s @%.3fs +%.3fs" % (prefix, name, start, duration))
+		return "\n".join(lines)
+
+
+def load_estimates(fileobj):
+	"""
+	Loads start-up time estimates from file with 'service seconds' on
+	every line. Empty lines and lines starting with '#' are ignored.
+	"""
+	rv = {}
+	for line in fileobj:
+		line = line.strip()
+		if not line or line.startswith("#"): continue
+		name, seconds = line.split()
+		rv[name] = float(seconds)
+	return rv
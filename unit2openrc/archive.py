@@ -0,0 +1,323 @@
+#!/usr/bin/env python2
+"""
+Unit2OpenRC - Archive
+
+Reads units from tar stream of system image and writes generated scripts
+as tar stream, so image never has to be unpacked.
+"""
+from __future__ import unicode_literals
+from unitindex import UnitIndex
+from batch import convert_units
+from stats import NULL_STATS
+from . import rc_name, is_template
+from consts import *
+import sys, os, io, errno, gzip, tarfile, threading, subprocess
+
+# Magic number of zstd frame. tarfile itself recognizes gzip and bzip2
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+COPY_BLOCK = 65536
+
+
+class ArchiveIndex(UnitIndex):
+	"""
+	UnitIndex of units read from tar stream of system image. Only files
+	in unit directories are kept in memory; everything else is skipped
+	over as it streams by. Symlinks are resolved same way as in image.
+	"""
+	
+	def __init__(self, fileobj, unit_dirs=UNIT_DIRS, init_d=INIT_D):
+		# data maps path to file contents, targets maps path to symlink
+		# target and entries maps directory to dict of {name: kind}
+		self.data, self.targets, self.entries = {}, {}, {}
+		# Names of files already present in init_d
+		self.scripts = set()
+		init_d = init_d.rstrip("/")
+		prefixes = tuple([ d.rstrip("/") + "/" for d in unit_dirs ])
+		tar = open_archive(fileobj)
+		try:
+			self._read(tar, prefixes, init_d)
+		except (tarfile.TarError, EOFError), e:
+			raise IOError("Failed to read archive: %s" % (e,))
+		finally:
+			tar.close()
+		UnitIndex.__init__(self, unit_dirs)
+	
+	
+	def _read(self, tar, prefixes, init_d):
+		""" Reads what's needed from archive members """
+		for member in tar:
+			path = _member_path(member.name)
+			if os.path.dirname(path) == init_d:
+				self.scripts.add(os.path.basename(path))
+			if member.issym():
+				# Symlinks anywhere may be needed to resolve path to unit
+				self.targets[path] = _decode(member.linkname)
+				self.data.pop(path, None)
+				if path.startswith(prefixes):
+					self._add_entry(path, "link")
+				continue
+			if not path.startswith(prefixes):
+				continue
+			self.targets.pop(path, None)
+			if member.isdir():
+				self.entries.setdefault(path, {})
+				self._add_entry(path, "dir")
+			elif member.isfile():
+				self.data[path] = tar.extractfile(member).read()
+				self._add_entry(path, "file")
+			elif member.islnk():
+				# Hardlink to file that came earlier in archive
+				target = _member_path(member.linkname)
+				if target in self.data:
+					self.data[path] = self.data[target]
+					self._add_entry(path, "file")
+			else:
+				self._add_entry(path, "other")
+	
+	
+	def _add_entry(self, path, kind):
+		"""
+		Adds path into listing of its directory. Archive doesn't have to
+		contain entries for directories, so parents are added as well.
+		"""
+		parent, name = os.path.split(path)
+		self.entries.setdefault(parent, {})[name] = kind
+		while parent != "/":
+			parent, name = os.path.split(parent)
+			listing = self.entries.setdefault(parent, {})
+			if name in listing:
+				break
+			listing[name] = "dir"
+	
+	
+	def list_dir(self, d, suffixes=None):
+		for name, kind in self.entries.get(d, {}).items():
+			if suffixes is None or name.endswith(suffixes):
+				yield name, os.path.join(d, name), kind
+	
+	
+	def list_names(self, d):
+		return list(self.entries.get(d, {}))
+	
+	
+	def readlink(self, path):
+		return self.targets[path]
+	
+	
+	def follow(self, path):
+		"""
+		Resolves symlinks in every component of path, as in image.
+		"""
+		for i in xrange(self.MAX_SYMLINKS):
+			parts = path.strip("/").split("/")
+			for j in xrange(len(parts), 0, -1):
+				prefix = "/" + "/".join(parts[0:j])
+				if prefix in self.targets:
+					target = os.path.join(os.path.dirname(prefix), self.targets[prefix])
+					path = os.path.normpath("/".join([ target ] + parts[j:]))
+					break
+			else:
+				return path
+		return path
+	
+	
+	def is_file(self, path):
+		return path in self.data
+	
+	
+	def is_dir(self, path):
+		return path in self.entries
+	
+	
+	def is_mask(self, path):
+		return self.follow(path) == self.MASK_TARGET
+	
+	
+	def read(self, path):
+		try:
+			return self.data[self.follow(path)]
+		except KeyError:
+			raise IOError(errno.ENOENT, "%s: %s" % (os.strerror(errno.ENOENT), path))
+
+
+def open_archive(fileobj):
+	"""
+	Opens tar stream for reading. Stream may be compressed by gzip, bzip2
+	or zstd; zstd is decompressed by external zstd executable.
+	Throws IOError if archive cannot be read.
+	"""
+	head = fileobj.read(len(ZSTD_MAGIC))
+	stream = _Prefixed(head, fileobj)
+	if head == ZSTD_MAGIC:
+		stream = _decompress([ ZSTD, "-d", "-c", "-q" ], stream)
+	try:
+		return tarfile.open(fileobj=stream, mode="r|*")
+	except tarfile.TarError, e:
+		raise IOError("Failed to read archive: %s" % (e,))
+
+
+def _decode(name):
+	""" Returns member name from tarfile as unicode string """
+	if type(name) != unicode:
+		return name.decode('utf-8', 'replace')
+	return name
+
+
+def _member_path(name):
+	""" Returns absolute path of archive member """
+	return os.path.normpath("/" + _decode(name))
+
+
+class _Prefixed(object):
+	""" File-like object that returns already read data before rest of file """
+	
+	def __init__(self, head, fileobj):
+		self.head = head
+		self.fileobj = fileobj
+	
+	
+	def read(self, size=-1):
+		if not self.head:
+			return self.fileobj.read(size)
+		if size < 0:
+			data, self.head = self.head + self.fileobj.read(), b""
+		else:
+			data, self.head = self.head[0:size], self.head[size:]
+			if len(data) < size:
+				data += self.fileobj.read(size - len(data))
+		return data
+
+
+def _decompress(command, stream):
+	"""
+	Returns output of decompressing command, which is fed by 'stream' from
+	another thread, so neither side has to be read whole.
+	"""
+	try:
+		p = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+	except OSError, e:
+		raise IOError("Failed to execute %s: %s" % (command[0], e))
+	def feed():
+		try:
+			while True:
+				data = stream.read(COPY_BLOCK)
+				if not data:
+					break
+				p.stdin.write(data)
+		except IOError:
+			# Decompressor exited early; reported when its output ends
+			pass
+		finally:
+			p.stdin.close()
+	t = threading.Thread(target=feed)
+	t.daemon = True
+	t.start()
+	return p.stdout
+
+
+def archive_writer(fileobj, name=None, mtime=0):
+	"""
+	Opens tar stream for writing. If 'name' ends with .gz, .tgz or .bz2,
+	stream is compressed accordingly. Returns (tar, stream) tuple, where
+	'stream' is what tar writes into; both have to be closed, tar first.
+	
+	tarfile would store current time in gzip header, so gzip stream is
+	created here with 'mtime' instead. bzip2 has no timestamp.
+	"""
+	mode, stream = "w|", fileobj
+	if name is not None:
+		if name.endswith((".gz", ".tgz")):
+			stream = gzip.GzipFile(filename="", mode="wb", fileobj=fileobj, mtime=mtime)
+		elif name.endswith(".bz2"):
+			mode = "w|bz2"
+	return tarfile.open(fileobj=stream, mode=mode, format=tarfile.PAX_FORMAT), stream
+
+
+def convert_to_archive(index, services, tar, init_d=INIT_D, exists=None,
+			options={}, instances={}, mtime=0, stats=NULL_STATS):
+	"""
+	Converts services (list of names) found in index (UnitIndex) and adds
+	generated scripts into 'tar' (writable TarFile) under init_d, along
+	with symlinks for instances of templates. 'exists' is function that
+	returns True if file with given name already exists in init_d; such
+	scripts are skipped, same as in auto mode without manifest.
+	
+	'options' and 'instances' are same as for convert_all, 'mtime' is
+	modification time of added files. All messages are printed to stderr,
+	as stdout may be used for archive itself.
+	"""
+	prefix = init_d.strip("/")
+	_add_member(tar, prefix, tarfile.DIRTYPE, mtime)
+	for service in services:
+		name = rc_name(service)
+		if exists is not None and exists(name):
+			print >>sys.stderr, "Skipped %s: File exists" % (service,)
+			stats.skip("file exists")
+			continue
+		try:
+			with stats.stage("parse"):
+				items = _items(index, service)
+		except IOError, e:
+			print >>sys.stderr, "Skipped %s: Failed to read unit file: %s" % (service, e)
+			stats.count("failed")
+			continue
+		with stats.stage("convert"):
+			[ ( name, script, diagnostics ) ] = convert_units(items, options)
+		for d in diagnostics:
+			if d.level == WARNING:
+				print >>sys.stderr, "%s: %s" % (service, d)
+		if script is None:
+			print >>sys.stderr, "Skipped %s: %s" % (service,
+				"; ".join([ d.message for d in diagnostics if d.level == ERROR ]))
+			stats.count("failed")
+			continue
+		with stats.stage("write"):
+			_add_member(tar, "%s/%s" % (prefix, name), tarfile.REGTYPE, mtime, data=script)
+		stats.count("converted")
+		stats.count("bytes_written", len(script))
+		print >>sys.stderr, "Converted %s" % (name,)
+		if is_template(service):
+			for instance in sorted(set(index.instances(service)) | set(instances.get(service, ()))):
+				link = "%s.%s" % (name, instance)
+				if exists is not None and exists(link):
+					print >>sys.stderr, "Skipped %s: File exists" % (link,)
+					stats.skip("file exists")
+					continue
+				_add_member(tar, "%s/%s" % (prefix, link), tarfile.SYMTYPE, mtime,
+					linkname=name)
+				stats.count("linked")
+				print >>sys.stderr, "Linked %s" % (link,)
+
+
+def _items(index, service):
+	"""
+	Returns list of items for convert_units with service and socket unit
+	activating it, if any. Throws IOError if any file cannot be read.
+	"""
+	items = []
+	socket = index.socket(service)
+	if socket is not None:
+		socket_name = service[0:-len(".service")] + ".socket"
+		items.append(( socket_name, index.read(socket),
+			[ index.read(x) for x in index.dropins(socket_name) ] ))
+	items.append(( service, index.read(index.units[service]),
+		[ index.read(x) for x in index.dropins(service) ], index.units[service] ))
+	return items
+
+
+def _add_member(tar, name, type, mtime, data=None, linkname=None):
+	""" Adds file, directory or symlink owned by root into archive """
+	info = tarfile.TarInfo(name.encode('utf-8'))
+	info.type = type
+	info.mtime = mtime
+	info.uid, info.gid, info.uname, info.gname = 0, 0, b"root", b"root"
+	if type == tarfile.SYMTYPE:
+		info.mode = 0777
+		info.linkname = linkname.encode('utf-8')
+	else:
+		info.mode = 0755
+	if data is not None:
+		info.size = len(data)
+		tar.addfile(info, io.BytesIO(data))
+	else:
+		tar.addfile(info)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python2
+"""
+Unit2OpenRC - Batch
+
+Converts units held in memory, without touching filesystem, so conversion
+can be used as part of generator pipeline.
+"""
+from __future__ import unicode_literals
+from unitfile import UnitFile, SocketUnitFile, UnitFileParser
+from rcfile import RCFile
+from convert import convert
+from . import Diagnostic, rc_name, is_template
+from consts import *
+
+
+def convert_units(units, options={}):
+	"""
+	Converts units from iterable of (name, source), (name, source,
+	dropins) or (name, source, dropins, path) tuples, where 'source' and
+	every item of 'dropins' list is byte string, unicode string or
+	file-like object with unit file contents and 'path' is path of unit
+	file named in header of generated script, unit name by default.
+	'options' are passed to convert function as keyword arguments.
+	
+	Lazily yields (rc_name, script, diagnostics) tuple for every service,
+	where 'script' is rendered rc script as byte string, or None if unit
+	could not be converted, and 'diagnostics' is list of Diagnostic
+	instances.
+	
+	Socket units are not converted, but remembered and used to activate
+	service with same name that comes later. Other units are skipped.
+	
+	Template, such as 'foo@.service', is converted into multiplexed script
+	'foo'; creating 'foo.instance' symlinks to it is left to caller.
+	"""
+	sockets = {}
+	for item in units:
+		name, source = item[0], item[1]
+		dropins = item[2] if len(item) > 2 else ()
+		path = item[3] if len(item) > 3 else None
+		base, unit_type = name.rsplit(".", 1) if "." in name else (name, "service")
+		if unit_type == "socket":
+			try:
+				sockets[base] = SocketUnitFile(layers=_layers(source, dropins))
+			except (IOError, ValueError), e:
+				sockets[base] = Diagnostic(WARNING, "Invalid socket unit: %s" % (e,))
+		elif unit_type == "service":
+			yield convert_unit(name, source, dropins, sockets.pop(base, None), options, path)
+
+
+def convert_unit(name, source, dropins=(), socket=None, options={}, path=None):
+	"""
+	Converts single service. 'source', 'dropins' and 'path' are same as
+	for convert_units, 'socket' is SocketUnitFile activating service, or
+	None.
+	Returns (rc_name, script, diagnostics) tuple.
+	"""
+	short_name = rc_name(name)
+	diagnostics = []
+	if isinstance(socket, Diagnostic):
+		diagnostics.append(socket)
+		socket = None
+	try:
+		unit = UnitFile(layers=_layers(source, dropins))
+		rc = RCFile(short_name, template=is_template(name))
+		convert(unit, rc, socket=socket, **options)
+	except (IOError, ValueError), e:
+		diagnostics.append(Diagnostic(ERROR, "%s" % (e,)))
+		return short_name, None, diagnostics
+	diagnostics += rc.diagnostics
+	return short_name, rc.render(path or name), diagnostics
+
+
+def _layers(source, dropins):
+	""" Returns list of parsed layers for UnitFile """
+	return [ UnitFileParser().parse(_lines(x)) for x in [ source ] + list(dropins) ]
+
+
+def _lines(source):
+	""" Returns something that yields lines of unit file """
+	if isinstance(source, basestring):
+		return source.splitlines(True)
+	return source
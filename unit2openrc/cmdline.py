@@ -0,0 +1,162 @@
+#!/usr/bin/env python2
+"""
+Unit2OpenRC - Command Lines
+
+Splits Exec* options and other lists of words using same quoting rules as
+systemd, in single pass over value.
+"""
+from __future__ import unicode_literals
+import re
+
+# Prefixes of Exec* options, see systemd.service(5)
+EXEC_PREFIXES = "-@:+!"
+# Characters that make value more than list of whitespace-separated words
+SPECIAL_RE = re.compile(r'[\'"\\%$]')
+# C-style escapes supported by systemd, except for numeric ones
+ESCAPES = {
+	'a' : '\a', 'b' : '\b', 'f' : '\f', 'n' : '\n', 'r' : '\r', 't' : '\t',
+	'v' : '\v', '\\' : '\\', '"' : '"', "'" : "'", 's' : ' ',
+}
+# Numeric escapes, as (regex matching digits, base)
+NUMERIC_ESCAPES = {
+	'x' : ( re.compile(r'[0-9a-fA-F]{2}'), 16 ),
+	'u' : ( re.compile(r'[0-9a-fA-F]{4}'), 16 ),
+	'U' : ( re.compile(r'[0-9a-fA-F]{8}'), 16 ),
+}
+OCTAL_ESCAPE_RE = re.compile(r'[0-7]{3}')
+
+# Cache of already split values. Same dependency lists and commands are
+# usually repeated by many units.
+_words = {}
+_commands = {}
+
+
+def split_words(value):
+	"""
+	Splits value into tuple of words, removing quotes and resolving
+	escape sequences. '$' and '%' are kept as they are.
+	Throws ValueError if quotes are not balanced.
+	"""
+	try:
+		return _words[value]
+	except KeyError:
+		pass
+	if SPECIAL_RE.search(value):
+		rv = _split(value, None, None, False)
+	else:
+		rv = tuple(value.split())
+	_words[value] = rv
+	return rv
+
+
+def split_command(value, specifiers=None, used=None):
+	"""
+	Splits Exec* option into (prefixes, words) tuple, where 'prefixes' is
+	string with all prefixes found in front of command, such as '-' or
+	'@'. Throws ValueError if quotes are not balanced or if there is no
+	command.
+	
+	If 'specifiers' dict is provided, specifiers such as %n are replaced
+	by its values and added to 'used' set; unknown specifiers are kept.
+	
+	In words, '${NAME}' and '$NAME' as word of its own are references to
+	environment variables and '$$' is '$' character, as in systemd. With
+	':' prefix, environment variables are not expanded, so every '$' is
+	doubled.
+	"""
+	cacheable = "%" not in value
+	if cacheable:
+		try:
+			return _commands[value]
+		except KeyError:
+			pass
+	value = value.lstrip()
+	i = 0
+	while i < len(value) and value[i] in EXEC_PREFIXES:
+		i += 1
+	prefixes, words = value[0:i], value[i:]
+	if SPECIAL_RE.search(words):
+		words = _split(words, specifiers, used, ":" in prefixes)
+	else:
+		words = tuple(words.split())
+	if not words:
+		raise ValueError("Empty command line: %s" % (value,))
+	rv = prefixes, words
+	if cacheable:
+		_commands[value] = rv
+	return rv
+
+
+def _split(value, specifiers, used, escape_dollar):
+	"""
+	Does actual splitting for split_words and split_command.
+	Quotes may appear anywhere in word and escape sequences are resolved
+	both inside and outside of quotes.
+	"""
+	words, word, quote, in_word = [], [], None, False
+	i, length = 0, len(value)
+	while i < length:
+		c = value[i]
+		i += 1
+		if c == "\\":
+			if i >= length:
+				# Trailing backslash is kept
+				word.append(c)
+			else:
+				decoded, i = _escape(value, i)
+				word.append(decoded)
+			in_word = True
+		elif c == "%" and specifiers is not None and i < length:
+			s = value[i]
+			i += 1
+			if s in specifiers:
+				word.append(specifiers[s])
+				if used is not None:
+					used.add(s)
+			else:
+				word.append(c + s)
+			in_word = True
+		elif c == "$" and escape_dollar:
+			word.append("$$")
+			in_word = True
+		elif quote is not None:
+			if c == quote:
+				quote = None
+			else:
+				word.append(c)
+		elif c in "'\"":
+			quote = c
+			in_word = True
+		elif c.isspace():
+			if in_word:
+				words.append("".join(word))
+				word, in_word = [], False
+		else:
+			word.append(c)
+			in_word = True
+	if quote is not None:
+		raise ValueError("Unbalanced quoting: %s" % (value,))
+	if in_word:
+		words.append("".join(word))
+	return tuple(words)
+
+
+def _escape(value, i):
+	"""
+	Decodes escape sequence starting at value[i], right after backslash.
+	Returns (decoded string, index after sequence). Unknown sequence is
+	kept as it is.
+	"""
+	c = value[i]
+	if c in ESCAPES:
+		return ESCAPES[c], i + 1
+	if c in NUMERIC_ESCAPES:
+		regex, base = NUMERIC_ESCAPES[c]
+		m = regex.match(value, i + 1)
+		if m:
+			return unichr(int(m.group(0), base)), m.end()
+	else:
+		m = OCTAL_ESCAPE_RE.match(value, i)
+		if m:
+			return unichr(int(m.group(0), 8)), m.end()
+	return "\\" + c, i + 1
@@ -6,8 +6,11 @@ Mainly paths to where input and outuput files are located.
 """
 from __future__ import unicode_literals
 
+VERSION = "0.1"
+
 # Paths
 INIT_D = "/etc/init.d"
+MANIFEST = "/var/lib/unit2openrc/manifest.json"	# Remembers what was converted by unit2openrc -a
 RUN_D = "/run"
 DAEMON_DIR = "/usr/bin"		# Directory where daemon executables are stored (currently not used in any meaningfull way)
 UNIT_DIRS = [
@@ -23,7 +26,7 @@ ALLOW_DBUS = True			# If set to True, it is possible to convert 'dbus' service t
 AUTO_IGNORED = [
 	# In auto-generate mode (unit2openrc -a), services with names containing
 	# any string from this list are ignored
-	'@', 'systemd-', 'dbus-org', 'plymouth',
+	'systemd-', 'dbus-org', 'plymouth',
 ]
 AUTO_IGNORED_EXACT = [
 	# In auto-generate mode (unit2openrc -a), services with these exact
@@ -50,22 +53,87 @@ AUTO_IGNORED_EXACT = [
 # Executables and rc file commands
 START_STOP_DAEMON = "start-stop-daemon"
 DBUS_SERVICE_WAIT = "dbus-service-wait"
+NOTIFY_SERVICE_WAIT = "notify-service-wait"
+SOCKET_ACTIVATE = "socket-activate"
+SUPERVISE_DAEMON = "supervise-daemon"
+ZSTD = "zstd"			# Used to decompress zstd compressed archives
+RC_SVCNAME_REF = "${RC_SVCNAME}"	# Name of service, as set by openrc-run
+INSTANCE_VAR = "UNIT_INSTANCE"		# Variables set in script generated from template unit
+INSTANCE_UNESCAPED_VAR = "UNIT_INSTANCE_UNESCAPED"
 EBEGIN = "ebegin"
 EEND = "eend"
 BEFORE = "before"
 AFTER = "after"
 
 # Messages
+WARNING = "warning"		# Levels of Diagnostic
+ERROR = "error"
 STARTING = "Starting %s '%s'"
 STOPPING = "Stopping %s '%s'"
+RELOADING = "Reloading %s '%s'"
+TEMPLATE_NOT_STARTED = "%s is template, start %s.<instance> instead"
 
 # Service types (shared by UnitFile *and* RCFile, but RCFile uses only SIMPLE and FORKING types)
 ST_SIMPLE	= 'simple'
 ST_FORKING	= 'forking'
 ST_ONESHOT	= 'oneshot'
 ST_DBUS		= 'dbus'
-SYSTEMD_SERVICE_TYPES = ( ST_SIMPLE, ST_FORKING, ST_ONESHOT, ST_DBUS )
-RC_SERVICE_TYPES = ( ST_SIMPLE, ST_FORKING, ST_DBUS )
+ST_NOTIFY	= 'notify'
+SYSTEMD_SERVICE_TYPES = ( ST_SIMPLE, ST_FORKING, ST_ONESHOT, ST_DBUS, ST_NOTIFY )
+RC_SERVICE_TYPES = ( ST_SIMPLE, ST_FORKING, ST_DBUS, ST_NOTIFY )
+
+# Socket unit options supported by socket-activate, mapped to its arguments
+SOCKET_LISTEN_OPTIONS = {
+	'listen_stream'				: '-s',
+	'listen_datagram'			: '-d',
+	'listen_sequential_packet'	: '-q',
+}
+SOCKET_LISTEN_UNSUPPORTED = ( 'listen_fifo', 'listen_special', 'listen_netlink',
+	'listen_message_queue', 'listen_usb_function' )
+
+# Resource control
+# Limit* directives mapped to rc_ulimit option and size of block used by
+# that option, in bytes. Only options that mean same in every /bin/sh
+# that openrc-run may use are listed; LimitCPU is in seconds.
+ULIMIT_OPTIONS = {
+	'limit_cpu'		: ( '-t', None ),
+	'limit_fsize'	: ( '-f', 512 ),
+	'limit_data'	: ( '-d', 1024 ),
+	'limit_stack'	: ( '-s', 1024 ),
+	'limit_core'	: ( '-c', 512 ),
+	'limit_rss'		: ( '-m', 1024 ),
+	'limit_nofile'	: ( '-n', 1 ),
+	'limit_as'		: ( '-v', 1024 ),
+	'limit_memlock'	: ( '-l', 1024 ),
+}
+# Memory* directives mapped to cgroup v2 settings
+CGROUP_MEMORY_SETTINGS = {
+	'memory_min'		: 'memory.min',
+	'memory_low'		: 'memory.low',
+	'memory_high'		: 'memory.high',
+	'memory_max'		: 'memory.max',
+	'memory_swap_max'	: 'memory.swap.max',
+}
+CPU_QUOTA_PERIOD = 100000	# Microseconds, used when CPUQuotaPeriodSec is not set
+# IOSchedulingClass values mapped to class number used by start-stop-daemon --ionice
+IO_SCHEDULING_CLASSES = {
+	'none' : 0, 'realtime' : 1, 'best-effort' : 2, 'idle' : 3,
+	'0' : 0, '1' : 1, '2' : 2, '3' : 3,
+}
+# CPUSchedulingPolicy values understood by start-stop-daemon --scheduler
+CPU_SCHEDULING_POLICIES = ( 'other', 'batch', 'idle', 'fifo', 'rr' )
+
+# Restart= values that make service supervised. supervise-daemon restarts
+# daemon whenever it exits, so these are only approximated
+RESTART_POLICIES = ( 'on-success', 'on-failure', 'on-abnormal',
+	'on-watchdog', 'on-abort', 'always' )
+DEFAULT_START_LIMIT_BURST = 5		# Same as systemd DefaultStartLimitBurst...
+DEFAULT_START_LIMIT_INTERVAL = 10	# ... and DefaultStartLimitIntervalSec, in seconds
+
+# Timeouts
+DEFAULT_TIMEOUT_START = 90	# Seconds, same as systemd DefaultTimeoutStartSec
+WATCH_DELAY = 0.5			# In watch mode, units are converted when nothing changes for this many seconds...
+WATCH_MAX_DELAY = 5			# ... or after this many seconds since first change
 
 UNIT_NAMES_DICT = {
 	"network.target"		: "net",
@@ -76,6 +144,15 @@ UNIT_NAMES_DICT = {
 	"dbus.socket"			: "dbus",
 }
 
+# Services provided by OpenRC itself. Dependencies on these are not
+# reported as dangling by unit2openrc --analyze
+RC_KNOWN_SERVICES = set(UNIT_NAMES_DICT.values()) | set((
+	"bootmisc", "devfs", "dmesg", "fsck", "hostname", "hwclock", "clock",
+	"killprocs", "localmount", "logger", "modules", "mount-ro", "net",
+	"netmount", "procfs", "root", "savecache", "swap", "sysctl", "sysfs",
+	"udev", "urandom",
+))
+
 # Header of generated rc file
 RC_HEADER = """#!/usr/bin/openrc-run
 # This file was auto-generated from %(source_file_name)s
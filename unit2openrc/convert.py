@@ -5,143 +5,654 @@ Unit2OpenRC - Conversion
 Evertything interesting happens here.
 """
 from __future__ import unicode_literals
-from unitfile import UnitFile
+from unitfile import UnitFile, SocketUnitFile, UnitFileParser, SCHEMA
 from rcfile import RCFile, Command, StartStopDaemon
-from . import ensure_list
+from cmdline import split_words, split_command
+from . import parse_timespan, parse_size, split_instance, is_template
 from consts import *
-import os, shlex
+import os, re, copy
 
+# Matches single CPU or range of CPUs in CPUAffinity and AllowedCPUs
+CPU_RANGE_RE = re.compile(r'^[0-9]+(-[0-9]+)?$')
+# Matches specifier, such as %i, in unit values
+SPECIFIER_RE = re.compile(r'%(.)')
+# Matches escaped character in unit name
+ESCAPE_RE = re.compile(r'\\x([0-9a-fA-F]{2})')
+# Specifiers in these options are resolved when command is split
+EXEC_OPTIONS = frozenset(( 'exec_start_pre', 'exec_start', 'exec_start_post',
+	'exec_stop_pre', 'exec_stop', 'exec_stop_post', 'exec_reload' ))
+# References to PID of main process, set by systemd for ExecReload
+MAINPID_REFS = ( "$MAINPID", "${MAINPID}" )
+# Signal name or number, without SIG prefix
+SIGNAL_RE = re.compile(r'^([A-Z]+[0-9]*|[0-9]+)$')
 
-def convert(source, target):
+
+def convert(source, target, declarative=False, socket=None, supervise=False,
+			sockets=None):
 	"""
 	Performs actuall conversion.
 	
 	Currently, 'source' has to be UnitFile and 'target' RCFile.
+	If 'declarative' is True and service allows it, generated script only
+	sets variables used by openrc-run instead of defining start() and
+	stop() functions.
+	If 'socket' (SocketUnitFile) is provided and service allows it,
+	generated script only listens on sockets and daemon is started when
+	first connection arrives.
+	If 'supervise' is True and service should be restarted when it exits,
+	daemon is started by supervise-daemon, which restarts it.
+	If 'sockets' dict of {socket name: service name}, as returned by
+	UnitIndex.socket_services, is provided, dependencies on socket units
+	are converted into dependencies on services they activate and
+	dependencies on sockets that don't activate anything are dropped.
 	"""
 	if isinstance(source, UnitFile) and isinstance(target, RCFile):
-		_unit2openrc(source, target)
+		if socket is not None and not isinstance(socket, SocketUnitFile):
+			raise TypeError("Unsupported socket unit")
+		_unit2openrc(source, target, declarative, socket, supervise, sockets)
 	else:
 		raise TypeError("Unsupported conversion")
 
 
-def _unit2openrc(unit, rc):
+def _unit2openrc(unit, rc, declarative=False, socket=None, supervise=False,
+			sockets=None):
 	"""
 	Copies and converts data from UnitFile instance into RCFile instance
 	"""
+	# Report what will be lost
+	_report_unknown(unit, rc, "unit")
+	if socket is not None:
+		_report_unknown(socket, rc, "socket unit")
+	
+	# Resolve specifiers
+	used = set()
+	unit = _resolve_specifiers(unit, rc, used)
+	if socket is not None:
+		socket = _resolve_specifiers(socket, rc, used)
+	if rc.template:
+		# Instance is part of service name after first dot
+		rc.variables.append(( INSTANCE_VAR, '"${RC_SVCNAME#*.}"' ))
+		if "I" in used:
+			rc.variables.append(( INSTANCE_UNESCAPED_VAR,
+				'"$(printf \'%%s\' "${%s}" | sed \'s|-|/|g\')"' % (INSTANCE_VAR,) ))
+	
 	# Convert basic stuff
 	rc.description = unit.description
-	if 'pidfile' in unit:
+	if unit.pidfile is not None:
 		rc.pidfile = unit.pidfile
 	# Convert environment
-	if 'environment' in unit:
-		for x in ensure_list(unit.environment):
-			for v in shlex.split(x):
-				if "=" in v:
-					k, v = v.split("=", 1)
-					rc.env[k] = v
-				else:
-					print >>sys.stderr, "Warning: Invalid environment var definition:", v
+	for x in unit.environment:
+		for v in split_words(x):
+			if "=" in v:
+				k, v = v.split("=", 1)
+				rc.env[k] = v
+			else:
+				rc.warn("Invalid environment var definition: %s" % (v,))
 	
 	# Convert deps
-	if 'requires' in unit:
-		rc.needs = _convert_requirements(unit.requires)
-	if 'wants' in unit:
-		rc.want = _convert_requirements(unit.wants)
-	if 'after' in unit:
-		rc.after = _convert_requirements(unit.after)
-	if 'before' in unit:
-		rc.before = _convert_requirements(unit.before)
+	rc.need = _convert_requirements(unit.requires, sockets, rc)
+	rc.want = _convert_requirements(unit.wants, sockets, rc)
+	rc.after = _convert_requirements(unit.after, sockets, rc)
+	rc.before = _convert_requirements(unit.before, sockets, rc)
 	if unit.type == ST_DBUS:
 		rc.need.append('dbus')
 		rc.want.append('dbus')
+	own_names = [ rc.shortname ]
+	if rc.template:
+		own_names.append("%s.${%s}" % (rc.shortname, INSTANCE_VAR))
+	for deps in (rc.need, rc.want, rc.after, rc.before):
+		# Service usually requires its own socket
+		for name in own_names:
+			if name in deps:
+				deps.remove(name)
 	
 	# Convert ExecStart, ExecStop, ExecStartPre and ExecStopPre options
-	rc.start, rc.stop = [], []
-	rc.start_pre, rc.stop_pre = [], []
 	rc.type = unit.type
 	if unit.type not in RC_SERVICE_TYPES:
 		raise ValueError("Unsupported service type: %s" % (unit.type,))
 	
-	# Convert 'start' command ExecStart and ExecStartPost, 2nd being optional
-	rc.start.append(Command(EBEGIN, STARTING % (rc.description, rc.shortname)))
-	rc.start.append(StartStopDaemon.start(Command.split(unit.exec_start),
-		rc.pidfile, forking = unit.type not in (ST_SIMPLE, ST_DBUS)))
-	if unit.type == ST_DBUS:
-		rc.start.extend(Command.multiple(
-			Command(DBUS_SERVICE_WAIT, unit.bus_name),
-			"if [ $? -ne 0 ] ; then",
-			Command.indented(
-				"# ensure service is killed if it fails to acquire dbus name",
-				Command("kill", '-9', '$(<', rc.pidfile, ')' ),
-				Command(EEND, '1' ),
-				"return 1"
-			),
-			"fi",
-			"true"
-		))
-	
-	if "exec_start_post" in unit:
-		rc.start.extend(_convert_exec_post(unit.exec_start_post))
+	if socket is not None:
+		problem = _activation_problem(unit, socket)
+		if problem is not None:
+			rc.warn("%s; %s will be started without socket activation" % (problem, rc.shortname))
+			socket = None
+	
+	# Convert Nice, Limit*, Memory* and similar options
+	_convert_resources(unit, rc)
+	
+	# Convert Restart option
+	restart = (unit.restart or "no") in RESTART_POLICIES
+	if supervise and restart:
+		problem = _supervise_problem(unit)
+		if problem is not None:
+			rc.warn("%s; %s will not be restarted" % (problem, rc.shortname))
+			supervise = False
+	elif restart:
+		rc.warn("Restart=%s is supported only with supervise-daemon; %s will not be restarted"
+			% (unit.restart, rc.shortname))
+	if unit.watchdog_sec not in (None, "0"):
+		rc.warn("WatchdogSec= is not supported; %s will not be restarted if it hangs"
+			% (rc.shortname,))
+	
+	if supervise and restart:
+		_convert_supervised(unit, rc, socket)
+	elif declarative and _can_be_declarative(unit):
+		_convert_declarative(unit, rc, socket)
 	else:
-		rc.start.append(Command(EEND, "$?"))
+		_convert_start_stop(unit, rc, socket)
 	
-	# ... 'stop' command, both ExecStop and ExecStopPost are optional
-	rc.stop.append(Command(EBEGIN, STOPPING % (rc.description, rc.shortname)))
-	if "exec_stop" in unit:
-		rc.stop.append(Command.split(unit.exec_stop))
-	if unit.type == ST_SIMPLE or "exec_stop" not in unit:
-		rc.stop.append(StartStopDaemon.stop(rc.pidfile))
+	# Convert ExecStartPre, ExecStopPre and ExecReload options
+	rc.start_pre = _convert_exec(unit.exec_start_pre, rc)
+	rc.stop_pre = _convert_exec(unit.exec_stop_pre, rc)
+	rc.reload = _convert_reload(unit, rc)
+
+
+def _report_unknown(unit, rc, kind):
+	"""
+	Adds single warning listing all directives in unit that converter
+	doesn't know, grouped by section.
+	"""
+	if not unit.unknown:
+		return
+	sections, options = [], {}
+	for section, option in unit.unknown:
+		if section not in options:
+			sections.append(section)
+			options[section] = []
+		options[section].append(UnitFileParser.original_name(option) + "=")
+	rc.warn("Unsupported directives ignored in %s: %s" % (kind, "; ".join([
+		"[%s] %s" % (section, ", ".join(options[section])) for section in sections ])))
+
+
+def _specifiers(rc):
+	"""
+	Returns dict with values of %i, %I, %n, %N, %p, %P and %% specifiers.
 	
-	if "exec_stop_post" in unit:
-		rc.stop.extend(_convert_exec_post(unit.exec_stop_post))
+	Instance of template is known only when script is started, so %i and
+	%I are replaced by references to variables set from RC_SVCNAME.
+	"""
+	prefix = rc.shortname
+	if rc.template:
+		name = "%s@${%s}" % (prefix, INSTANCE_VAR)
+		instance = "${%s}" % (INSTANCE_VAR,)
+		unescaped = "${%s}" % (INSTANCE_UNESCAPED_VAR,)
 	else:
-		rc.stop.append(Command(EEND, "$?"))
+		name, instance, unescaped = prefix, "", ""
+	return {
+		'i' : instance, 'I' : unescaped,
+		'n' : name + ".service", 'N' : name,
+		'p' : prefix, 'P' : _unescape(prefix),
+		'%' : '%',
+	}
+
+
+def _resolve_specifiers(unit, rc, used):
+	"""
+	Returns unit with specifiers returned by _specifiers resolved, adding
+	every resolved specifier to 'used' set. Other specifiers are left as
+	they are. Unit without specifiers is returned as it is, otherwise it's
+	copied first.
+	
+	Specifiers in Exec* options are only added to 'used', they are
+	resolved by _command.
+	"""
+	specifiers = _specifiers(rc)
+	def replace(m):
+		if m.group(1) in specifiers:
+			used.add(m.group(1))
+			return specifiers[m.group(1)]
+		return m.group(0)
+	
+	changes = {}
+	for option, (is_list, default) in SCHEMA.iteritems():
+		value = getattr(unit, option)
+		if option in EXEC_OPTIONS:
+			for x in value:
+				if "%" in x:
+					used.update([ s for s in SPECIFIER_RE.findall(x) if s in specifiers ])
+			continue
+		if is_list:
+			if any([ "%" in x for x in value ]):
+				changes[option] = [ SPECIFIER_RE.sub(replace, x) for x in value ]
+		elif value is not None and "%" in value:
+			changes[option] = SPECIFIER_RE.sub(replace, value)
+	if not changes:
+		return unit
+	unit = copy.copy(unit)
+	for option in changes:
+		setattr(unit, option, changes[option])
+	return unit
+
+
+def _unescape(value):
+	""" Reverts escaping used by systemd in unit names """
+	return ESCAPE_RE.sub(lambda m: unichr(int(m.group(1), 16)), value.replace("-", "/"))
+
+
+def _can_be_declarative(unit):
+	"""
+	Returns True if openrc-run can start and stop service by itself,
+	without start() and stop() functions.
+	"""
+	if unit.type not in (ST_SIMPLE, ST_FORKING):
+		return False
+	for o in ("exec_start_post", "exec_stop", "exec_stop_post"):
+		if o in unit:
+			return False
+	return True
+
+
+def _supervise_problem(unit):
+	"""
+	Returns None if service can be started by supervise-daemon, or string
+	describing why it can't.
+	supervise-daemon has to be parent of daemon and stops it by itself.
+	"""
+	if unit.type != ST_SIMPLE:
+		return "Only simple services can be supervised"
+	if len(unit.exec_stop):
+		return "Supervised service cannot use ExecStop="
+	return None
+
+
+def _activation_problem(unit, socket):
+	"""
+	Returns None if service can be started by socket-activate helper, or
+	string describing why it can't.
+	That's possible only if daemon doesn't fork, as helper is replaced by
+	daemon, and only for sockets that helper knows how to create.
+	"""
+	if unit.type not in (ST_SIMPLE, ST_NOTIFY):
+		return "Socket activation is supported only for simple and notify services"
+	if (socket.accept or "no").lower() in ("yes", "true", "on", "1"):
+		return "Unsupported socket option: Accept=yes"
+	for o in SOCKET_LISTEN_UNSUPPORTED:
+		if o in socket:
+			return "Unsupported socket option: %s" % (o,)
+	if not any([ o in socket for o in SOCKET_LISTEN_OPTIONS ]):
+		return "Socket unit without supported Listen option"
+	return None
+
+
+def _socket_activate(socket, rc, daemon):
+	"""
+	Returns command that listens on all sockets from socket unit and
+	executes 'daemon' command when first connection arrives.
+	"""
+	cmd = Command(SOCKET_ACTIVATE, "-n",
+		socket.file_descriptor_name or rc.svcname() + ".socket")
+	if socket.socket_mode is not None:
+		cmd.extend("-m", socket.socket_mode)
+	# File descriptors are passed in order in which sockets were listed
+	used = {}
+	for o in socket.listen_order:
+		if o in SOCKET_LISTEN_OPTIONS:
+			i = used.get(o, 0)
+			cmd.extend(SOCKET_LISTEN_OPTIONS[o], getattr(socket, o)[i])
+			used[o] = i + 1
+	return cmd.extend("--", *daemon.args)
+
+
+def _convert_declarative(unit, rc, socket=None):
+	"""
+	Converts ExecStart into 'command', 'command_args' and
+	'command_background' variables used by openrc-run
+	"""
+	daemon = _command(unit.exec_start[0], rc)
+	if socket is not None:
+		daemon = _socket_activate(socket, rc, daemon)
+	rc.command = daemon.args[0]
+	rc.command_args = daemon.args[1:]
+	rc.command_background = unit.type == ST_SIMPLE
+
+
+def _convert_supervised(unit, rc, socket=None):
+	"""
+	Converts ExecStart into 'command' and 'command_args' started by
+	supervise-daemon, and Restart*, StartLimit* options into respawn_*
+	variables. Daemon is restarted after it exits, unless it exits more
+	than StartLimitBurst times in StartLimitIntervalSec.
+	"""
+	daemon = _command(unit.exec_start[0], rc)
+	if socket is not None:
+		daemon = _socket_activate(socket, rc, daemon)
+	rc.supervisor = SUPERVISE_DAEMON
+	rc.command = daemon.args[0]
+	rc.command_args = daemon.args[1:]
+	# supervise-daemon writes its own PID into pidfile, so daemon can't
+	# use same file
+	rc.pidfile = os.path.join(RUN_D, rc.svcname() + ".pid")
+	rc.start_post = _convert_exec(unit.exec_start_post, rc)
+	rc.stop_post = _convert_exec(unit.exec_stop_post, rc)
 	
-	# Convert ExecStartPre and ExecStopPre options
-	if "exec_start_pre" in unit:
-		rc.start_pre.extend(_convert_exec_pre(unit.exec_start_pre))
-	if "exec_stop_pre" in unit:
-		rc.stop_pre.extend(_convert_exec_pre(unit.exec_stop_pre))
+	if unit.restart_sec is not None:
+		rc.respawn_delay = _resource(rc, 'restart_sec', _seconds, unit.restart_sec)
+	burst = "%d" % (DEFAULT_START_LIMIT_BURST,)
+	if unit.start_limit_burst is not None:
+		burst = _resource(rc, 'start_limit_burst', _integer, unit.start_limit_burst)
+	interval = "%d" % (DEFAULT_START_LIMIT_INTERVAL,)
+	for o in ('start_limit_interval_sec', 'start_limit_interval'):
+		if getattr(unit, o) is not None:
+			interval = _resource(rc, o, _seconds, getattr(unit, o))
+			break
+	if interval == "0" or burst == "0":
+		# Restarts are not limited
+		rc.respawn_max = "0"
+	elif interval is not None and burst is not None:
+		rc.respawn_max = burst
+		rc.respawn_period = interval
 
 
-def _convert_exec_pre(options):
+def _convert_start_stop(unit, rc, socket=None):
+	"""
+	Converts ExecStart, ExecStartPost, ExecStop and ExecStopPost into
+	commands used in start() and stop() functions
 	"""
-	Converts 'ExecStartPre' and 'ExecStopPre' options from systemd
-	to list of command used later in rc script start_pre and stop_pre
-	functions
+	# Convert 'start' command ExecStart and ExecStartPost, 2nd being optional
+	daemon = _command(unit.exec_start[0], rc)
+	if socket is not None:
+		daemon = _socket_activate(socket, rc, daemon)
+	rc.start = StartStopDaemon.start(daemon,
+		rc.pidfile, forking = unit.type not in (ST_SIMPLE, ST_DBUS, ST_NOTIFY),
+		options = rc.daemon_options)
+	if unit.type == ST_NOTIFY and socket is None:
+		# With socket activation, service is ready as soon as it listens.
+		# Otherwise, daemon is started by helper that waits for READY=1
+		timeout = _start_timeout(unit, rc)
+		rc.start = Command(NOTIFY_SERVICE_WAIT,
+			"-t", "%d" % (timeout or 0,), "-p", rc.pidfile,
+			os.path.join(RUN_D, rc.svcname() + ".notify"), "--",
+			*rc.start.args)
+	if unit.type == ST_DBUS:
+		rc.bus_name = unit.bus_name
+	rc.start_post = _convert_exec(unit.exec_start_post, rc)
+	
+	# ... 'stop' command, both ExecStop and ExecStopPost are optional
+	rc.stop = _convert_exec(unit.exec_stop, rc)
+	if unit.type in (ST_SIMPLE, ST_NOTIFY) or not unit.exec_stop:
+		rc.stop.append(StartStopDaemon.stop(rc.pidfile))
+	rc.stop_post = _convert_exec(unit.exec_stop_post, rc)
+
+
+def _convert_reload(unit, rc):
+	"""
+	Converts ExecReload into commands of reload() function. By far most
+	common 'kill -HUP $MAINPID' is rewritten to signal daemon found by
+	pidfile, or through supervise-daemon if service is supervised, as its
+	pidfile holds PID of supervisor.
 	"""
-	options = ensure_list(options)
 	rv = []
-	for o in options:
-		if o.startswith("-"):
-			rv.append(Command.split(o[1:]))
-		else:
-			rv.append(Command.split(o).extend("||", "return", "1"))
-	if len(rv):
-		rv.append(Command("return", "0"))
+	for c in _convert_exec(unit.exec_reload, rc):
+		signal = _kill_signal(c.args)
+		if signal is not None:
+			if rc.supervisor is not None:
+				c.args = [ SUPERVISE_DAEMON, rc.svcname(), "--signal", signal ]
+			else:
+				c.args = [ START_STOP_DAEMON, "-s", signal, "-p", rc.pidfile ]
+		elif any([ "MAINPID" in x for x in c.args ]):
+			rc.warn("$MAINPID is supported only in 'kill -SIGNAL $MAINPID' form of ExecReload=: %s"
+				% (c.to_string(),))
+		rv.append(c)
 	return rv
 
 
-def _convert_exec_post(options):
+def _kill_signal(args):
+	"""
+	Returns name of signal sent by 'kill [-SIGNAL] [--] $MAINPID' command, or
+	None if command is anything else.
+	"""
+	if os.path.basename(args[0]) != "kill" or args[-1] not in MAINPID_REFS:
+		return None
+	options = args[1:-1]
+	if options and options[-1] == "--":
+		options = options[0:-1]
+	if not options:
+		return "TERM"
+	if len(options) == 2 and options[0] in ("-s", "--signal"):
+		signal = options[1]
+	elif len(options) == 1 and options[0].startswith("-") and options[0] != "-s":
+		signal = options[0][1:]
+	else:
+		return None
+	signal = signal.upper()
+	if signal.startswith("SIG"):
+		signal = signal[3:]
+	if not SIGNAL_RE.match(signal):
+		return None
+	return signal
+
+
+def _start_timeout(unit, rc):
+	"""
+	Returns start timeout in whole seconds, as specified by TimeoutStartSec
+	or TimeoutSec, or None if there should be no timeout. Invalid value
+	is reported and default timeout is used instead.
 	"""
-	Converts 'ExecStartPost' and 'ExecStopPost' options from systemd
-	to list of command that can be appended to start() or stop() function.
+	option = "timeout_start_sec" if unit.timeout_start_sec else "timeout_sec"
+	value = getattr(unit, option)
+	if value is None:
+		return DEFAULT_TIMEOUT_START
+	try:
+		timeout = parse_timespan(value)
+	except ValueError, e:
+		rc.warn("%s; %s= ignored" % (e, UnitFileParser.original_name(option)))
+		return DEFAULT_TIMEOUT_START
+	if timeout is None or timeout == 0:
+		# Both mean 'no timeout' in systemd
+		return None
+	return max(1, int(round(timeout)))
+
+
+def _convert_resources(unit, rc):
+	"""
+	Converts resource-control options. Scheduling options are passed to
+	start-stop-daemon, Limit* options are set as rc_ulimit and cgroup
+	limits as rc_cgroup_settings. Options with value that cannot be
+	expressed are reported and skipped.
+	"""
+	# start-stop-daemon options
+	if unit.nice is not None:
+		v = _resource(rc, 'nice', _integer, unit.nice, -20, 19)
+		if v is not None:
+			rc.daemon_options += [ "--nicelevel", v ]
+	if unit.ioscheduling_class is not None or unit.ioscheduling_priority is not None:
+		v = _resource(rc, 'ioscheduling_class', _ionice, unit)
+		if v is not None:
+			rc.daemon_options += [ "--ionice", v ]
+	if unit.cpuscheduling_policy is not None or unit.cpuscheduling_priority is not None:
+		v = _resource(rc, 'cpuscheduling_policy', _scheduler, unit)
+		if v is not None:
+			rc.daemon_options += v
 	
-	Generated list is in indented if-then-else block that checks if
-	"start-stop-daemon" command failed and executes commands only if that's
-	not case. Generated block also takes care of calling 'eend' command.
+	# rc_ulimit
+	for o in sorted(ULIMIT_OPTIONS):
+		if getattr(unit, o) is not None:
+			v = _resource(rc, o, _ulimit, o, getattr(unit, o))
+			if v is not None:
+				rc.ulimit += [ ULIMIT_OPTIONS[o][0], v ]
+	
+	# rc_cgroup_settings
+	memory = dict(CGROUP_MEMORY_SETTINGS)
+	if unit.memory_max is None:
+		# MemoryLimit is older name of MemoryMax
+		memory['memory_limit'] = memory.pop('memory_max')
+	for o in sorted(memory):
+		if getattr(unit, o) is not None:
+			v = _resource(rc, o, _cgroup_limit, getattr(unit, o), parse_size)
+			if v is not None:
+				rc.cgroup_settings.append(( memory[o], v ))
+	if unit.cpuquota is not None:
+		v = _resource(rc, 'cpuquota', _cpu_max, unit)
+		if v is not None:
+			rc.cgroup_settings.append(( "cpu.max", v ))
+	if unit.cpuweight is not None:
+		v = _resource(rc, 'cpuweight', _integer, unit.cpuweight, 1, 10000)
+		if v is not None:
+			rc.cgroup_settings.append(( "cpu.weight", v ))
+	if unit.ioweight is not None:
+		v = _resource(rc, 'ioweight', _integer, unit.ioweight, 1, 10000)
+		if v is not None:
+			rc.cgroup_settings.append(( "io.weight", "default " + v ))
+	if unit.tasks_max is not None:
+		v = _resource(rc, 'tasks_max', _cgroup_limit, unit.tasks_max, _integer)
+		if v is not None:
+			rc.cgroup_settings.append(( "pids.max", v ))
+	# CPUAffinity sets affinity of daemon process only, but cpuset is
+	# closest thing OpenRC can do. AllowedCPUs has precedence.
+	if unit.allowed_cpus is not None:
+		v = _resource(rc, 'allowed_cpus', _cpus, [ unit.allowed_cpus ])
+	elif len(unit.cpuaffinity):
+		v = _resource(rc, 'cpuaffinity', _cpus, unit.cpuaffinity)
+	else:
+		v = None
+	if v is not None:
+		rc.cgroup_settings.append(( "cpuset.cpus", v ))
+
+
+def _resource(rc, option, convert, *args):
+	"""
+	Returns convert(*args). If conversion throws ValueError, reports
+	that 'option' was ignored and returns None.
 	"""
-	options = ensure_list(options)
-	return Command.multiple(
-		"if [ $? -eq 0 ] ; then",
-		Command.indented(
-			[ Command.split(o).extend("||", "return", "1") for o in options ],
-			Command(EEND, "0")
-		),
-		"else",
-			Command(EEND, "1").indent(),
-		"fi"
-	)
+	try:
+		return convert(*args)
+	except ValueError, e:
+		rc.warn("%s; %s= ignored" % (e, UnitFileParser.original_name(option)))
+		return None
+
+
+def _integer(value, minimum=0, maximum=None):
+	""" Returns value as string, checking that it's integer in range """
+	try:
+		i = int(value.strip())
+	except ValueError:
+		raise ValueError("Invalid number: %s" % (value,))
+	if i < minimum or (maximum is not None and i > maximum):
+		raise ValueError("Value out of range: %s" % (value,))
+	return "%d" % (i,)
+
+
+def _seconds(value):
+	""" Returns time span as string with whole number of seconds """
+	seconds = parse_timespan(value)
+	if seconds is None:
+		raise ValueError("Infinite time span is not supported")
+	return "%d" % (-int(-seconds // 1),)
+
+
+def _ionice(unit):
+	""" Returns 'class:priority' argument for start-stop-daemon --ionice """
+	cls = unit.ioscheduling_class or "best-effort"
+	if cls not in IO_SCHEDULING_CLASSES:
+		raise ValueError("Unsupported IO scheduling class: %s" % (cls,))
+	cls = IO_SCHEDULING_CLASSES[cls]
+	if unit.ioscheduling_priority is None:
+		return "%d" % (cls,)
+	return "%d:%s" % (cls, _integer(unit.ioscheduling_priority, 0, 7))
+
+
+def _scheduler(unit):
+	""" Returns start-stop-daemon arguments setting CPU scheduling policy """
+	policy = unit.cpuscheduling_policy or "other"
+	if policy not in CPU_SCHEDULING_POLICIES:
+		raise ValueError("Unsupported CPU scheduling policy: %s" % (policy,))
+	rv = [ "--scheduler", policy ]
+	if unit.cpuscheduling_priority is not None:
+		rv += [ "--scheduler-priority", _integer(unit.cpuscheduling_priority, 0, 99) ]
+	return rv
+
+
+def _ulimit(option, value):
+	"""
+	Returns Limit* option value as used by ulimit. As rc_ulimit sets soft
+	and hard limit at once, 'soft:hard' is supported only if both are same.
+	"""
+	if ":" in value:
+		soft, hard = value.split(":", 1)
+		if soft != hard:
+			raise ValueError("Different soft and hard limits are not supported")
+		value = soft
+	block = ULIMIT_OPTIONS[option][1]
+	if block is None:
+		limit = parse_timespan(value)
+	else:
+		limit = parse_size(value)
+		if limit is not None:
+			limit = float(limit) / block
+	if limit is None:
+		return "unlimited"
+	return "%d" % (-int(-limit // 1),)
+
+
+def _cgroup_limit(value, parse):
+	"""
+	Returns limit as written into cgroup file, where 'max' means no limit.
+	Values relative to amount of memory or tasks of host can't be
+	converted, as script may be used on another machine.
+	"""
+	if value.strip().endswith("%"):
+		raise ValueError("Percentage limits are not supported")
+	if value.strip() == "infinity":
+		return "max"
+	return "%s" % (parse(value),)
+
+
+def _cpu_max(unit):
+	""" Returns cpu.max setting for CPUQuota and CPUQuotaPeriodSec """
+	value = unit.cpuquota.strip()
+	if not value.endswith("%"):
+		raise ValueError("Invalid CPU quota: %s" % (value,))
+	try:
+		percent = float(value[0:-1])
+	except ValueError:
+		raise ValueError("Invalid CPU quota: %s" % (value,))
+	period = CPU_QUOTA_PERIOD
+	if unit.cpuquota_period_sec is not None:
+		period = parse_timespan(unit.cpuquota_period_sec)
+		if period is None:
+			raise ValueError("Invalid CPU quota period: %s" % (unit.cpuquota_period_sec,))
+		period = int(round(period * 1000000))
+	return "%d %d" % (max(1, int(round(percent * period / 100))), period)
+
+
+def _cpus(values):
+	""" Returns CPU list in format used by cpuset.cpus """
+	rv = []
+	for value in values:
+		for x in value.replace(",", " ").split():
+			if not CPU_RANGE_RE.match(x):
+				raise ValueError("Unsupported CPU list: %s" % (value,))
+			rv.append(x)
+	if not rv:
+		raise ValueError("Empty CPU list")
+	return ",".join(rv)
+
+
+def _convert_exec(options, rc):
+	"""
+	Converts 'ExecStartPre', 'ExecStartPost' and similar options from
+	systemd to list of commands.
+	"""
+	return [ _command(o, rc) for o in options ]
+
+
+def _command(value, rc):
+	"""
+	Splits Exec* option into Command, resolving specifiers. Failure of
+	command prefixed by '-' is ignored. '+' and '!' prefixes only change
+	privileges, which are not changed by rc script anyway, and ':' is
+	handled by split_command. Setting argv[0] by '@' prefix is not
+	supported, so argv[0] is dropped.
+	"""
+	prefixes, words = split_command(value, _specifiers(rc) if "%" in value else None)
+	if "@" in prefixes:
+		if len(words) < 2:
+			raise ValueError("Missing argv[0] after executable: %s" % (value,))
+		rc.warn("Setting argv[0] is not supported, %s is used: %s" % (words[0], value))
+		words = words[0:1] + words[2:]
+	c = Command(*words)
+	c.ignore_failure = "-" in prefixes
+	return c
 
 
 def _convert_requirement(r):
@@ -151,47 +662,89 @@ def _convert_requirement(r):
 	This is done mainly by stripping .service part of name, but uses
 	UNIT_NAMES_DICT for some special names (e.g. 'network.target' -> 'net')
 	
-	May return empty string for some names, such as .socket and .device
-	units. These are later ignored.
+	Socket unit is converted to name of service it activates, as that
+	service listens on socket when socket activation is used.
+	
+	Instance of template, such as 'foo@bar.service', is converted to name
+	of symlink to multiplexed script, 'foo.bar'.
+	
+	May return empty string for some names, such as .device units and
+	sockets of services that are not converted. These are later ignored.
 	"""
 	if r in UNIT_NAMES_DICT:
 		return UNIT_NAMES_DICT[r]
 	
-	for suffix in ('device', 'socket'):
-		if r.endswith("." + suffix):
-			# Ignored
+	if r.endswith(".device"):
+		# Ignored
+		return ""
+	if r.endswith(".socket"):
+		if any([ word in r for word in AUTO_IGNORED ]):
 			return ""
 	
-	for suffix in ('target', 'service'):
+	for suffix in ('target', 'service', 'socket'):
 		if r.endswith("." + suffix):
-			return ".".join(r.split(".")[0:-1])
+			r = ".".join(r.split(".")[0:-1])
+			break
 	
+	if "@" in r:
+		# Instance of template is started through 'prefix.instance'
+		# symlink, template itself cannot be started
+		prefix, instance = r.split("@", 1)
+		if not instance:
+			return ""
+		return "%s.%s" % (prefix, instance)
 	return r
 
 
-def _convert_requirements(rs):
+def _convert_requirements(rs, sockets=None, rc=None):
 	"""
 	Calls convert_requirement for each item in list and
 	filters out empty returns.
 	Supports nested lists as well.
+	
+	If 'sockets' dict is provided, socket unit is first replaced by
+	service it activates. Socket that is not in dict is dropped and
+	warning is recorded in 'rc'.
 	"""
 	rv = set()
 	def add(r):
 		if type(r) == list:
 			for x in r: add(x)
 		else:
-			for x in shlex.split(r):
-				x = _convert_requirement(x)
-				if x: rv.add(x)
+			for x in split_words(r):
+				name = _convert_requirement(x)
+				if name and sockets is not None and x.endswith(".socket") \
+						and x not in UNIT_NAMES_DICT:
+					service = _socket_service(x, sockets)
+					if service is None:
+						rc.warn("%s doesn't activate any existing service; dependency on it is dropped" % (x,))
+						continue
+					name = _convert_requirement(service)
+				if name: rv.add(name)
 	add(rs)
 	return list(rv)
 
 
+def _socket_service(name, sockets):
+	"""
+	Returns name of service activated by socket unit 'name', as found in
+	'sockets' dict, or None if there is no such service. Instance of
+	template socket activates same instance of service.
+	"""
+	if name in sockets:
+		return sockets[name]
+	template, instance = split_instance(name)
+	service = sockets.get(template)
+	if service is not None and is_template(service):
+		return service.replace("@.", "@%s." % (instance,), 1)
+	return None
+
+
 if __name__ == "__main__":
 	# Loads file specified as first argument.
 	# Used only to test loading
 	import sys, pprint
 	u = UnitFile(sys.argv[1])
 	print u
-	pprint.pprint(u.values)
+	pprint.pprint(u.to_dict())
 
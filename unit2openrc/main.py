@@ -5,37 +5,604 @@ Unit2OpenRC - main
 Converts systemd unit files into OpenRC scripts
 """
 from __future__ import unicode_literals
-from unitfile import UnitFile
+from unitfile import UnitFile, SocketUnitFile
 from rcfile import RCFile
 from convert import convert
+from unitindex import UnitIndex
+from manifest import Manifest, sources_digest, sockets_digest
+from stats import Stats, NULL_STATS
+from analyze import DependencyGraph, load_estimates
+from watch import Watcher
+from archive import ArchiveIndex, archive_writer, convert_to_archive
+from . import write_if_changed, rc_name, is_template, split_instance, in_root
 from consts import *
-import sys, os, argparse
+import sys, os, argparse, multiprocessing, json, time
 
 HELP = """ Converts systemd unit files into OpenRC scripts """
 
 
-def convert_one(unit_filename, rc_filename):
+def render_one(unit_filename, short_name, dropins=(), stats=NULL_STATS, options={},
+			socket=(), root=None):
+	"""
+	Loads and converts one unit, returns (data, diagnostics) tuple with
+	rendered rc script as string and list of problems found in unit.
+	'options' are passed to convert function as keyword arguments.
+	'socket' is list of socket unit activating service followed by its
+	drop-ins, or empty list if there is no such unit. If 'root' is set,
+	unit is named by its path inside of root directory in script.
+	Throws IOError, OSError or ValueError if unit cannot be read or
+	converted.
+	"""
+	with stats.stage("parse"):
+		u, s = load_units([ unit_filename ] + list(dropins), socket)
+	with stats.stage("convert"):
+		rc = RCFile(short_name, template=is_template(os.path.split(unit_filename)[-1]))
+		convert(u, rc, socket=s, **options)
+	with stats.stage("render"):
+		return rc.render(source_name(unit_filename, root)), rc.diagnostics
+
+
+def source_name(filename, root):
+	"""
+	Returns path of unit file as seen from inside of root directory, or
+	path as it is if file is not inside of root.
+	"""
+	if root is None:
+		return filename
+	path = os.path.relpath(filename, root)
+	if path.startswith(".."):
+		return filename
+	return "/" + path
+
+
+def report_diagnostics(name, diagnostics):
+	""" Prints warnings recorded while converting unit, prefixed by its name """
+	for d in diagnostics:
+		print >>sys.stderr, "%s: %s" % (name, d)
+
+
+def load_units(sources, socket=()):
+	"""
+	Loads service from list of unit file and its drop-ins and socket unit
+	from same kind of list, if not empty. Returns (unit, socket) tuple,
+	where 'socket' may be None.
+	"""
+	u = UnitFile.load(sources[0], sources[1:])
+	if not socket:
+		return u, None
+	try:
+		return u, SocketUnitFile.load(socket[0], socket[1:])
+	except ValueError, e:
+		raise ValueError("Invalid socket unit: %s" % (e,))
+
+
+def unit_sources(index, service):
+	"""
+	Returns (sources, socket) tuple of lists for service from UnitIndex,
+	where 'sources' is unit file followed by its drop-ins and 'socket' same
+	list for socket unit activating service, empty if there is none.
+	"""
+	sources = [ index.units[service] ] + index.dropins(service)
+	socket = index.socket(service)
+	if socket is None:
+		return sources, []
+	socket_name = service[0:-len(".service")] + ".socket"
+	return sources, [ socket ] + index.dropins(socket_name)
+
+
+def convert_one(unit_filename, rc_filename, dropins=(), options={}, socket=(),
+			root=None):
 	""" Loads, converts and saves one unit->rc combination """
+	short_name = os.path.split(rc_filename)[-1]
 	try:
-		u = UnitFile(open(unit_filename, "r"))
-	except IOError, e:
+		data, diagnostics = render_one(unit_filename, short_name, dropins,
+			options=options, socket=socket, root=root)
+	except (IOError, OSError), e:
 		print >>sys.stderr, "Failed to read unit file: %s" % (e,)
 		return 1
 	except ValueError, e:
 		print >>sys.stderr, "Invalid unit file: %s" % (e,)
 		return 1
 	
-	short_name = os.path.split(rc_filename)[-1]
+	report_diagnostics(os.path.split(unit_filename)[-1], diagnostics)
+	return write_one(rc_filename, data)
+
+
+def write_one(rc_filename, data, stats=NULL_STATS):
+	"""
+	Saves already rendered rc script. Script that already has same content
+	is not touched, so OpenRC doesn't have to rebuild its dependency cache.
+	"""
 	try:
-		rc = RCFile(short_name)
-		convert(u, rc)
-		rc.write(open(rc_filename, "w"), unit_filename)
-		os.chmod(rc_filename, 0755)
-	except IOError, e:
+		with stats.stage("write"):
+			written = write_if_changed(rc_filename, data, 0755)
+	except (IOError, OSError), e:
 		print >>sys.stderr, "Failed to write rc file: %s" % (e,)
+		stats.count("failed")
 		return 1
 	
-	print "Converted %s" % (rc.shortname)	
+	if not written:
+		stats.count("identical")
+		print "Unchanged %s" % (os.path.split(rc_filename)[-1],)
+		return
+	stats.count("converted")
+	stats.count("bytes_written", len(data))
+	print "Converted %s" % (os.path.split(rc_filename)[-1],)
+
+
+def link_instances(service, rc_filename, instances, manifest=None, stats=NULL_STATS):
+	"""
+	Creates 'name.instance' symlink to multiplexed script generated from
+	template for every instance. If 'manifest' is provided, symlinks
+	created in past for instances that are no longer enabled are removed.
+	"""
+	target = os.path.split(rc_filename)[-1]
+	links = []
+	for instance in instances:
+		link = "%s.%s" % (rc_filename, instance)
+		if os.path.islink(link) and os.readlink(link) == target:
+			links.append(link)
+			continue
+		if os.path.lexists(link):
+			print >>sys.stderr, "Skipped %s: File exists" % (os.path.split(link)[-1],)
+			stats.skip("file exists")
+			continue
+		try:
+			os.symlink(target, link)
+		except OSError, e:
+			print >>sys.stderr, "Failed to create symlink: %s" % (e,)
+			stats.count("failed")
+			continue
+		links.append(link)
+		stats.count("linked")
+		print "Linked %s" % (os.path.split(link)[-1],)
+	if manifest is not None:
+		unlink_instances([ x for x in manifest.links(service) if x not in links ],
+			target, stats)
+		manifest.set_links(service, links)
+
+
+def unlink_instances(links, target, stats=NULL_STATS):
+	""" Removes symlinks to 'target' script, created by link_instances """
+	for link in links:
+		if os.path.islink(link) and os.readlink(link) == target:
+			try:
+				os.unlink(link)
+				print "Removed %s" % (os.path.split(link)[-1],)
+				stats.count("removed")
+			except OSError, e:
+				print >>sys.stderr, "Failed to remove symlink: %s" % (e,)
+
+
+def is_ignored(service):
+	""" Returns True for services that are never converted in auto mode """
+	if service in AUTO_IGNORED_EXACT:
+		return True
+	return any([ word in service for word in AUTO_IGNORED ])
+
+
+def _render_job(job):
+	"""
+	Worker-side part of convert_all.
+	Returns (service, rc_filename, data, digest, error, diagnostics, times)
+	tuple, where either 'data' or 'error' is None. 'digest' is digest of
+	unit file and drop-ins, 'diagnostics' list of warnings, printed by
+	caller so output doesn't depend on order in which workers finish, and
+	'times' is dict with time spent in each stage, empty if 'timed' is
+	False.
+	"""
+	service, sources, socket, rc_filename, timed, options, root = job
+	stats = Stats() if timed else NULL_STATS
+	try:
+		with stats.stage("parse"):
+			digest = sources_digest(sources + socket)
+		data, diagnostics = render_one(sources[0], os.path.split(rc_filename)[-1],
+			sources[1:], stats, options, socket, root)
+		return service, rc_filename, data, digest, None, diagnostics, stats.times
+	except (IOError, OSError), e:
+		return (service, rc_filename, None, None,
+			"Failed to read unit file: %s" % (e,), [], stats.times)
+	except ValueError, e:
+		return service, rc_filename, None, digest, "%s" % (e,), [], stats.times
+
+
+def _convert_job(job):
+	"""
+	Worker-side part of reduce_and_render.
+	Works as _render_job, but returns converted RCFile instance instead of
+	rendered data.
+	"""
+	service, sources, socket, rc_filename, timed, options, root = job
+	stats = Stats() if timed else NULL_STATS
+	try:
+		with stats.stage("parse"):
+			digest = sources_digest(sources + socket)
+			u, s = load_units(sources, socket)
+		with stats.stage("convert"):
+			rc = RCFile(os.path.split(rc_filename)[-1],
+				template=is_template(os.path.split(sources[0])[-1]))
+			convert(u, rc, socket=s, **options)
+		return service, rc_filename, rc, digest, None, rc.diagnostics, stats.times
+	except (IOError, OSError), e:
+		return (service, rc_filename, None, None,
+			"Failed to read unit file: %s" % (e,), [], stats.times)
+	except ValueError, e:
+		return service, rc_filename, None, digest, "%s" % (e,), [], stats.times
+
+
+def _render_rc_job(job):
+	"""
+	Worker-side part of reduce_and_render.
+	Renders already converted RCFile, returns same tuple as _render_job.
+	"""
+	service, rc_filename, rc, digest, source_file_name, timed = job
+	stats = Stats() if timed else NULL_STATS
+	with stats.stage("render"):
+		data = rc.render(source_file_name)
+	return service, rc_filename, data, digest, None, rc.diagnostics, stats.times
+
+
+def _depends_job(job):
+	"""
+	Worker-side part of analyze_all.
+	Returns (service, depends, error, diagnostics) tuple, where 'depends'
+	is dict of {kind: list of names}, or None if unit cannot be converted.
+	"""
+	service, sources, socket, short_name, sockets = job
+	try:
+		rc = RCFile(short_name, template=is_template(os.path.split(sources[0])[-1]))
+		u, s = load_units(sources, socket)
+		convert(u, rc, socket=s, sockets=sockets)
+		return service, dict(need=rc.need, want=rc.want, after=rc.after,
+				before=rc.before), None, rc.diagnostics
+	except (IOError, OSError), e:
+		return service, None, "Failed to read unit file: %s" % (e,), []
+	except ValueError, e:
+		return service, None, "%s" % (e,), []
+
+
+def map_jobs(fn, jobs, job_count):
+	"""
+	Calls fn for each item in jobs, using pool of job_count worker processes.
+	Yields results in same order as jobs were given, so output doesn't depend
+	on how fast workers are.
+	"""
+	if job_count is None:
+		job_count = multiprocessing.cpu_count()
+	job_count = min(job_count, len(jobs))
+	if job_count < 2:
+		# Not worth of spawning anything
+		for j in jobs:
+			yield fn(j)
+		return
+	pool = multiprocessing.Pool(job_count)
+	chunksize = max(1, len(jobs) // (job_count * 4))
+	try:
+		for r in pool.imap(fn, jobs, chunksize):
+			yield r
+	except:
+		pool.terminate()
+		raise
+	pool.close()
+	pool.join()
+
+
+def reduce_and_render(jobs, graph_jobs, job_count, stats=NULL_STATS):
+	"""
+	Converts all jobs, removes redundant dependencies using graph of all
+	converted units and renders results. Units from 'graph_jobs' are
+	converted only to make dependency graph complete.
+	Yields same tuples as _render_job does.
+	"""
+	timed = stats is not NULL_STATS
+	graph = DependencyGraph()
+	converted = []
+	for service, rc_filename, rc, digest, error, diagnostics, times in map_jobs(
+				_convert_job, jobs + graph_jobs, job_count):
+		stats.merge_times(times)
+		if rc is not None:
+			graph.add_rcfile(rc)
+		if len(converted) < len(jobs):
+			converted.append(( service, rc_filename, rc, digest, error ))
+	
+	with stats.stage("reduce"):
+		stats.count("dependencies_removed", graph.reduce())
+	
+	render_jobs = []
+	for (service, rc_filename, rc, digest, error), job in zip(converted, jobs):
+		if error is not None:
+			yield service, rc_filename, None, digest, error, [], {}
+			continue
+		depends = graph.depends[rc.shortname]
+		rc.after, rc.before = depends['after'], depends['before']
+		render_jobs.append(( service, rc_filename, rc, digest,
+			source_name(job[1][0], job[6]), timed ))
+	for r in map_jobs(_render_rc_job, render_jobs, job_count):
+		yield r
+
+
+def convert_all(unit_dirs=UNIT_DIRS, init_d=INIT_D, job_count=None,
+			manifest=None, stats=NULL_STATS, reduce=False, options={}, only=None,
+			instances={}, root=None):
+	"""
+	Converts all services found in unit_dirs, saving rc scripts into init_d.
+	Parsing, conversion and rendering is done by job_count worker processes
+	(defaults to number of CPUs), while all files are written from this one.
+	
+	If 'manifest' (Manifest instance) is provided, units that were not
+	changed since last run are skipped, scripts generated from units that
+	disappeared are removed and scripts generated in past are updated.
+	
+	If 'stats' (Stats instance) is provided, time spent in every stage and
+	number of converted, skipped and failed units is recorded in it.
+	
+	If 'reduce' is True, redundant 'after' and 'before' dependencies are
+	removed from generated scripts. As this needs graph of all units,
+	every unit is converted, and every script generated in past is
+	rewritten, even if unit was not changed.
+	
+	'options' are passed to convert function as keyword arguments.
+	
+	If 'only' (set of service names) is provided, only these services are
+	converted, or their scripts removed. That's ignored if 'reduce' is True.
+	
+	Every template is converted only once into multiplexed script, which
+	is then symlinked for every instance enabled in .wants or .requires
+	directories and for instances listed in 'instances' dict, which maps
+	template name, such as 'foo@.service', to list of instances.
+	
+	If 'root' is set, unit_dirs and init_d are inside of root directory of
+	another system, see UnitIndex.
+	"""
+	if reduce:
+		only = None
+	timed = stats is not NULL_STATS
+	graph_jobs = []
+	with stats.stage("scan"):
+		index = UnitIndex(unit_dirs, root)
+		services = index.services()
+		stats.count("units_scanned", len(services))
+		options = dict(options, sockets=index.socket_services())
+		if manifest is not None:
+			manifest.sockets = sockets_digest(options['sockets'])
+			if manifest.sockets_changed():
+				# Dependencies on socket units of any service may change
+				only = None
+		jobs, sources, stat_results = [], {}, {}
+		# Maps template to its rc script, linked once everything is converted
+		templates = {}
+		for service in sorted(services if only is None else only & set(services)):
+			# Skip over some special stuff
+			if is_ignored(service):
+				stats.skip("ignored")
+				continue
+			rc_filename = os.path.join(init_d, rc_name(service))
+			if is_template(service):
+				templates[service] = rc_filename
+			unit, socket = unit_sources(index, service)
+			# Manifest tracks socket unit as well, so change to it is noticed
+			sources[service] = unit + socket
+			if manifest is not None:
+				try:
+					stat_results[service] = [ os.stat(x) for x in sources[service] ]
+				except OSError, e:
+					print >>sys.stderr, "Skipped %s: %s" % (service, e)
+					stats.count("failed")
+					continue
+				if reduce and manifest.rc_filename(service) == rc_filename:
+					jobs.append(( service, unit, socket, rc_filename, timed, options, root ))
+					continue
+				if manifest.is_unchanged(service, sources[service], stat_results[service]):
+					stats.skip("unchanged")
+					continue
+				if manifest.rc_filename(service) == rc_filename:
+					# Generated in past, can be overwritten
+					jobs.append(( service, unit, socket, rc_filename, timed, options, root ))
+					continue
+			if os.path.exists(rc_filename):
+				print >>sys.stderr, "Skipped %s: File exists" % (service,)
+				stats.skip("file exists")
+				templates.pop(service, None)
+				graph_jobs.append(( service, unit, socket, rc_filename, False, options, root ))
+				continue
+			jobs.append(( service, unit, socket, rc_filename, timed, options, root ))
+	
+	# Convert everything and write results as they are coming
+	if reduce:
+		results = reduce_and_render(jobs, graph_jobs, job_count, stats)
+	else:
+		results = map_jobs(_render_job, jobs, job_count)
+	for service, rc_filename, data, digest, error, diagnostics, times in results:
+		stats.merge_times(times)
+		report_diagnostics(service, diagnostics)
+		if error is not None:
+			print >>sys.stderr, "Skipped %s: %s" % (service, error)
+			stats.count("failed")
+			if manifest is not None and digest is not None:
+				# Remember failure, so unit is not parsed again until changed.
+				# Script generated in past, if any, is kept.
+				manifest.update(service, sources[service], stat_results[service],
+					digest, manifest.rc_filename(service))
+		elif write_one(rc_filename, data, stats) is None:
+			if manifest is not None:
+				manifest.update(service, sources[service], stat_results[service],
+					digest, rc_filename)
+	
+	# Link instances to scripts generated from templates
+	for service in sorted(templates):
+		rc_filename = templates[service]
+		if not os.path.exists(rc_filename):
+			# Failed to convert
+			continue
+		if manifest is not None and manifest.rc_filename(service) != rc_filename:
+			continue
+		link_instances(service, rc_filename,
+			sorted(set(index.instances(service)) | set(instances.get(service, ()))),
+			manifest, stats)
+	
+	if manifest is not None:
+		# Remove scripts generated from units that are gone
+		for service in sorted(manifest.names()):
+			if service not in services and (only is None or service in only):
+				rc_filename = manifest.rc_filename(service)
+				if rc_filename:
+					unlink_instances(manifest.links(service),
+						os.path.split(rc_filename)[-1], stats)
+				if rc_filename and os.path.exists(rc_filename):
+					try:
+						os.unlink(rc_filename)
+						print "Removed %s" % (os.path.split(rc_filename)[-1],)
+						stats.count("removed")
+					except OSError, e:
+						print >>sys.stderr, "Failed to remove rc file: %s" % (e,)
+						continue
+				manifest.remove(service)
+		try:
+			with stats.stage("write"):
+				manifest.save()
+		except (IOError, OSError), e:
+			print >>sys.stderr, "Failed to save manifest: %s" % (e,)
+
+
+def watch_all(unit_dirs=UNIT_DIRS, init_d=INIT_D, job_count=None,
+			manifest=None, stats=NULL_STATS, reduce=False, options={}, instances={},
+			root=None):
+	"""
+	Converts all services as convert_all does and then, until interrupted,
+	waits for units to be changed and converts again only affected
+	services. Throws OSError if inotify is not available.
+	"""
+	watcher = Watcher(unit_dirs)
+	try:
+		# Watcher is created first, so nothing changed in meantime is missed
+		convert_all(unit_dirs, init_d, job_count, manifest, stats, reduce, options,
+			instances=instances, root=root)
+		while True:
+			affected = watcher.wait()
+			if affected is not None and not affected:
+				# Nothing that is converted was changed
+				continue
+			convert_all(unit_dirs, init_d, job_count, manifest, stats, reduce,
+				options, affected, instances, root)
+	finally:
+		watcher.close()
+
+
+def analyze_all(unit_dirs=UNIT_DIRS, job_count=None, root=None):
+	"""
+	Converts all services found in unit_dirs, without saving anything, and
+	returns DependencyGraph built from converted dependencies.
+	"""
+	index = UnitIndex(unit_dirs, root)
+	services = index.services()
+	sockets = index.socket_services()
+	jobs = []
+	for service in sorted(services):
+		# Skip over same things as convert_all does
+		if is_ignored(service):
+			continue
+		short_name = rc_name(service)
+		sources, socket = unit_sources(index, service)
+		jobs.append(( service, sources, socket, short_name, sockets ))
+	
+	graph = DependencyGraph()
+	for service, depends, error, diagnostics in map_jobs(_depends_job, jobs, job_count):
+		report_diagnostics(service, diagnostics)
+		if error is not None:
+			print >>sys.stderr, "Skipped %s: %s" % (service, error)
+		else:
+			graph.add(rc_name(service), **depends)
+	return graph
+
+
+def archive_all(index, out, init_d=INIT_D, exists=None, stats=NULL_STATS,
+			options={}, instances={}):
+	"""
+	Converts all services from index (UnitIndex or ArchiveIndex) as auto
+	mode does, but writes scripts as tar stream into 'out' file object
+	instead of init_d directory. Paths in archive are relative to root.
+	See convert_to_archive for 'exists'.
+	
+	Modification time of archived files is taken from SOURCE_DATE_EPOCH
+	environment variable, if set, so same units always produce same
+	archive.
+	"""
+	mtime = int(os.environ.get("SOURCE_DATE_EPOCH", time.time()))
+	with stats.stage("scan"):
+		services = index.services()
+		stats.count("units_scanned", len(services))
+		options = dict(options, sockets=index.socket_services())
+		for name, path in sorted(index.unresolved.iteritems()):
+			print >>sys.stderr, ("Warning: Skipped %s: Symlink target is not file in unit directories: %s"
+				% (name, index.follow(path)))
+			if name.endswith(".service"):
+				stats.skip("unresolved symlink")
+		names = []
+		for service in sorted(services):
+			if is_ignored(service):
+				stats.skip("ignored")
+			else:
+				names.append(service)
+	tar, stream = archive_writer(out, getattr(out, "name", None), mtime)
+	convert_to_archive(index, names, tar, init_d, exists, options, instances,
+		mtime, stats)
+	tar.close()
+	if stream is not out:
+		stream.close()
+
+
+def report_stats(stats, summary=False, json_file=None):
+	"""
+	Prints summary of stats into stderr if 'summary' is True and saves them
+	as JSON into 'json_file', if set; '-' means standard output.
+	Returns 1 if file cannot be written, None otherwise.
+	"""
+	if summary:
+		print >>sys.stderr, stats.summary()
+	if json_file is None:
+		return
+	data = json.dumps(stats.to_dict(), indent=1, sort_keys=True) + "\n"
+	if json_file == "-":
+		sys.stdout.write(data)
+		return
+	try:
+		with open(json_file, "w") as f:
+			f.write(data)
+	except (IOError, OSError), e:
+		print >>sys.stderr, "Failed to save stats: %s" % (e,)
+		return 1
+
+
+def output_options(args):
+	"""
+	Returns string describing command line options that change generated
+	scripts. Stored in manifest, so scripts are regenerated when they
+	change.
+	"""
+	return ",".join([ x for x in ("reduce", "declarative", "supervise")
+		if getattr(args, x) ])
+
+
+def convert_options(args):
+	""" Returns keyword arguments for convert function """
+	return dict(declarative=args.declarative, supervise=args.supervise)
+
+
+def parse_instances(names):
+	"""
+	Parses list of template instances, such as 'foo@bar' or
+	'foo@bar.service', into dict used by convert_all.
+	Throws ValueError if any name is not instance.
+	"""
+	rv = {}
+	for name in names:
+		if "." not in name:
+			name += ".service"
+		template, instance = split_instance(name)
+		if template is None:
+			raise ValueError("Not an instance of template unit: %s" % (name,))
+		rv.setdefault(template, []).append(instance)
+	return rv
 
 
 def main(argv):
@@ -47,6 +614,88 @@ def main(argv):
 			existing openrc scripts, but may update scripts generated by this
 			tool in past."""
 		)
+	parser.add_argument('--watch', action='store_true',
+		help="""work as auto mode, but keep running afterwards and convert
+			services again, or remove their scripts, as soon as their units
+			are changed or removed. Requires manifest."""
+		)
+	parser.add_argument('--analyze', action='store_true',
+		help="""go over all systemd units as auto mode does, but instead of
+			generating openrc scripts, print report about dependency
+			cycles, dangling dependencies and longest start-up chains of
+			converted services."""
+		)
+	parser.add_argument('--estimates', type=str, metavar="FILE",
+		help="""file with start-up time estimates used by --analyze; every
+			line should contain service name and number of seconds. Every
+			service without estimate is counted as one second."""
+		)
+	parser.add_argument('--chains', type=int, default=5, metavar="N",
+		help="""number of critical chains reported by --analyze."""
+		)
+	parser.add_argument('-j', '--jobs', type=int, default=None, metavar="N",
+		help="""number of worker processes used in auto mode. Defaults to
+			number of CPUs."""
+		)
+	parser.add_argument('--manifest', type=str, default=None, metavar="FILE",
+		help="""file where auto mode remembers what was converted, so
+			unchanged units can be skipped next time. Defaults to %s."""
+			% (MANIFEST,)
+		)
+	parser.add_argument('--no-manifest', action='store_true',
+		help="""don't use manifest in auto mode. Every unit is converted,
+			but no existing script is overwritten or removed."""
+		)
+	parser.add_argument('-d', '--declarative', action='store_true',
+		help="""where possible, generate scripts that only set variables
+			such as 'command' and 'command_args' and let openrc-run start
+			and stop service, instead of generating start() and stop()
+			functions."""
+		)
+	parser.add_argument('--supervise', action='store_true',
+		help="""start services that systemd restarts (Restart=always,
+			on-failure and so on) by supervise-daemon, which restarts them
+			when they exit."""
+		)
+	parser.add_argument('--instance', type=str, action='append', default=[],
+		metavar="UNIT",
+		help="""instance of template unit, such as 'foo@bar', to create
+			'foo.bar' symlink for, in addition to instances enabled in .wants
+			directories. May be used multiple times."""
+		)
+	parser.add_argument('--root', type=str, metavar="DIR",
+		help="""convert units of another system, such as mounted image,
+			with its root directory in DIR. Units are searched for and
+			scripts and manifest are written in default locations inside
+			of DIR."""
+		)
+	parser.add_argument('--tar-in', type=str, metavar="FILE",
+		help="""read units from tar archive of whole system image, which
+			may be compressed by gzip, bzip2 or zstd, instead of unit
+			directories. Use '-' for standard input. Archive is read as
+			stream and never unpacked. Requires --tar-out."""
+		)
+	parser.add_argument('--tar-out', type=str, metavar="FILE",
+		help="""convert all units as auto mode does, but write scripts and
+			symlinks for instances of templates into tar archive FILE,
+			compressed if name ends with .gz or .bz2, instead of %s. Use
+			'-' for standard output. Existing scripts are never
+			overwritten and manifest is not used."""
+			% (INIT_D,)
+		)
+	parser.add_argument('--reduce', action='store_true',
+		help="""in auto mode, remove 'after' and 'before' dependencies that
+			are already implied by other dependencies of converted services.
+			Requires converting all units every time."""
+		)
+	parser.add_argument('--stats', action='store_true',
+		help="""print time spent in each stage and number of converted,
+			skipped and failed units in auto mode."""
+		)
+	parser.add_argument('--stats-json', type=str, metavar="FILE",
+		help="""save same informations as --stats prints into FILE as JSON.
+			Use '-' for standard output."""
+		)
 	parser.add_argument('unit', type=str, nargs="?",
 		help="""input, systemd unit. Either full path to file or unit name with
 			or without suffix. If path is ommited, unit is searched in default
@@ -60,39 +709,87 @@ def main(argv):
 			""" % (INIT_D,)
 		)
 	args = parser.parse_args()
+	if args.jobs is not None and args.jobs < 1:
+		parser.error("number of jobs has to be at least 1")
+	try:
+		instances = parse_instances(args.instance)
+	except ValueError, e:
+		parser.error("%s" % (e,))
+	if args.tar_in and not args.tar_out:
+		parser.error("--tar-in requires --tar-out")
+	if args.tar_out and (args.watch or args.analyze or args.unit):
+		parser.error("--tar-out cannot be used with --watch, --analyze or single unit")
+	if args.tar_out and (args.reduce or args.jobs is not None):
+		# Archive is converted serially and without dependency graph
+		parser.error("--tar-out cannot be used with --reduce or --jobs")
+	if args.tar_out == "-" and args.stats_json == "-":
+		parser.error("--stats-json - cannot be used with --tar-out -")
+	root = args.root
+	unit_dirs = [ in_root(root, x) for x in UNIT_DIRS ]
+	init_d = in_root(root, INIT_D)
+	if args.manifest is None:
+		args.manifest = in_root(root, MANIFEST)
 	
 	# Parse parsed parameters
-	if args.auto:
-		# Convert all things
-		services = {}
-		# Scan all directories and collect services
-		for d in UNIT_DIRS:
-			if os.path.isdir(d):
-				for f in os.listdir(d):
-					if f.endswith(".service"):
-						path = os.path.join(d, f)
-						if os.path.isfile(path):
-							if f not in services:
-								services[f] = path
-		for service in services:
-			# Skip over some special stuff
-			skip = False
-			for word in AUTO_IGNORED:
-				if word in service:
-					skip = True
-					break
-			if skip: continue
-			# Convert single service
-			rc_filename = os.path.split(service)[-1]
-			rc_filename = rc_filename.split(".")[0]
-			rc_filename = os.path.join(INIT_D, rc_filename)
-			if not os.path.exists(rc_filename):
-				try:
-					convert_one(services[service], rc_filename)
-				except ValueError, e:
-					print >>sys.stderr, "Skipped %s: %s" % (service, e)
+	if args.tar_out:
+		stats = NULL_STATS
+		if args.stats or args.stats_json:
+			stats = Stats()
+		try:
+			if args.tar_in:
+				with stats.stage("scan"):
+					index = ArchiveIndex(sys.stdin if args.tar_in == "-"
+						else open(args.tar_in, "rb"))
+				exists = index.scripts.__contains__
 			else:
-				print >>sys.stderr, "Skipped %s: File exists" % (service,)
+				index = UnitIndex(unit_dirs, root)
+				exists = lambda name: os.path.lexists(os.path.join(init_d, name))
+			if args.tar_out == "-":
+				archive_all(index, sys.stdout, exists=exists, stats=stats,
+					options=convert_options(args), instances=instances)
+			else:
+				with open(args.tar_out, "wb") as f:
+					archive_all(index, f, exists=exists, stats=stats,
+						options=convert_options(args), instances=instances)
+		except (IOError, OSError), e:
+			print >>sys.stderr, "Failed to convert archive: %s" % (e,)
+			return 1
+		return report_stats(stats, args.stats, args.stats_json)
+	elif args.analyze:
+		estimates = {}
+		if args.estimates:
+			try:
+				estimates = load_estimates(open(args.estimates, "r"))
+			except (IOError, ValueError), e:
+				print >>sys.stderr, "Failed to load estimates: %s" % (e,)
+				return 1
+		graph = analyze_all(unit_dirs, args.jobs, root)
+		print graph.report(estimates, args.chains, RC_KNOWN_SERVICES)
+	elif args.watch:
+		if args.no_manifest:
+			parser.error("--watch cannot be used with --no-manifest")
+		manifest = Manifest(args.manifest, output_options(args))
+		try:
+			watch_all(unit_dirs, init_d, args.jobs, manifest=manifest,
+				reduce=args.reduce, options=convert_options(args), instances=instances,
+				root=root)
+		except OSError, e:
+			print >>sys.stderr, "Failed to watch unit directories: %s" % (e,)
+			return 1
+		except KeyboardInterrupt:
+			return 0
+	elif args.auto:
+		# Convert all things
+		manifest = None
+		if not args.no_manifest:
+			manifest = Manifest(args.manifest, output_options(args))
+		stats = NULL_STATS
+		if args.stats or args.stats_json:
+			stats = Stats()
+		convert_all(unit_dirs, init_d, args.jobs, manifest=manifest, stats=stats,
+			reduce=args.reduce, options=convert_options(args), instances=instances,
+			root=root)
+		return report_stats(stats, args.stats, args.stats_json)
 	else:
 		# Conver single unit
 		if args.unit is None:
@@ -100,31 +797,44 @@ def main(argv):
 			print >>sys.stderr, "%s: error: too few arguments" % (sys.argv[0])
 			sys.exit(1)
 		
+		dropins, socket = [], []
+		linked = []
 		if "/" in args.unit:
 			unit_filename = args.unit
+			socket_filename = os.path.splitext(unit_filename)[0] + ".socket"
+			if unit_filename.endswith(".service") and os.path.exists(socket_filename):
+				socket = [ socket_filename ]
 		else:
 			# Unit name without path was passed - search for it
-			unit_filename = None
-			for path in UNIT_DIRS:
-				for suffix in ("", ".service"):
-					fn = os.path.join(path, args.unit + suffix)
-					if os.path.exists(fn):
-						unit_filename = fn
-						break
-				if unit_filename : break
+			index = UnitIndex(unit_dirs, root)
+			unit_filename = index.lookup(args.unit)
+			if unit_filename:
+				service = os.path.split(unit_filename)[-1]
+				dropins, socket = unit_sources(index, service)
+				dropins = dropins[1:]
+			if index.is_masked(args.unit):
+				print >>sys.stderr, "Systemd unit is masked: %s" % (args.unit,)
+				return 1
 			if not unit_filename:
 				print >>sys.stderr, "Unknown systemd unit: %s" % (args.unit,)
 				return 1
+			template, instance = split_instance(args.unit if "." in args.unit
+				else args.unit + ".service")
+			if template is not None and template == service:
+				# Instance without unit file of its own, template is used
+				linked.append(instance)
 		
+		unit_name = os.path.split(unit_filename)[-1]
 		if args.rc_file is None:
-			rc_filename = os.path.split(unit_filename)[-1]
-			rc_filename = rc_filename.split(".")[0]
-			rc_filename = os.path.join(INIT_D, rc_filename)
+			rc_filename = os.path.join(init_d, rc_name(unit_name))
 		elif "/" in args.rc_file:
 			rc_filename = args.rc_file
 		else:
-			rc_filename = os.path.join(INIT_D, args.rc_file)
+			rc_filename = os.path.join(init_d, args.rc_file)
 		
 		# Wololo
-		convert_one(unit_filename, rc_filename)
+		if convert_one(unit_filename, rc_filename, dropins, convert_options(args),
+				socket, root) is None and is_template(unit_name):
+			link_instances(unit_name, rc_filename,
+				sorted(set(linked) | set(instances.get(unit_name, ()))))
 
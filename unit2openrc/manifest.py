@@ -0,0 +1,186 @@
+#!/usr/bin/env python2
+"""
+Unit2OpenRC - Manifest
+
+Remembers which unit files were converted into which rc scripts, so
+auto mode can skip units that were not changed since last run and remove
+scripts generated from units that no longer exist.
+"""
+from __future__ import unicode_literals
+from consts import *
+from . import write_if_changed
+import os, json, hashlib
+
+
+def sources_digest(filenames):
+	"""
+	Returns hex sha1 digest of content of all files, in order.
+	Throws IOError if any file cannot be read.
+	"""
+	h = hashlib.sha1()
+	for filename in filenames:
+		h.update(filename.encode('utf-8'))
+		h.update(b"\0")
+		with open(filename, "rb") as f:
+			h.update(f.read())
+		h.update(b"\0")
+	return h.hexdigest()
+
+
+def sockets_digest(sockets):
+	"""
+	Returns hex sha1 digest of dict of {socket name: service name}, as
+	returned by UnitIndex.socket_services.
+	"""
+	h = hashlib.sha1()
+	for name in sorted(sockets):
+		h.update(("%s\0%s\0" % (name, sockets[name])).encode('utf-8'))
+	return h.hexdigest()
+
+
+class Manifest(object):
+	"""
+	Maps unit name to dict with 'sources', 'digest', 'version', 'options'
+	and 'rc' keys. 'sources' is list of [path, mtime, size] for unit file
+	and all its drop-ins, 'digest' is digest of their content and 'rc' is
+	path to generated rc script, or None if unit failed to convert.
+	For template, optional 'links' key holds list of symlinks to rc script
+	created for its instances.
+	
+	'options' is string describing options that affect generated script.
+	Unit converted with different options is never considered unchanged.
+	Same goes for 'sockets', digest of socket units that dependencies on
+	sockets are resolved with, see sockets_digest.
+	"""
+	
+	def __init__(self, filename, options=""):
+		self.filename = filename
+		self.options = options
+		# Set by caller once units are indexed
+		self.sockets = None
+		self.units = {}
+		self.changed = False
+		try:
+			with open(filename, "r") as f:
+				data = json.load(f)
+			if type(data) == dict and type(data.get('units')) == dict:
+				self.units = data['units']
+		except IOError:
+			# No manifest yet
+			pass
+		except ValueError:
+			# Broken manifest, start from scratch
+			self.changed = True
+	
+	
+	def __contains__(self, name):
+		return name in self.units
+	
+	
+	def names(self):
+		""" Returns list of all unit names stored in manifest """
+		return list(self.units)
+	
+	
+	def rc_filename(self, name):
+		"""
+		Returns path to rc script generated from unit 'name', or None if
+		there is no such script.
+		"""
+		if name in self.units:
+			return self.units[name].get('rc')
+		return None
+	
+	
+	def links(self, name):
+		""" Returns list of symlinks created for instances of template 'name' """
+		if name in self.units:
+			return self.units[name].get('links') or []
+		return []
+	
+	
+	def set_links(self, name, links):
+		""" Stores list of symlinks created for instances of template 'name' """
+		if name in self.units and self.links(name) != links:
+			self.units[name]['links'] = links
+			self.changed = True
+	
+	
+	def is_unchanged(self, name, sources, stats):
+		"""
+		Returns True if 'sources' files (unit file and its drop-ins), with
+		already known stat results 'stats', are same as when unit 'name'
+		was converted last time.
+		
+		Files are read and hashed only if some file was touched, but no
+		size has changed.
+		"""
+		e = self.units.get(name)
+		if e is None or e.get('version') != VERSION or e.get('options') != self.options:
+			return False
+		if e.get('sockets') != self.sockets:
+			return False
+		if e.get('rc') is not None and not os.path.exists(e['rc']):
+			return False
+		known = e.get('sources') or []
+		if [ x[0] for x in known ] != sources:
+			return False
+		if [ x[2] for x in known ] != [ st.st_size for st in stats ]:
+			return False
+		if [ x[1] for x in known ] != [ st.st_mtime for st in stats ]:
+			try:
+				if sources_digest(sources) != e.get('digest'):
+					return False
+			except IOError:
+				return False
+			# Only touched, remember new mtimes
+			e['sources'] = self._sources(sources, stats)
+			self.changed = True
+		return True
+	
+	
+	def update(self, name, sources, stats, digest, rc_filename):
+		""" Stores (new) informations about unit 'name' """
+		links = self.links(name)
+		self.units[name] = dict(
+			sources = self._sources(sources, stats),
+			digest = digest,
+			version = VERSION,
+			options = self.options,
+			sockets = self.sockets,
+			rc = rc_filename,
+		)
+		if links:
+			self.units[name]['links'] = links
+		self.changed = True
+	
+	
+	@staticmethod
+	def _sources(sources, stats):
+		return [ [ path, st.st_mtime, st.st_size ]
+			for (path, st) in zip(sources, stats) ]
+	
+	
+	def sockets_changed(self):
+		""" Returns True if any unit was converted with different socket units """
+		return any([ e.get('sockets') != self.sockets for e in self.units.itervalues() ])
+	
+	
+	def remove(self, name):
+		""" Removes unit 'name' from manifest """
+		if name in self.units:
+			del self.units[name]
+			self.changed = True
+	
+	
+	def save(self):
+		""" Saves manifest, if anything was changed """
+		if not self.changed:
+			return
+		d = os.path.dirname(self.filename)
+		if d and not os.path.isdir(d):
+			os.makedirs(d)
+		data = json.dumps(dict(version=VERSION, units=self.units),
+			indent=1, sort_keys=True)
+		write_if_changed(self.filename, data, 0644)
+		self.changed = False
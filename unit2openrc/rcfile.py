@@ -6,28 +6,95 @@ Holds and writes rc file data.
 Cannot load already existing file.
 """
 from __future__ import unicode_literals
-from . import ServiceConfig, Command
+from . import ServiceConfig, Command, Diagnostic
 from unitfile import UnitFile
+from template import Template, quote, quote_arg
 from consts import *
-from cStringIO import StringIO
 import os
 
+
+def _start_template(wait=""):
+	return Template("start() {\n\t%s @message@\n\t@command@\n%s@result@}\n\n"
+		% (EBEGIN, wait))
+
+# Skeletons of start() function for every service type. Only 'command'
+# is different for simple and forking services.
+START_TEMPLATES = {
+	ST_SIMPLE	: _start_template(),
+	ST_FORKING	: _start_template(),
+	ST_NOTIFY	: _start_template(),
+	ST_DBUS		: _start_template(
+		"\t%s @bus_name@\n" % (DBUS_SERVICE_WAIT,) +
+		"\tif [ $? -ne 0 ] ; then\n"
+		"\t\t# ensure service is killed if it fails to acquire dbus name\n"
+		"\t\tkill -9 $(cat @pidfile@)\n"
+		"\t\t%s 1\n" % (EEND,) +
+		"\t\treturn 1\n"
+		"\tfi\n"
+		"\ttrue\n"
+	),
+}
+STOP_TEMPLATE = Template("stop() {\n\t%s @message@\n@commands@@result@}\n\n" % (EBEGIN,))
+RELOAD_TEMPLATE = Template("reload() {\n\t%s @message@\n@commands@\t%s @status@\n}\n\n"
+	% (EBEGIN, EEND))
+# Used for start_pre and stop_pre functions, and for start_post and
+# stop_post when openrc-run starts and stops daemon by itself
+PRE_TEMPLATE = Template("@name@() {\n@commands@\treturn 0\n}\n\n")
+# Starts start_pre function of template, which has to be started through
+# symlink named after instance
+TEMPLATE_CHECK = Template(
+	"\tif [ \"${RC_SVCNAME}\" = @name@ ] ; then\n"
+	"\t\teerror @message@\n"
+	"\t\treturn 1\n"
+	"\tfi\n")
+# Ends start() or stop() function when there is nothing to do after daemon
+# is started or stopped...
+RESULT = "\t%s $?\n" % (EEND,)
+# ... and when there are ExecStartPost or ExecStopPost commands.
+POST_TEMPLATE = Template(
+	"\tif [ $? -eq 0 ] ; then\n"
+	"@commands@"
+	"\t\t%s 0\n"
+	"\telse\n"
+	"\t\t%s 1\n"
+	"\tfi\n" % (EEND, EEND))
+
 class RCFile(ServiceConfig):
-	def __init__(self, shortname):
-		ServiceConfig.__init__(self)
+	__slots__ = ( 'shortname', 'template', 'variables', 'pidfile', 'type', 'description', 'start',
+		'start_post', 'stop', 'stop_post', 'start_pre', 'stop_pre', 'reload', 'bus_name',
+		'need', 'want', 'after', 'before', 'env', 'command', 'command_args',
+		'command_background', 'supervisor', 'respawn_delay', 'respawn_max',
+		'respawn_period', 'daemon_options', 'ulimit', 'cgroup_settings',
+		'diagnostics' )
+	
+	def __init__(self, shortname, template=False):
 		self.shortname = shortname
-		self.pidfile = os.path.join(RUN_D, shortname + ".pid")
+		# If template is True, script is multiplexed and started through
+		# symlinks named 'shortname.instance'
+		self.template = template
+		# List of (name, value) shell variables set on top of rc file.
+		# Values are used as they are, so they have to be quoted
+		self.variables = []
+		self.pidfile = os.path.join(RUN_D, self.svcname() + ".pid")
 		self.type = ST_FORKING
 		self.description = "Description not set"
-		# start and stop are lists of commands executed when starting or
-		# stopping service; commands are specified as lists of arguments,
-		# so both start and stop contains list of lists
-		self.start = []
-		self.stop  = []
-		# start_pre and stop_pre are in same format as start and stop,
-		# but used in different function
+		# start is Command starting daemon, start_post list of Commands
+		# executed after it succeeds. If start is None, start() function
+		# is not generated.
+		self.start = None
+		self.start_post = []
+		# stop is list of Commands stopping daemon, stop_post list of
+		# Commands executed after they succeed
+		self.stop = []
+		self.stop_post = []
+		# Commands executed by start_pre and stop_pre functions
 		self.start_pre = []
 		self.stop_pre = []
+		# Commands executed by reload() function, available as extra
+		# command of started service. Function is not generated if empty.
+		self.reload = []
+		# For dbus services, name that daemon has to acquire
+		self.bus_name = None
 		# see man openrc-run for these
 		self.need = []
 		self.want = []
@@ -35,6 +102,40 @@ class RCFile(ServiceConfig):
 		self.before = []
 		# env contains environment variables set on top of rc file
 		self.env = {}
+		# If command is set, start and stop are left empty and openrc-run
+		# starts and stops daemon by itself. See man openrc-run for these
+		self.command = None
+		self.command_args = []
+		self.command_background = False
+		# If supervisor is set, daemon started from command is restarted by
+		# it when it exits. respawn_* are strings or None
+		self.supervisor = None
+		self.respawn_delay = None
+		self.respawn_max = None
+		self.respawn_period = None
+		# Additional start-stop-daemon options, such as --nicelevel
+		self.daemon_options = []
+		# Arguments for ulimit, set as rc_ulimit
+		self.ulimit = []
+		# List of (name, value) cgroup settings, set as rc_cgroup_settings
+		self.cgroup_settings = []
+		# Warnings produced while converting, list of Diagnostic instances
+		self.diagnostics = []
+	
+	
+	def svcname(self):
+		"""
+		Returns name of service as used in scripts; for template, that's
+		reference to RC_SVCNAME, which holds name of symlink.
+		"""
+		if self.template:
+			return RC_SVCNAME_REF
+		return self.shortname
+	
+	
+	def warn(self, message):
+		""" Records warning about something that couldn't be converted """
+		self.diagnostics.append(Diagnostic(WARNING, message))
 	
 	
 	def write(self, outfileobj, source_file_name="unknown file"):
@@ -43,54 +144,131 @@ class RCFile(ServiceConfig):
 		source_file_name is used only in comment string and doesn't actually
 		affect anything.
 		"""
-		o = StringIO()
+		outfileobj.write(self.render(source_file_name))
+	
+	
+	def render(self, source_file_name="unknown file"):
+		""" Returns rc script as utf-8 encoded byte string """
+		o = []
+		# Values of template may refer to variables set from RC_SVCNAME
+		q = quote_arg if self.template else quote
 		
 		# Output header
-		o.write(RC_HEADER % dict(
+		o.append(RC_HEADER % dict(
 			source_file_name = source_file_name,
 			unit2openrc = "Unit2OpenRC"
 		))
 		
 		# Output PID file and environment variables
+		for v in self.variables:
+			o.append("%s=%s\n" % v)
 		for v in self.env:
-			val = self.env[v]
-			if " " in val:
-				val = '"%s"' % (val.encode('unicode_escape').replace('"', '\\"'),)
-			o.write("export %s=%s\n" % (v, val))
-		o.write("pidfile=%s\n" % (self.pidfile))
-		o.write("\n")
+			o.append("export %s=%s\n" % (v, q(self.env[v])))
+		if self.command is not None:
+			o.append("description=%s\n" % (q(self.description),))
+			o.append("command=%s\n" % (q(self.command),))
+			if len(self.command_args):
+				o.append("command_args=%s\n" % (quote(
+					Command(*self.command_args).to_string()),))
+			if self.command_background:
+				o.append("command_background=true\n")
+			if self.supervisor is not None:
+				o.append("supervisor=%s\n" % (quote(self.supervisor),))
+				for kind in ('respawn_delay', 'respawn_max', 'respawn_period'):
+					if getattr(self, kind) is not None:
+						o.append("%s=%s\n" % (kind, quote(getattr(self, kind))))
+			if len(self.daemon_options):
+				o.append("%s_args=%s\n" % (
+					"supervise_daemon" if self.supervisor else "start_stop_daemon",
+					quote(Command(*self.daemon_options).to_string())))
+		if len(self.ulimit):
+			o.append("rc_ulimit=%s\n" % (quote(" ".join(self.ulimit)),))
+		if len(self.cgroup_settings):
+			o.append("rc_cgroup_settings=%s\n" % (quote("\n".join([
+				"%s %s" % x for x in self.cgroup_settings ])),))
+		if len(self.reload):
+			o.append("extra_started_commands=%s\n" % (quote("reload"),))
+		o.append("pidfile=%s\n" % (q(self.pidfile),))
+		o.append("\n")
 		
 		# Oputput depend function if needed
 		depend = []
-		if len(self.need):   depend.append(Command( 'need',   *self.need))
-		if len(self.want):   depend.append(Command( 'want',   *self.want))
-		if len(self.after):  depend.append(Command( 'after' , *self.after))
-		if len(self.before): depend.append(Command( 'before', *self.before))
+		for kind in ('need', 'want', 'after', 'before'):
+			names = getattr(self, kind)
+			if len(names):
+				depend.append("\t%s %s\n" % (kind, " ".join([ q(x) for x in names ])))
 		if len(depend):
-			RCFile.output_function(o, 'depend', depend)
+			o.append("depend() {\n%s}\n\n" % ("".join(depend),))
 		
 		# Outuput start_pre and stop_pre functions, if needed
-		if len(self.start_pre):
-			RCFile.output_function(o, 'start_pre', self.start_pre)
+		if self.template:
+			o.append(PRE_TEMPLATE.render(name="start_pre",
+				commands = TEMPLATE_CHECK.render(
+					name = quote(self.shortname),
+					message = quote(TEMPLATE_NOT_STARTED % (self.shortname, self.shortname)),
+				) + RCFile.commands(self.start_pre, 1)))
+		elif len(self.start_pre):
+			o.append(PRE_TEMPLATE.render(name="start_pre",
+				commands=RCFile.commands(self.start_pre, 1)))
 		if len(self.stop_pre):
-			RCFile.output_function(o, 'stop_pre', self.stop_pre)
+			o.append(PRE_TEMPLATE.render(name="stop_pre",
+				commands=RCFile.commands(self.stop_pre, 1)))
+		if self.start is None and len(self.start_post):
+			o.append(PRE_TEMPLATE.render(name="start_post",
+				commands=RCFile.commands(self.start_post, 1)))
+		if not len(self.stop) and len(self.stop_post):
+			o.append(PRE_TEMPLATE.render(name="stop_post",
+				commands=RCFile.commands(self.stop_post, 1)))
 		
-		# Outuput start and stop functions
-		RCFile.output_function(o, 'start', self.start)
-		RCFile.output_function(o, 'stop', self.stop)
+		# Outuput start and stop functions, if not left to openrc-run
+		if self.start is not None:
+			o.append(START_TEMPLATES[self.type].render(
+				message = q(STARTING % (self.description, self.svcname())),
+				command = self.start.to_string(),
+				bus_name = q(self.bus_name or ""),
+				pidfile = q(self.pidfile),
+				result = RCFile.result(self.start_post)))
+		if len(self.stop):
+			o.append(STOP_TEMPLATE.render(
+				message = q(STOPPING % (self.description, self.svcname())),
+				commands = RCFile.commands(self.stop, 1, False),
+				result = RCFile.result(self.stop_post)))
+		if len(self.reload):
+			# Result of last command is result of whole function
+			last = self.reload[-1]
+			o.append(RELOAD_TEMPLATE.render(
+				message = q(RELOADING % (self.description, self.svcname())),
+				commands = RCFile.commands(self.reload[0:-1], 1,
+					fail="{ %s 1; return 1; }" % (EEND,))
+					+ "\t%s\n" % (last.to_string(),),
+				status = "0" if last.ignore_failure else "$?"))
 		
-		outfileobj.write(o.getvalue().encode('utf-8'))
+		return "".join(o).encode('utf-8')
 	
 	
 	@staticmethod
-	def output_function(o, name, commands):
-		""" Writes bash function 'name' into file-like object 'o' """
-		o.write('%s() {\n' % (name,))
-		for c in commands:
-			o.write("\t")
-			o.write(c.to_string())
-			o.write("\n")
-		o.write('}\n\n')
+	def commands(commands, indent, check=True, fail="return 1"):
+		"""
+		Returns commands as lines indented by 'indent' tabs. If 'check' is
+		True, 'fail' is executed when command that may not fail fails.
+		"""
+		prefix = "\t" * indent
+		if check:
+			return "".join([ "%s%s\n" % (prefix, c.to_string())
+				if c.ignore_failure else "%s%s || %s\n" % (prefix, c.to_string(), fail)
+				for c in commands ])
+		return "".join([ "%s%s\n" % (prefix, c.to_string()) for c in commands ])
+	
+	
+	@staticmethod
+	def result(post):
+		"""
+		Returns end of start() or stop() function, executing 'post' commands
+		if daemon was started or stopped successfully.
+		"""
+		if len(post):
+			return POST_TEMPLATE.render(commands=RCFile.commands(post, 2))
+		return RESULT
 	
 	
 	def __str__(self):
@@ -101,11 +279,12 @@ class StartStopDaemon(Command):
 	"""
 	Holds data for start-stop-daemon command.
 	"""
-	def __init__(self, daemon_command, pidfile, start, forking=False):
+	def __init__(self, daemon_command, pidfile, start, forking=False, options=()):
 		"""
 		daemon_command has to be Command instance.
 		Generates -S (start) command if start is True; Othewise
-		generates -K (kill) command.
+		generates -K (kill) command. 'options' are added to -S command
+		before daemon arguments.
 		"""
 		Command.__init__(self)
 		if not start:
@@ -115,15 +294,16 @@ class StartStopDaemon(Command):
 			daemon_args = daemon_command.args
 			daemon_args = [ daemon_args[0], "--" ] + daemon_args[1:]
 			if forking:
-				self.args = [ START_STOP_DAEMON, '-S' ] + daemon_args
+				self.args = [ START_STOP_DAEMON, '-S' ] + list(options) + daemon_args
 			else:
-				self.args = [ START_STOP_DAEMON, '-S', '-b', '-m', '-p',
-					pidfile, '-x' ] + daemon_args
+				self.args = ( [ START_STOP_DAEMON, '-S', '-b', '-m', '-p', pidfile ]
+					+ list(options) + [ '-x' ] + daemon_args )
 			
 	
 	@staticmethod
-	def start(daemon_command, pidfile, forking=False):
-		return StartStopDaemon(daemon_command, pidfile, True, forking=forking)
+	def start(daemon_command, pidfile, forking=False, options=()):
+		return StartStopDaemon(daemon_command, pidfile, True, forking=forking,
+			options=options)
 	
 	@staticmethod
 	def stop(pidfile, forking=False):
@@ -136,5 +316,5 @@ if __name__ == "__main__":
 	import sys, pprint
 	u = UnitFile(sys.argv[1])
 	print u
-	pprint.pprint(u.values)
+	pprint.pprint(u.to_dict())
 
@@ -0,0 +1,142 @@
+#!/usr/bin/env python2
+"""
+Unit2OpenRC - Stats
+
+Collects time spent in individual conversion stages and various counters.
+"""
+from __future__ import unicode_literals
+import time
+
+# Stages, in order in which they are reported
+STAGES = ( "scan", "parse", "convert", "render", "write" )
+
+
+class Stats(object):
+	"""
+	Collects wall time spent in each stage and counters, such as number of
+	converted or skipped units.
+	
+	Callables added by add_hook are called as hook(kind, name, value) every
+	time when something is recorded, where kind is one of "time", "count"
+	or "skip".
+	"""
+	
+	def __init__(self):
+		self.times = {}
+		self.counters = {}
+		self.skipped = {}
+		self.hooks = []
+		self.started = time.time()
+	
+	
+	def stage(self, name):
+		"""
+		Returns context manager that adds time spent inside 'with' block
+		to stage 'name'.
+		"""
+		return _Timer(self, name)
+	
+	
+	def add_time(self, name, seconds):
+		""" Adds seconds to time spent in stage 'name' """
+		self.times[name] = self.times.get(name, 0.0) + seconds
+		for h in self.hooks: h("time", name, seconds)
+	
+	
+	def count(self, name, n=1):
+		""" Increases counter 'name' by n """
+		self.counters[name] = self.counters.get(name, 0) + n
+		for h in self.hooks: h("count", name, n)
+	
+	
+	def skip(self, reason):
+		""" Counts unit skipped because of 'reason' """
+		self.skipped[reason] = self.skipped.get(reason, 0) + 1
+		for h in self.hooks: h("skip", reason, 1)
+	
+	
+	def add_hook(self, hook):
+		""" Registers callable called every time when anything is recorded """
+		self.hooks.append(hook)
+	
+	
+	def merge_times(self, times):
+		""" Adds times from dict returned by another (worker) instance """
+		for name in times:
+			self.add_time(name, times[name])
+	
+	
+	def to_dict(self):
+		""" Returns everything collected as dict that can be dumped as JSON """
+		return dict(
+			total = time.time() - self.started,
+			stages = dict(self.times),
+			counters = dict(self.counters),
+			skipped = dict(self.skipped),
+		)
+	
+	
+	def summary(self):
+		""" Returns human-readable summary """
+		d = self.to_dict()
+		lines = [ "Total time: %.3fs" % (d['total'],) ]
+		for name in STAGES + tuple(sorted(set(self.times) - set(STAGES))):
+			if name in self.times:
+				lines.append("  %-10s %9.3fs" % (name, self.times[name]))
+		for name in sorted(self.counters):
+			lines.append("%s: %s" % (name.replace("_", " ").capitalize(),
+				self.counters[name]))
+		if self.skipped:
+			lines.append("Skipped: %s (%s)" % (sum(self.skipped.values()),
+				", ".join([ "%s: %s" % (k, self.skipped[k])
+					for k in sorted(self.skipped) ])))
+		return "\n".join(lines)
+
+
+class NullStats(Stats):
+	"""
+	Used when stats are disabled. Records nothing and costs (almost)
+	nothing.
+	"""
+	
+	def __init__(self):
+		Stats.__init__(self)
+	
+	def stage(self, name):
+		return _NULL_TIMER
+	
+	def add_time(self, name, seconds):
+		pass
+	
+	def count(self, name, n=1):
+		pass
+	
+	def skip(self, reason):
+		pass
+	
+	def add_hook(self, hook):
+		raise TypeError("Cannot add hook to disabled stats")
+
+
+class _Timer(object):
+	def __init__(self, stats, name):
+		self.stats, self.name = stats, name
+	
+	def __enter__(self):
+		self.t = time.time()
+		return self
+	
+	def __exit__(self, *a):
+		self.stats.add_time(self.name, time.time() - self.t)
+
+
+class _NullTimer(object):
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, *a):
+		pass
+
+
+_NULL_TIMER = _NullTimer()
+NULL_STATS = NullStats()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python2
+"""
+Unit2OpenRC - Templates
+
+Shell quoting and precompiled script templates used by RCFile.
+"""
+from __future__ import unicode_literals
+import re
+
+# Matches any character that needs quoting anywhere in shell word
+UNSAFE_RE = re.compile(r'[^a-zA-Z0-9@%+=:,./_-]')
+# Matches any character that keeps special meaning inside double quotes
+DOUBLE_QUOTE_SPECIAL_RE = re.compile(r'[$`"\\]')
+# ${NAME} reference, expanded as single word, or $$, which is literal $
+REFERENCE_RE = re.compile(r'\$(?:\$|\{([A-Za-z_][A-Za-z0-9_]*)\})')
+# $NAME as word of its own, expanded and split at whitespace
+WORD_VARIABLE_RE = re.compile(r'^\$[A-Za-z_][A-Za-z0-9_]*$')
+# @name@ placeholder in template
+FIELD_RE = re.compile(r'@([a-z_]+)@')
+
+
+def quote(value):
+	"""
+	Returns value quoted so shell reads it back as single word with exactly
+	same content. Values that don't need quoting are returned unchanged.
+	"""
+	if value and not UNSAFE_RE.search(value):
+		return value
+	if DOUBLE_QUOTE_SPECIAL_RE.search(value):
+		return "'%s'" % (value.replace("'", "'\\''"),)
+	return '"%s"' % (value,)
+
+
+# Cache of already quoted command arguments. Most of arguments, such as
+# start-stop-daemon options, are same for many services.
+_quoted_args = {}
+
+def quote_arg(value):
+	"""
+	Works as quote, but keeps environment variable references expanded as
+	systemd expands them in Exec* options; $NAME as word of its own is
+	split at whitespace, ${NAME} is substituted as part of word and $$
+	stands for literal $. Every distinct value is quoted only once.
+	"""
+	try:
+		return _quoted_args[value]
+	except KeyError:
+		pass
+	if "$" not in value:
+		rv = quote(value)
+	elif WORD_VARIABLE_RE.match(value):
+		rv = value
+	else:
+		# Split value into literal parts and names of variables between them
+		literals, names, literal, pos = [], [], [], 0
+		for m in REFERENCE_RE.finditer(value):
+			literal.append(value[pos:m.start()])
+			if m.group(1) is None:
+				literal.append("$")
+			else:
+				literals.append("".join(literal))
+				names.append(m.group(1))
+				literal = []
+			pos = m.end()
+		literal.append(value[pos:])
+		literals.append("".join(literal))
+		if not names:
+			rv = quote(literals[0])
+		elif (not any([ DOUBLE_QUOTE_SPECIAL_RE.search(x) for x in literals ])
+				and any([ UNSAFE_RE.search(x) for x in literals ])):
+			# Whole word fits into single pair of double quotes
+			rv = '"%s"' % ("".join([ "%s${%s}" % x for x in zip(literals, names) ])
+				+ literals[-1],)
+		else:
+			rv = []
+			for literal, name in zip(literals, names):
+				if literal:
+					rv.append(quote(literal))
+				rv.append('"${%s}"' % (name,))
+			if literals[-1]:
+				rv.append(quote(literals[-1]))
+			rv = "".join(rv)
+	_quoted_args[value] = rv
+	return rv
+
+
+class Template(object):
+	"""
+	Fixed script skeleton with @name@ placeholders.
+	
+	Skeleton is compiled into format string once, so rendering is single
+	string formatting operation. Values are inserted as they are, so
+	anything that comes from unit has to be quoted in advance.
+	"""
+	
+	def __init__(self, text):
+		self.format = FIELD_RE.sub(r'%(\1)s', text.replace("%", "%%"))
+	
+	
+	def render(self, **values):
+		"""
+		Returns skeleton with placeholders replaced by values.
+		Throws KeyError if value for any placeholder is missing.
+		"""
+		return self.format % values
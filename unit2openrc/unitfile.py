@@ -7,58 +7,287 @@ Loads and holds data from systemd unit file.
 from __future__ import unicode_literals
 from . import ServiceConfig
 from consts import *
-from collections import OrderedDict
-import re, ConfigParser
+import os, re
+
+# Directives that are understood by converter, as (name, is_list, default).
+# Values of list directives are always lists, in order of assignment;
+# other directives hold last assigned value, or default if not assigned.
+DIRECTIVES = (
+	# [Unit]
+	( 'description',				False,	None ),
+	( 'after',						True,	None ),
+	( 'before',						True,	None ),
+	( 'requires',					True,	None ),
+	( 'wants',						True,	None ),
+	( 'start_limit_interval_sec',	False,	None ),
+	( 'start_limit_burst',			False,	None ),
+	# [Service]
+	( 'type',						False,	ST_SIMPLE ),
+	( 'pidfile',					False,	None ),
+	( 'bus_name',					False,	None ),
+	( 'environment',				True,	None ),
+	( 'exec_start_pre',				True,	None ),
+	( 'exec_start',					True,	None ),
+	( 'exec_start_post',			True,	None ),
+	( 'exec_stop_pre',				True,	None ),
+	( 'exec_stop',					True,	None ),
+	( 'exec_stop_post',				True,	None ),
+	( 'exec_reload',				True,	None ),
+	( 'timeout_sec',				False,	None ),
+	( 'timeout_start_sec',			False,	None ),
+	( 'restart',					False,	None ),
+	( 'restart_sec',				False,	None ),
+	( 'start_limit_interval',		False,	None ),
+	( 'watchdog_sec',				False,	None ),
+	( 'nice',						False,	None ),
+	( 'ioscheduling_class',			False,	None ),
+	( 'ioscheduling_priority',		False,	None ),
+	( 'cpuscheduling_policy',		False,	None ),
+	( 'cpuscheduling_priority',		False,	None ),
+	( 'cpuaffinity',				True,	None ),
+	( 'limit_cpu',					False,	None ),
+	( 'limit_fsize',				False,	None ),
+	( 'limit_data',					False,	None ),
+	( 'limit_stack',				False,	None ),
+	( 'limit_core',					False,	None ),
+	( 'limit_rss',					False,	None ),
+	( 'limit_nofile',				False,	None ),
+	( 'limit_as',					False,	None ),
+	( 'limit_memlock',				False,	None ),
+	( 'memory_min',					False,	None ),
+	( 'memory_low',					False,	None ),
+	( 'memory_high',				False,	None ),
+	( 'memory_max',					False,	None ),
+	( 'memory_limit',				False,	None ),
+	( 'memory_swap_max',			False,	None ),
+	( 'cpuquota',					False,	None ),
+	( 'cpuquota_period_sec',		False,	None ),
+	( 'cpuweight',					False,	None ),
+	( 'ioweight',					False,	None ),
+	( 'tasks_max',					False,	None ),
+	( 'allowed_cpus',				False,	None ),
+	# [Socket]
+	( 'listen_stream',				True,	None ),
+	( 'listen_datagram',			True,	None ),
+	( 'listen_sequential_packet',	True,	None ),
+	( 'listen_fifo',				True,	None ),
+	( 'listen_special',				True,	None ),
+	( 'listen_netlink',				True,	None ),
+	( 'listen_message_queue',		True,	None ),
+	( 'listen_usb_function',		True,	None ),
+	( 'accept',						False,	None ),
+	( 'socket_mode',				False,	None ),
+	( 'file_descriptor_name',		False,	None ),
+)
+# Directives that have no meaning for OpenRC and are ignored without warning
+IGNORED_DIRECTIVES = frozenset((
+	'documentation', 'default_dependencies', 'ignore_on_isolate',
+	'allow_isolate', 'cpuaccounting', 'memory_accounting', 'tasks_accounting',
+	'ioaccounting',
+))
+# Maps directive name to (is_list, default)
+SCHEMA = { name : (is_list, default) for (name, is_list, default) in DIRECTIVES }
+
 
 class UnitFile(ServiceConfig):
+	"""
+	Systemd unit. Every directive from DIRECTIVES is available as
+	attribute, other directives are only recorded in 'unknown' list.
+	"""
+	__slots__ = tuple([ d[0] for d in DIRECTIVES ]) + ( 'unknown', )
 	CAMEL = re.compile('^([^a-z]*[a-z0-9]*_?)(.*)')
 	# UnitFile() throws ValueError if any if these fields is missing
 	REQUIRED_FIELDS = ( 'description', 'exec_start' )
 	IGNORED_SECTIONS = ( 'Install', )
+	# Unknown directives are reported only in these sections
+	KNOWN_SECTIONS = ( 'Unit', 'Service', 'Socket' )
 	
-	def __init__(self, fileobj):
-		ServiceConfig.__init__(self)
-		# Parse unit file
-		cp = UnitFileParser()
-		cp.readfp(fileobj)
-		
-		# Copy data
-		for s in cp.sections():
-			if s not in self.IGNORED_SECTIONS:
-				for o in cp.options(s):
-					v = cp.get(s, o)
-					if "\n" in v: v = v.split("\n")
-					self.values[o] = v
-		
-		# Add default values
-		if 'type' not in self.values:
-			self.type = ST_SIMPLE	# Systemd default
-		
-		# Check required fields and values
+	def __init__(self, fileobj=None, layers=()):
+		"""
+		Loads unit from file object, or from list of already parsed layers
+		(see load_layer) applied in given order.
+		"""
+		for name, is_list, default in DIRECTIVES:
+			setattr(self, name, [] if is_list else default)
+		# List of (section, option) for directives that are not in schema
+		self.unknown = []
+		if fileobj is not None:
+			# Parse unit file
+			layers = [ UnitFileParser().parse(fileobj) ] + list(layers)
+		for layer in layers:
+			for section, option, value in layer:
+				if section not in self.IGNORED_SECTIONS:
+					self.assign(section, option, value)
+		self.finish()
+	
+	
+	@classmethod
+	def load(cls, filename, dropins=()):
+		"""
+		Loads unit from file, with drop-in files applied on top of it.
+		Parsed files are cached, see load_layer.
+		"""
+		return cls(layers = [ load_layer(x) for x in [ filename ] + list(dropins) ])
+	
+	
+	def assign(self, section, option, value):
+		"""
+		Applies single 'Option=value' assignment, using same rules as
+		systemd does.
+		"""
+		try:
+			is_list, default = SCHEMA[option]
+		except KeyError:
+			if (section in self.KNOWN_SECTIONS and option not in IGNORED_DIRECTIVES
+					and not option.startswith("x-")
+					and ( section, option ) not in self.unknown):
+				self.unknown.append(( section, option ))
+			return
+		if value == "":
+			# Empty assignment resets option to default
+			setattr(self, option, [] if is_list else default)
+		elif is_list:
+			getattr(self, option).append(value)
+		else:
+			setattr(self, option, value)
+	
+	
+	def finish(self):
+		"""
+		Called after all assignments are applied. Throws ValueError if unit
+		is not valid.
+		"""
 		for o in self.REQUIRED_FIELDS:
-			if o not in self.values:
+			if o not in self:
 				raise ValueError("Required field missing: %s" % (o,))
 		if self.type not in SYSTEMD_SERVICE_TYPES:
 			raise ValueError("Invalid service type: %s" % (self.type,))
+		if self.type != ST_ONESHOT and len(self.exec_start) > 1:
+			raise ValueError("Multiple ExecStart= options are allowed only for oneshot services")
 		if self.type == ST_DBUS:
 			if "bus_name" not in self:
 				raise ValueError("DBus service without BusName specified")
+	
+	
+	def to_dict(self):
+		""" Returns dict with all directives that are set """
+		return { name : getattr(self, name) for name in SCHEMA if name in self }
 
 
-class UnitFileParser(ConfigParser.RawConfigParser):
+class SocketUnitFile(UnitFile):
 	"""
-	Extends RawConfigParser for parsing Unit files,
-	PLUS, converts CamelCase fields into lower_case_with_underscores.
+	Socket unit, used to start service activated by it.
+	Whether socket can be used is decided when service is converted, so
+	nothing is required here.
+	
+	'listen_order' lists name of Listen* option for every address in order
+	in which they were assigned, as systemd passes sockets to service in
+	that order.
 	"""
-	def __init__(self):
-		ConfigParser.RawConfigParser.__init__(self,
-				dict_type=UnitFileParser.MultiValueDict)
+	__slots__ = ( 'listen_order', )
+	REQUIRED_FIELDS = ( )
+	
+	def __init__(self, fileobj=None, layers=()):
+		self.listen_order = []
+		UnitFile.__init__(self, fileobj, layers)
+	
+	
+	def assign(self, section, option, value):
+		UnitFile.assign(self, section, option, value)
+		if option.startswith("listen_") and option in SCHEMA:
+			if value == "":
+				self.listen_order = [ x for x in self.listen_order if x != option ]
+			else:
+				self.listen_order.append(option)
+	
+	
+	def finish(self):
+		pass
+
+
+# Cache used by load_layer; maps path to (mtime, size, assignments) tuple
+_layer_cache = {}
+
+def load_layer(filename):
+	"""
+	Parses unit or drop-in file and returns tuple of all (section, option,
+	value) assignments found in it.
+	
+	Result is cached for as long as file mtime and size stays same, so file
+	shared by many units, such as drop-in applied to all services, is
+	parsed only once.
+	"""
+	st = os.stat(filename)
+	if filename in _layer_cache:
+		mtime, size, layer = _layer_cache[filename]
+		if mtime == st.st_mtime and size == st.st_size:
+			return layer
+	with open(filename, "r") as f:
+		layer = tuple(UnitFileParser().parse(f))
+	_layer_cache[filename] = (st.st_mtime, st.st_size, layer)
+	return layer
+
+
+class UnitFileParser(object):
+	"""
+	Streaming parser for systemd unit file syntax.
+	Yields (section, option, value) for every assignment found, converting
+	CamelCase option names into lower_case_with_underscores.
+	"""
+	COMMENTS = ( "#", ";" )
+	# Cache of already converted option names, shared by all instances,
+	# and same mapping in other direction
+	_option_names = {}
+	_original_names = {}
+	
+	def parse(self, fileobj):
+		"""
+		Yields (section, option, value) for every assignment in file.
+		
+		Lines ending with backslash are joined with next line, comment lines
+		inside such continuation are skipped. As in systemd, assignments
+		outside of any section and lines without '=' are ignored.
+		"""
+		section = None
+		continued = None
+		for line in fileobj:
+			if type(line) != unicode:
+				line = line.decode('utf-8')
+			line = line.strip()
+			if continued is not None:
+				if line.startswith(self.COMMENTS):
+					continue
+				line = continued + line
+				continued = None
+			elif not line or line.startswith(self.COMMENTS):
+				continue
+			if line.endswith("\\"):
+				continued = line[0:-1] + " "
+				continue
+			if line.startswith("["):
+				if line.endswith("]"):
+					section = line[1:-1]
+				continue
+			if section is None or "=" not in line:
+				continue
+			option, value = line.split("=", 1)
+			yield section, self.optionxform(option.strip()), value.strip()
+		if continued is not None and section is not None and "=" in continued:
+			# File ends in middle of continuation
+			option, value = continued.split("=", 1)
+			yield section, self.optionxform(option.strip()), value.strip()
 	
 	
 	def optionxform(self, n):
 		"""
-		Converts option name from CamelCase to lower_case_with_underscores
+		Converts option name from CamelCase to lower_case_with_underscores.
+		Every distinct name is converted only once.
 		"""
+		try:
+			return self._option_names[n]
+		except KeyError:
+			pass
+		key = n
 		words = []
 		while len(n):
 			m = UnitFile.CAMEL.match(n)
@@ -66,15 +295,18 @@ class UnitFileParser(ConfigParser.RawConfigParser):
 			word, n = m.groups()
 			if word.endswith("_"): word = word[0:-1]
 			words.append(word.lower())
-		return "_".join(words)
+		self._option_names[key] = rv = "_".join(words)
+		self._original_names.setdefault(rv, key)
+		return rv
 	
 	
-	class MultiValueDict(OrderedDict):
-		def __setitem__(self, k, v):
-			if isinstance(v, list) and k in self:
-				self[k].extend(v)
-			else:
-				OrderedDict.__setitem__(self, k, v)
+	@staticmethod
+	def original_name(option):
+		"""
+		Returns option name as it was written in unit file, for option
+		name returned by optionxform.
+		"""
+		return UnitFileParser._original_names.get(option, option)
 
 
 if __name__ == "__main__":
@@ -83,4 +315,4 @@ if __name__ == "__main__":
 	import sys, pprint
 	u = UnitFile(open(sys.argv[1], "r"))
 	print u
-	pprint.pprint(u.values)
+	pprint.pprint(u.to_dict())
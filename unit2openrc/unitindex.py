@@ -0,0 +1,312 @@
+#!/usr/bin/env python2
+"""
+Unit2OpenRC - Unit Index
+
+Knows where all systemd units are placed.
+"""
+from __future__ import unicode_literals
+from . import split_instance, in_root
+from unitfile import UnitFileParser
+from consts import *
+import os, stat
+
+try:
+	from os import scandir
+except ImportError:
+	try:
+		# Backport from PyPI, optional
+		from scandir import scandir
+	except ImportError:
+		scandir = None
+
+
+class UnitIndex(object):
+	"""
+	Index of unit files, built by one pass over all unit directories.
+	
+	Directories are processed in order of precedence, so for every unit
+	name, only first found file is used. Symlink to /dev/null masks unit
+	with same name in all directories with lower precedence.
+	
+	If 'root' is set, unit_dirs are inside of root directory of another
+	system and absolute symlinks are resolved relative to it.
+	Subclasses may override list_dir, list_names, readlink, follow, is_file,
+	is_dir, is_mask and read to index something else than local filesystem.
+	"""
+	MASK_TARGET = "/dev/null"
+	# Directories with symlinks to units wanted or required by another unit
+	DEPENDENCY_DIRS = ( ".wants", ".requires" )
+	# Only entries with these suffixes are needed from unit directories
+	INDEXED_SUFFIXES = ( ".service", ".socket", ".d" ) + DEPENDENCY_DIRS
+	MAX_SYMLINKS = 40
+	
+	def __init__(self, unit_dirs=UNIT_DIRS, root=None):
+		self.root = root
+		# units maps unit name to path, or to None if unit is masked
+		self.units = {}
+		# dropin_dirs maps unit name (or unit type, such as 'service') to
+		# list of drop-in directories, in order of precedence
+		self.dropin_dirs = {}
+		# template_instances maps template name, such as 'foo@.service', to
+		# set of instances enabled by symlinks in .wants and .requires
+		# directories
+		self.template_instances = {}
+		# unresolved maps unit name to path of symlink that doesn't lead
+		# to file, such as target outside of unit directories of archive
+		self.unresolved = {}
+		for d in unit_dirs:
+			for name, path, kind in self.list_dir(d, self.INDEXED_SUFFIXES):
+				if name.endswith(".d") and kind in ("dir", "link"):
+					if kind == "link":
+						path = self.follow(path)
+					if kind == "dir" or self.is_dir(path):
+						self.dropin_dirs.setdefault(name[0:-2], []).append(path)
+					continue
+				if name.endswith(self.DEPENDENCY_DIRS) and kind == "dir":
+					for link in self.list_names(path):
+						template, instance = split_instance(link)
+						if template is not None:
+							self.template_instances.setdefault(template, set()).add(instance)
+					continue
+				if name in self.units:
+					# Already found in directory with higher precedence
+					continue
+				if kind == "link":
+					if self.readlink(path) == self.MASK_TARGET:
+						self.units[name] = None
+						continue
+					target = self.follow(path)
+					if self.is_file(target):
+						self.units[name] = target
+					else:
+						self.unresolved.setdefault(name, path)
+				elif kind == "file":
+					self.units[name] = path
+		for name in self.units:
+			# Found in directory with lower precedence
+			self.unresolved.pop(name, None)
+	
+	
+	def list_dir(self, d, suffixes=None):
+		"""
+		Yields (name, path, kind) for every entry in directory 'd', or only
+		for entries with name ending with one of 'suffixes', if set.
+		"""
+		return list_dir(d, suffixes)
+	
+	
+	def list_names(self, d):
+		""" Returns names of entries in directory 'd', without their kind """
+		try:
+			return os.listdir(d)
+		except OSError:
+			return []
+	
+	
+	def readlink(self, path):
+		""" Returns target of symlink """
+		return os.readlink(path)
+	
+	
+	def follow(self, path):
+		"""
+		Returns path through which symlink should be accessed. That's
+		symlink itself, unless root is set; absolute symlinks would point
+		outside of it, so these are resolved here.
+		"""
+		if self.root is None:
+			return path
+		for i in xrange(self.MAX_SYMLINKS):
+			if not os.path.islink(path):
+				break
+			target = os.readlink(path)
+			if os.path.isabs(target):
+				path = in_root(self.root, target)
+			else:
+				path = os.path.join(os.path.dirname(path), target)
+		return path
+	
+	
+	def is_file(self, path):
+		return os.path.isfile(path)
+	
+	
+	def is_dir(self, path):
+		return os.path.isdir(path)
+	
+	
+	def is_mask(self, path):
+		""" Returns True if symlink masks unit or drop-in """
+		return (self.readlink(path) == self.MASK_TARGET
+			or os.path.realpath(path) == self.MASK_TARGET)
+	
+	
+	def read(self, path):
+		"""
+		Returns contents of unit or drop-in file as byte string.
+		Throws IOError if file cannot be read.
+		"""
+		with open(path, "rb") as f:
+			return f.read()
+	
+	
+	def lookup(self, name):
+		"""
+		Returns path to unit file or None if there is no such unit or unit
+		is masked. If unit name has no suffix, .service is assumed.
+		For instance of template without unit file of its own, path to
+		template is returned.
+		"""
+		for n in (name, name + ".service"):
+			if n in self.units:
+				return self.units[n]
+			template, instance = split_instance(n)
+			if template is not None and self.units.get(template):
+				return self.units[template]
+		return None
+	
+	
+	def is_masked(self, name):
+		""" Returns True if unit is masked """
+		for n in (name, name + ".service"):
+			if n in self.units:
+				return self.units[n] is None
+		return False
+	
+	
+	def dropins(self, name):
+		"""
+		Returns list of drop-in files that should be applied on top of unit,
+		in order in which they should be applied.
+		
+		As in systemd, drop-ins are searched in '<unit>.d' directories,
+		'<prefix>-.<type>.d' directories for every dash-separated prefix of
+		unit name and in '<type>.d' directories. If same file name is found
+		in multiple directories, only one from most specific directory with
+		highest precedence is used. Files are applied sorted by name.
+		"""
+		if "." not in name:
+			return []
+		prefix, unit_type = name.rsplit(".", 1)
+		candidates = [ name ]
+		parts = prefix.split("-")
+		for i in reversed(xrange(1, len(parts))):
+			candidates.append("-".join(parts[0:i]) + "-." + unit_type)
+		candidates.append(unit_type)
+		
+		files = {}
+		for c in candidates:
+			for d in self.dropin_dirs.get(c, ()):
+				for fname, path, kind in self.list_dir(d, (".conf",)):
+					if fname.endswith(".conf") and fname not in files:
+						if kind not in ("file", "link"):
+							continue
+						if kind == "link":
+							if self.is_mask(path):
+								files[fname] = None
+								continue
+							path = self.follow(path)
+						files[fname] = path
+		return [ files[x] for x in sorted(files) if files[x] is not None ]
+	
+	
+	def socket(self, name):
+		"""
+		Returns path to socket unit activating service, or None if there is
+		no such unit or unit is masked. As in systemd, 'foo.socket'
+		activates 'foo.service'.
+		"""
+		if not name.endswith(".service"):
+			return None
+		return self.units.get(name[0:-len(".service")] + ".socket")
+	
+	
+	def socket_services(self):
+		"""
+		Returns dict of {socket name: service name} for every socket unit
+		that is not masked and activates service that exists. As in
+		systemd, service is set by Service= option of socket unit and
+		defaults to service with same name as socket.
+		"""
+		rv = {}
+		for name, path in self.units.iteritems():
+			if path is None or not name.endswith(".socket"):
+				continue
+			service = name[0:-len(".socket")] + ".service"
+			try:
+				for x in [ path ] + self.dropins(name):
+					for section, option, value in UnitFileParser().parse(
+								self.read(x).splitlines(True)):
+						if section == "Socket" and option == "service" and value:
+							service = value
+			except (IOError, ValueError):
+				continue
+			if self.lookup(service) is not None:
+				rv[name] = service
+		return rv
+	
+	
+	def instances(self, template):
+		"""
+		Returns sorted list of enabled instances of template. Instances
+		that have unit file of their own are converted as any other unit
+		and not listed.
+		"""
+		prefix, suffix = template.split("@.", 1)
+		return sorted([ i for i in self.template_instances.get(template, ())
+			if "%s@%s.%s" % (prefix, i, suffix) not in self.units ])
+	
+	
+	def services(self):
+		""" Returns dict of {name: path} with all services that are not masked """
+		return { name : path for (name, path) in self.units.iteritems()
+			if path is not None and name.endswith(".service") }
+
+
+def list_dir(d, suffixes=None):
+	"""
+	Yields (name, path, kind) for every entry in directory, where kind is
+	one of "file", "dir", "link" or "other". If 'suffixes' is set, other
+	entries are skipped. Yields nothing if directory doesn't exist.
+	
+	Uses scandir, if available, so type of entry is known without calling
+	stat on most filesystems. Otherwise, lstat is called only for entries
+	that are not skipped.
+	"""
+	if scandir is not None:
+		try:
+			entries = scandir(d)
+		except OSError:
+			return
+		for e in entries:
+			if suffixes is not None and not e.name.endswith(suffixes):
+				continue
+			if e.is_symlink():
+				yield e.name, e.path, "link"
+			elif e.is_file(follow_symlinks=False):
+				yield e.name, e.path, "file"
+			elif e.is_dir(follow_symlinks=False):
+				yield e.name, e.path, "dir"
+			else:
+				yield e.name, e.path, "other"
+		return
+	try:
+		names = os.listdir(d)
+	except OSError:
+		return
+	for name in names:
+		if suffixes is not None and not name.endswith(suffixes):
+			continue
+		path = os.path.join(d, name)
+		try:
+			mode = os.lstat(path).st_mode
+		except OSError:
+			continue
+		if stat.S_ISLNK(mode):
+			yield name, path, "link"
+		elif stat.S_ISREG(mode):
+			yield name, path, "file"
+		elif stat.S_ISDIR(mode):
+			yield name, path, "dir"
+		else:
+			yield name, path, "other"
@@ -0,0 +1,289 @@
+#!/usr/bin/env python2
+"""
+Unit2OpenRC - Watch
+
+Uses inotify to find out which units were changed, so only these have to
+be converted again.
+"""
+from __future__ import unicode_literals
+from . import split_instance
+from consts import *
+import os, struct, select, time, errno, ctypes, ctypes.util
+
+# Constants from <sys/inotify.h>
+IN_MODIFY		= 0x00000002
+IN_ATTRIB		= 0x00000004
+IN_CLOSE_WRITE	= 0x00000008
+IN_MOVED_FROM	= 0x00000040
+IN_MOVED_TO		= 0x00000080
+IN_CREATE		= 0x00000100
+IN_DELETE		= 0x00000200
+IN_DELETE_SELF	= 0x00000400
+IN_MOVE_SELF	= 0x00000800
+IN_Q_OVERFLOW	= 0x00004000
+IN_IGNORED		= 0x00008000
+IN_ONLYDIR		= 0x01000000
+IN_ISDIR		= 0x40000000
+IN_NONBLOCK		= 0o4000
+IN_CLOEXEC		= 0o2000000
+
+# Events that mean that unit or drop-in was changed
+CHANGE_EVENTS = ( IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM
+	| IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF )
+# Events watched on parent of unit directory that doesn't exist yet
+PARENT_EVENTS = IN_CREATE | IN_MOVED_TO | IN_ONLYDIR
+EVENT_HEADER = struct.Struct(b"iIII")
+
+# Returned by Watcher.wait when any service may be affected
+ALL = None
+
+
+class Inotify(object):
+	"""
+	Minimal inotify binding, using libc through ctypes.
+	Throws OSError if inotify is not available.
+	"""
+	
+	def __init__(self):
+		name = ctypes.util.find_library(b"c")
+		try:
+			self.libc = ctypes.CDLL(name or b"libc.so.6", use_errno=True)
+			self.libc.inotify_init1
+		except (OSError, AttributeError):
+			raise OSError(errno.ENOSYS, "inotify is not available")
+		self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+		if self.fd < 0:
+			e = ctypes.get_errno()
+			raise OSError(e, os.strerror(e))
+	
+	
+	def fileno(self):
+		return self.fd
+	
+	
+	def add_watch(self, path, mask):
+		""" Returns watch descriptor. Throws OSError on failure """
+		if type(path) == unicode:
+			path = path.encode('utf-8')
+		wd = self.libc.inotify_add_watch(self.fd, path, mask)
+		if wd < 0:
+			e = ctypes.get_errno()
+			raise OSError(e, "%s: %s" % (os.strerror(e), path))
+		return wd
+	
+	
+	def read(self):
+		"""
+		Returns list of (wd, mask, name) for all pending events, or empty
+		list if there are none.
+		"""
+		try:
+			data = os.read(self.fd, 65536)
+		except OSError, e:
+			if e.errno in (errno.EAGAIN, errno.EINTR):
+				return []
+			raise
+		rv, pos = [], 0
+		while pos + EVENT_HEADER.size <= len(data):
+			wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, pos)
+			pos += EVENT_HEADER.size
+			name = data[pos:pos + length].rstrip(b"\0").decode('utf-8', 'replace')
+			pos += length
+			rv.append(( wd, mask, name ))
+		return rv
+	
+	
+	def close(self):
+		os.close(self.fd)
+
+
+class Watcher(object):
+	"""
+	Watches unit directories and drop-in directories in them.
+	
+	For unit directory that doesn't exist yet, nearest existing ancestor is
+	watched instead, one level deeper every time missing directory is
+	created, until unit directory itself exists.
+	"""
+	
+	def __init__(self, unit_dirs=UNIT_DIRS, delay=WATCH_DELAY, max_delay=WATCH_MAX_DELAY):
+		self.inotify = Inotify()
+		self.unit_dirs = [ os.path.normpath(d) for d in unit_dirs ]
+		self.delay = delay
+		self.max_delay = max_delay
+		# wds maps watch descriptor to (path, kind), where kind is "units",
+		# "dropins", "wants" or "parent"
+		self.wds = {}
+		for d in self.unit_dirs:
+			self._watch_unit_dir(d)
+	
+	
+	def fileno(self):
+		return self.inotify.fileno()
+	
+	
+	def _watch(self, path, mask, kind):
+		try:
+			wd = self.inotify.add_watch(path, mask)
+		except OSError:
+			# Directory was removed or cannot be watched
+			return False
+		self.wds[wd] = (path, kind)
+		return True
+	
+	
+	def _watch_unit_dir(self, d):
+		"""
+		Watches unit directory and all drop-in, .wants and .requires
+		directories in it. Returns True if unit directory is watched, or
+		False if its ancestor is watched instead.
+		"""
+		if not self._watch(d, CHANGE_EVENTS | IN_ONLYDIR, "units"):
+			return self._watch_ancestor(d)
+		try:
+			names = os.listdir(d)
+		except OSError:
+			return True
+		for name in names:
+			path = os.path.join(d, name)
+			kind = _subdir_kind(name)
+			if kind is not None and os.path.isdir(path):
+				self._watch(path, CHANGE_EVENTS | IN_ONLYDIR, kind)
+		return True
+	
+	
+	def _watch_ancestor(self, d):
+		"""
+		Watches nearest existing ancestor of unit directory 'd', which
+		doesn't exist. Returns True if 'd' was created in meantime and is
+		watched after all.
+		"""
+		child = d.rstrip("/")
+		parent = os.path.dirname(child)
+		while parent != os.path.dirname(parent) and not os.path.isdir(parent):
+			child, parent = parent, os.path.dirname(parent)
+		self._watch(parent, PARENT_EVENTS, "parent")
+		if child != d.rstrip("/") and os.path.isdir(child):
+			# Created before ancestor was watched; continue one level deeper
+			return self._watch_unit_dir(d)
+		return False
+	
+	
+	def _handle(self, wd, mask, name, affected):
+		"""
+		Updates watches as needed and adds services affected by event into
+		'affected' set. Returns False if any service may be affected.
+		"""
+		if mask & IN_Q_OVERFLOW:
+			# Some events were lost
+			return False
+		if wd not in self.wds:
+			return True
+		path, kind = self.wds[wd]
+		if mask & IN_IGNORED:
+			# Directory was removed
+			del self.wds[wd]
+			return True
+		if kind == "parent":
+			child = os.path.join(path, name)
+			everything = False
+			for d in self.unit_dirs:
+				if d == child or d.startswith(child + "/"):
+					# Unit directory or one of its ancestors was just created.
+					# Unit directory may already contain anything
+					if self._watch_unit_dir(d):
+						everything = True
+			return not everything
+		if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+			if kind == "units":
+				# Watch for directory being created again
+				self._watch_ancestor(path)
+				return False
+			return True
+		if kind == "dropins":
+			# Change of drop-in affects unit that directory is named after
+			return _affected_by(os.path.basename(path)[0:-2], affected)
+		if kind == "wants":
+			# Instance of template was enabled or disabled
+			template, instance = split_instance(name)
+			if template is not None:
+				affected.add(template)
+			return True
+		subdir = _subdir_kind(name)
+		if subdir is not None:
+			if mask & (IN_CREATE | IN_MOVED_TO) and mask & IN_ISDIR:
+				self._watch(os.path.join(path, name), CHANGE_EVENTS | IN_ONLYDIR, subdir)
+			if subdir == "dropins":
+				return _affected_by(name[0:-2], affected)
+			# Removed or replaced .wants directory may have had any instances
+			return False
+		return _affected_by(name, affected)
+	
+	
+	def wait(self, timeout=None):
+		"""
+		Blocks until something is changed, or until timeout (in seconds)
+		expires. Returns set of names of services that may be affected,
+		ALL if any service may be affected or empty set on timeout.
+		
+		Events are collected until there is none for 'delay' seconds, or
+		until 'max_delay' seconds pass, so burst of changes, such as package
+		installing many units, is handled at once.
+		"""
+		affected, everything = set(), False
+		r, w, x = select.select([ self ], [], [], timeout)
+		if not r:
+			return affected
+		deadline = time.time() + self.max_delay
+		while True:
+			for wd, mask, name in self.inotify.read():
+				if not self._handle(wd, mask, name, affected):
+					everything = True
+			remaining = deadline - time.time()
+			if remaining <= 0:
+				break
+			r, w, x = select.select([ self ], [], [], min(self.delay, remaining))
+			if not r:
+				break
+		if everything:
+			return ALL
+		return affected
+	
+	
+	def close(self):
+		self.inotify.close()
+
+
+def _subdir_kind(name):
+	"""
+	Returns kind of watch used for subdirectory of unit directory, or None
+	if it doesn't have to be watched.
+	"""
+	if name.endswith(".d"):
+		return "dropins"
+	if name.endswith((".wants", ".requires")):
+		return "wants"
+	return None
+
+
+def _affected_by(name, affected):
+	"""
+	Adds service affected by change of unit or drop-in directory 'name'
+	into 'affected' set. Returns False if drop-in directory affects all
+	units of some type.
+	"""
+	if "." not in name:
+		# Drop-in directory for all units of type, such as 'service.d'
+		return name not in ("service", "socket")
+	prefix, unit_type = name.rsplit(".", 1)
+	if unit_type not in ("service", "socket"):
+		return True
+	if prefix.endswith("-"):
+		# Drop-in directory for all units with prefix
+		return False
+	affected.add(prefix + ".service")
+	template, instance = split_instance(prefix + ".service")
+	if template is not None:
+		# Instance with unit file of its own is not linked to template
+		affected.add(template)
+	return True